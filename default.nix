@@ -20,6 +20,8 @@ python313Packages.buildPythonApplication
     fastapi
     httpx
     uvicorn
+    # parquet export of the accountability history
+    pyarrow
 
     # packages not in nixpkgs
     el_std_py
@@ -0,0 +1,230 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 21:10
+
+Benchmark replaying synthetic gateway workloads against the accountability
+cog event handlers (on_message, on_raw_message_edit, on_raw_message_delete)
+with a temporary database.
+
+Reports the throughput until everything is recorded, the p50/p99 latency of the
+handlers themselves (which includes waiting for space in the ingest queue) and
+the number of SQL statements per event.
+
+Usage: python experiments/bench_accountability.py [workload ...] [--users N] [--speedup X]
+
+Workloads: rollover, edits, deletes (default: all). With --speedup, events
+are replayed with their realistic spacing compressed by that factor,
+otherwise as fast as possible.
+"""
+
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+import discord
+from sqlalchemy import event
+from el.observable import Observable
+
+from compass_app.config import Config
+from compass_app.settings_store import SettingsStore
+from compass_app.database import CompassDB
+from compass_app.webserver import CompassWeb
+from compass_app.scheduler import CompassScheduler
+from compass_app.accountability.manager import AccountabilityManager
+from compass_app.accountability.cog import AccountabilityCommands
+from compass_app.accountability.tables import AccountabilityPeriod
+
+
+CHANNEL_ID = 1_000
+GOAL_THREAD_ID = 1_001
+RESULT_THREAD_ID = 1_002
+BOT_USER = SimpleNamespace(id=1)
+
+
+class BenchApp:
+    """The parts of CompassApp the accountability subsystem needs"""
+
+    def __init__(self, data: Path):
+        self.exited = Observable[bool](False)
+        self.data_path = data
+        self.db_path = data / "bench.db"
+        self.config = Config(
+            discord_bot_token="",
+            discord_guild_id=0,
+            discord_client_id="",
+            discord_client_secret="",
+            discord_redirect_url="",
+            web_host="localhost",
+            web_port=0,
+            accountability_channel_id=CHANNEL_ID,
+        )
+        self.settings_store = SettingsStore(self, data / "settings.json")
+        self.settings = self.settings_store.settings
+        self.bot = SimpleNamespace(user=BOT_USER)
+        self.db = CompassDB(self)
+        # only needed for registering the endpoints, the server isn't started
+        self.web = CompassWeb(self)
+        self.scheduler = CompassScheduler(self)
+        self.accountability = AccountabilityManager(self)
+
+
+# discord objects only with the attributes the handlers use
+def fake_thread(thread_id: int):
+    return SimpleNamespace(
+        id=thread_id,
+        type=discord.ChannelType.public_thread,
+        parent=SimpleNamespace(id=CHANNEL_ID),
+    )
+
+
+def fake_author(user: int):
+    return SimpleNamespace(
+        id=10_000 + user,
+        name=f"member{user}",
+        display_avatar=SimpleNamespace(url=f"https://cdn.example/avatars/{user}.png"),
+    )
+
+
+def fake_message(message_id: int, thread_id: int, user: int, content: str):
+    return SimpleNamespace(
+        id=message_id,
+        channel=fake_thread(thread_id),
+        author=fake_author(user),
+        content=content,
+        type=discord.MessageType.default,
+    )
+
+
+def fake_edit(message):
+    return SimpleNamespace(message_id=message.id, channel_id=message.channel.id, message=message)
+
+
+def fake_delete(message):
+    return SimpleNamespace(message_id=message.id, channel_id=message.channel.id)
+
+
+# A workload is a list of (time offset in seconds, handler name, argument)
+Workload = list[tuple[float, str, object]]
+
+
+def rollover(users: int, rng: random.Random) -> Workload:
+    """All users post their goal and the result of the last week within 10 minutes"""
+    events = []
+    for user in range(users):
+        events.append((rng.uniform(0, 600), "on_message", fake_message(
+            100_000 + user, GOAL_THREAD_ID, user, f"This week I will work out {rng.randint(1, 5)} times"
+        )))
+        events.append((rng.uniform(0, 600), "on_message", fake_message(
+            200_000 + user, RESULT_THREAD_ID, user, "✅" * rng.randint(0, 4) + "❌" * rng.randint(0, 2)
+        )))
+    return sorted(events, key=lambda e: e[0])
+
+
+def edits(users: int, rng: random.Random) -> Workload:
+    """A quarter of the users post results and then keep editing them"""
+    events = []
+    for user in range(users // 4):
+        start = rng.uniform(0, 300)
+        message = fake_message(200_000 + user, RESULT_THREAD_ID, user, "✅")
+        events.append((start, "on_message", message))
+        for edit in range(10):
+            edited = fake_message(message.id, RESULT_THREAD_ID, user, "✅" * (edit + 1) + "❌")
+            events.append((start + rng.uniform(1, 300), "on_raw_message_edit", fake_edit(edited)))
+    return sorted(events, key=lambda e: e[0])
+
+
+def deletes(users: int, rng: random.Random) -> Workload:
+    """All users post goals which are then deleted (e.g. by a moderator cleaning up a thread)"""
+    events = []
+    for user in range(users):
+        message = fake_message(100_000 + user, GOAL_THREAD_ID, user, "some goal")
+        events.append((rng.uniform(0, 300), "on_message", message))
+        events.append((rng.uniform(300, 360), "on_raw_message_delete", fake_delete(message)))
+    return sorted(events, key=lambda e: e[0])
+
+
+WORKLOADS = {
+    "rollover": rollover,
+    "edits": edits,
+    "deletes": deletes,
+}
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def bench(name: str, workload: Workload, speedup: float) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        app = BenchApp(Path(tmp))
+        db_task = asyncio.create_task(app.db.run())
+
+        # the period the workload posts into, known before startup like after a restart
+        async with app.db.session() as session:
+            period = AccountabilityPeriod.from_week(2025, 10)
+            period.goal_channel_id = GOAL_THREAD_ID
+            period.result_channel_id = RESULT_THREAD_ID
+            session.add(period)
+        manager_task = asyncio.create_task(app.accountability.run())
+        await app.accountability.threads.wait_warm()
+
+        statements = 0
+        def count(*args):
+            nonlocal statements
+            statements += 1
+        event.listen(app.db.engine.sync_engine, "before_cursor_execute", count)
+
+        cog = AccountabilityCommands(app)
+        latencies = []
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for offset, handler, argument in workload:
+            if speedup > 0:
+                delay = start + offset / speedup - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            handler_start = time.perf_counter()
+            await getattr(cog, handler)(argument)
+            latencies.append(time.perf_counter() - handler_start)
+        handled = loop.time() - start
+        await app.accountability.ingest.join()
+        elapsed = loop.time() - start
+
+        print(
+            f"{name:>9}: {len(workload)} events, handled in {handled:.2f}s, recorded in {elapsed:.2f}s "
+            f"({len(workload) / elapsed:.0f} events/s), "
+            f"handler p50 {percentile(latencies, 0.5) * 1e6:.0f}µs p99 {percentile(latencies, 0.99) * 1e6:.0f}µs, "
+            f"{statements / len(workload):.2f} statements/event"
+        )
+
+        app.exited.value = True
+        await manager_task
+        await db_task
+        await app.db.engine.dispose()
+        await app.db.read_engine.dispose()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Accountability event handler benchmark")
+    parser.add_argument("workloads", nargs="*", default=list(WORKLOADS), help=", ".join(WORKLOADS))
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--speedup", type=float, default=0, help="replay with realistic spacing compressed by this factor")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload '{name}'")
+
+    for name in args.workloads:
+        workload = WORKLOADS[name](args.users, random.Random(args.seed))
+        await bench(name, workload, args.speedup)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
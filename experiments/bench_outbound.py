@@ -0,0 +1,151 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 22:40
+
+Benchmark of the outbound discord REST paths of the accountability manager
+(period start/end and thread deletion through the outbound queue) against
+the mock discord server in experiments/mock_discord.py, which runs in the
+same process.
+
+Reports the throughput and p50/p99 latency of every operation and how many
+requests were rate limited by the mock and retried by discord.py.
+
+Usage: python experiments/bench_outbound.py [--periods N] [--latency 0.05] [--jitter 0.05] [--error-rate 0]
+"""
+
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from pathlib import Path
+
+import discord
+import uvicorn
+from el.observable import Observable
+
+sys.path.insert(0, str(Path(__file__).parent))
+import mock_discord
+
+from compass_app.config import Config
+from compass_app.settings_store import SettingsStore
+from compass_app.database import CompassDB
+from compass_app.webserver import CompassWeb
+from compass_app.dcbot import DiscordBot
+from compass_app.scheduler import CompassScheduler
+from compass_app.accountability.manager import AccountabilityManager
+from compass_app.accountability.tables import AccountabilityOutbox, OutboundKind
+
+
+PORT = 8901
+
+
+class BenchApp:
+    """The parts of CompassApp the accountability subsystem needs, with a bot using the mock API"""
+
+    def __init__(self, data: Path):
+        self.exited = Observable[bool](False)
+        self.data_path = data
+        self.db_path = data / "bench.db"
+        self.config = Config(
+            discord_bot_token="mock",
+            discord_guild_id=mock_discord.GUILD_ID,
+            discord_client_id="",
+            discord_client_secret="",
+            discord_redirect_url="",
+            web_host="localhost",
+            web_port=0,
+            accountability_channel_id=mock_discord.CHANNEL_ID,
+            discord_api_base=f"http://127.0.0.1:{PORT}/api/v10",
+        )
+        self.settings_store = SettingsStore(self, data / "settings.json")
+        self.settings = self.settings_store.settings
+        self.db = CompassDB(self)
+        # only needed for registering the endpoints, the server isn't started
+        self.web = CompassWeb(self)
+        self.bot = DiscordBot(self)
+        self.scheduler = CompassScheduler(self)
+        self.accountability = AccountabilityManager(self)
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def measure(name: str, operations: list, stats: mock_discord.MockStats) -> list:
+    """Runs operations concurrently and prints their throughput and latency"""
+    requests, limited = stats.requests, stats.rate_limited
+    latencies = []
+    async def timed(operation):
+        start = time.perf_counter()
+        result = await operation
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(timed(operation) for operation in operations), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    failed = sum(isinstance(result, Exception) for result in results)
+    print(
+        f"{name:>14}: {len(operations)} in {elapsed:.2f}s ({len(operations) / elapsed:.1f}/s), "
+        f"p50 {percentile(latencies, 0.5) * 1000:.0f}ms p99 {percentile(latencies, 0.99) * 1000:.0f}ms, "
+        f"{stats.requests - requests} requests, {stats.rate_limited - limited} rate limited, {failed} failed"
+    )
+    return results
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Accountability outbound REST benchmark")
+    parser.add_argument("--periods", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    mock = mock_discord.create_app(args.latency, args.jitter, args.error_rate)
+    server = uvicorn.Server(uvicorn.Config(mock, host="127.0.0.1", port=PORT, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    stats = mock.state.stats
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = BenchApp(Path(tmp))
+        db_task = asyncio.create_task(app.db.run())
+        manager_task = asyncio.create_task(app.accountability.run())
+        await app.bot.login(app.config.discord_bot_token)
+
+        weeks = range(1, args.periods + 1)
+        goal_threads = await measure(
+            "start period", [app.accountability.start_period(week, 2025) for week in weeks], stats
+        )
+        result_threads = await measure(
+            "end period", [app.accountability.end_period(week, 2025) for week in weeks], stats
+        )
+        threads = [thread for thread in goal_threads + result_threads if isinstance(thread, discord.Thread)]
+        async with app.db.session() as session:
+            deletions = [
+                AccountabilityOutbox(kind=OutboundKind.DELETE_THREAD, channel_id=thread.id)
+                for thread in threads
+            ]
+            session.add_all(deletions)
+        outbound = app.accountability.outbound
+        await measure(
+            "delete thread", [outbound.wait(outbound.submit(action.id)) for action in deletions], stats
+        )
+
+        await app.bot.close()
+        app.exited.value = True
+        await manager_task
+        await db_task
+        await app.db.engine.dispose()
+        await app.db.read_engine.dispose()
+
+    server.should_exit = True
+    await server_task
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 12:20
+
+Microbenchmark comparing the previous ORM get-or-create path for recording
+accountability goals with the single statement upserts.
+
+Usage: python experiments/bench_upsert.py [users] [rounds]
+"""
+
+import sys
+import time
+import asyncio
+import tempfile
+from pathlib import Path
+from datetime import datetime, timezone
+
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from compass_app.database import CompassUser
+from compass_app.accountability.tables import AccountabilityPeriod, AccountabilityEntry, AccountabilityGoal
+
+
+async def record_orm(session: AsyncSession, period: AccountabilityPeriod, discord_id: int, message_id: int):
+    """The get-or-create path as it was used before the upserts"""
+    user = await session.scalar(
+        select(CompassUser).where(CompassUser.discord_id == discord_id)
+    )
+    if user is None:
+        user = CompassUser(discord_id=discord_id, username=f"user{discord_id}")
+        session.add(user)
+    entry = await session.scalar(
+        select(AccountabilityEntry).where(
+            AccountabilityEntry.user == user,
+            AccountabilityEntry.period == period
+        )
+    )
+    if entry is None:
+        entry = AccountabilityEntry(user=user, period=period)
+        session.add(entry)
+    goal = await entry.awaitable_attrs.goal
+    if goal is None:
+        entry.goal = AccountabilityGoal(message_id=message_id, text="my goal")
+        session.add(entry)
+
+
+async def record_upsert(session: AsyncSession, period: AccountabilityPeriod, discord_id: int, message_id: int):
+    """The upsert path as used by the ingest queue (without user ID cache)"""
+    user_id = await CompassUser.upsert_from_discord(session, discord_id, f"user{discord_id}")
+    goal_id = (await session.execute(
+        insert(AccountabilityGoal).values(
+            message_id=message_id,
+            text="my goal",
+            date_created=datetime.now(timezone.utc),
+        ).returning(AccountabilityGoal.id)
+    )).scalar_one()
+    await AccountabilityEntry.upsert(session, user_id, period.id, goal_id=goal_id)
+
+
+async def bench(name: str, record, users: int, rounds: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{Path(tmp) / 'bench.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
+        statements = 0
+        def count(*args):
+            nonlocal statements
+            statements += 1
+        event.listen(engine.sync_engine, "before_cursor_execute", count)
+
+        periods = []
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            for week in range(rounds):
+                period = AccountabilityPeriod.from_week(2025, week + 1)
+                session.add(period)
+                periods.append(period)
+            await session.commit()
+        statements = 0
+
+        # every user posts one goal per period, each in its own transaction
+        start = time.perf_counter()
+        for period in periods:
+            for user in range(users):
+                async with AsyncSession(engine, expire_on_commit=False) as session:
+                    async with session.begin():
+                        await record(session, period, 10_000 + user, period.id * 100_000 + user)
+        elapsed = time.perf_counter() - start
+
+        total = users * rounds
+        print(
+            f"{name:>8}: {total} goals in {elapsed:.2f}s, "
+            f"{total / elapsed:.0f} goals/s, {statements / total:.1f} statements/goal"
+        )
+        await engine.dispose()
+
+
+async def main() -> None:
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    await bench("orm", record_orm, users, rounds)
+    await bench("upsert", record_upsert, users, rounds)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,52 +1,65 @@
-#import datetime
-#
-#def current_us_week_dates():
-#    today = datetime.date.today()
-#    # weekday(): Monday=0 ... Sunday=6
-#    weekday = today.weekday()
-#    
-#    # Find Sunday (start of week in US style)
-#    sunday = today - datetime.timedelta(days=(weekday + 1) % 7)
-#    # Saturday is 6 days after Sunday
-#    saturday = sunday + datetime.timedelta(days=6)
-#    
-#    # Get US-style week number (%U: weeks start on Sunday)
-#    week_number = int(today.strftime("%U"))
-#    year = today.year
-#    
-#    return year, week_number, sunday, saturday
-#
-#if __name__ == "__main__":
-#    year, week, start, end = current_us_week_dates()
-#    print(f"Current US-style week: {week} of {year}")
-#    print(f"Start (Sunday): {start}")
-#    print(f"End   (Saturday): {end}")
-
-from datetime import datetime, timedelta, date
-
-def get_us_week_dates(year, week):
-    """
-    Given a year and a US-style week number, returns the start (Sunday) and end (Saturday) dates.
-    Week 1 is the week containing January 1, starting on Sunday.
-    """
-    #
-    jan1 = datetime(year, 1, 1)
-    # Find the Sunday on or before Jan 1
-    days_to_sunday = jan1.weekday() + 1  # weekday(): Mon=0, Sun=6
-    first_sunday = jan1 - timedelta(days=days_to_sunday % 7)
-    
-    # Calculate start and end dates of the requested week
-    start_date = first_sunday + timedelta(weeks=week)
-    end_date = start_date + timedelta(days=6)
-    
-    return start_date.date(), end_date.date()
-
-
-# Example:
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+
+Property checks for the compass week calendar (compass_app.weeks),
+focused on year boundaries. Run with: python experiments/calendarweek.py
+"""
+
+import random
+from datetime import date, timedelta
+
+from compass_app.weeks import CompassCalendar, first_sunday
+
+
+def check(calendar: CompassCalendar, days: int = 20000, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    first = date(calendar.first_year - 3, 1, 1).toordinal()
+    last = date(calendar.last_year + 3, 12, 31).toordinal()
+
+    for _ in range(days):
+        day = date.fromordinal(rng.randint(first, last))
+        week = calendar.week_of(day)
+
+        # every day lies within its week, which runs from Sunday to Saturday
+        assert week.start <= day <= week.end, day
+        assert week.start.weekday() == 6 and week.end.weekday() == 5, day
+        assert (week.end - week.start).days == 6, day
+
+        # week -> date range -> week round trips
+        assert calendar.week(week.year, week.week) == week, day
+
+        # weeks are consecutive, also across year boundaries
+        following = calendar.week_of(week.end + timedelta(days=1))
+        if following.year == week.year:
+            assert following.week == week.week + 1, day
+        else:
+            assert following.year == week.year + 1 and following.week == 1, day
+            assert week.week == calendar.weeks_in_year(week.year), day
+
+        # on and after the first Sunday, the number matches %U
+        if day >= first_sunday(day.year):
+            assert week.year == day.year and week.week == int(day.strftime("%U")), day
+        else:
+            assert week.year == day.year - 1, day
+
+    # batch conversion agrees with single lookups
+    sample = [date.fromordinal(rng.randint(first, last)) for _ in range(1000)]
+    assert calendar.weeks_of(sample) == [calendar.week_of(d) for d in sample]
+
+    # week 1 always starts in the first seven days of January
+    for year in range(calendar.first_year - 3, calendar.last_year + 3):
+        start = calendar.week(year, 1).start
+        assert start.month == 1 and start.day <= 7 and start.weekday() == 6, year
+        assert calendar.weeks_in_year(year) in (52, 53), year
+
+    # known reference weeks
+    assert calendar.week(2025, 1).start == date(2025, 1, 5)
+    assert calendar.week_of(date(2025, 1, 4)).year == 2024
+    assert calendar.week(2023, 1).start == date(2023, 1, 1)
+
+
 if __name__ == "__main__":
-    year = 2026
-    week = 1
-    start, end = get_us_week_dates(year, week)
-    print(f"Week {week} of {year} starts on {start} and ends on {end}")
-    #print(date(2025, 9, 29).strftime("%U"))
-    #print(datetime.strptime("2025-39", "%Y-%U"))
+    check(CompassCalendar())
+    check(CompassCalendar(2030, 2030), seed=1)
+    print("All calendar checks passed.")
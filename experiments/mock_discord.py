@@ -0,0 +1,349 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 22:00
+
+Local stand-in for the Discord REST API, for load testing the outbound
+paths of the bot without hitting Discord.
+
+It emulates the endpoints the bot uses (login, application info, channels,
+threads, messages) with an in-memory store, per-route rate limit buckets
+that answer with 429s and the same headers as Discord, a global rate limit
+and injected latency.
+
+Point the bot at it with the "discord_api_base" config option, e.g.
+"http://127.0.0.1:8900/api/v10". In that mode the bot doesn't connect to
+the gateway.
+
+Usage: python experiments/mock_discord.py [--port 8900] [--latency 0.05] [--jitter 0.05] [--error-rate 0]
+"""
+
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import dataclasses
+from datetime import datetime, timezone
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+
+# snowflakes for everything created by the mock, starting at a plausible value
+_snowflakes = itertools.count(1_300_000_000_000_000_000)
+
+GUILD_ID = 500
+CHANNEL_ID = 1_000
+BOT_USER = {
+    "id": "1",
+    "username": "compass-mock-bot",
+    "discriminator": "0",
+    "global_name": None,
+    "avatar": None,
+    "bot": True,
+}
+
+
+@dataclasses.dataclass
+class Bucket:
+    """Fixed window rate limit bucket, like the ones discord reports in its headers"""
+    name: str
+    limit: int
+    window: float
+    remaining: int = 0
+    reset_at: float = 0
+
+    def take(self, now: float) -> bool:
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.window
+        if self.remaining == 0:
+            return False
+        self.remaining -= 1
+        return True
+
+    def headers(self, now: float) -> dict[str, str]:
+        return {
+            "X-RateLimit-Bucket": self.name,
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": f"{time.time() + (self.reset_at - now):.3f}",
+            "X-RateLimit-Reset-After": f"{max(0, self.reset_at - now):.3f}",
+        }
+
+
+# (limit, window in seconds) per route, similar to what discord uses for bots
+ROUTE_LIMITS = {
+    "get_user": (5, 5),
+    "get_application": (5, 5),
+    "get_channel": (5, 5),
+    "create_thread": (10, 10),
+    "send_message": (5, 5),
+    "get_message": (5, 5),
+    "get_messages": (5, 5),
+    "delete_message": (5, 1),
+    "delete_channel": (5, 5),
+}
+GLOBAL_LIMIT = (50, 1)
+
+
+@dataclasses.dataclass
+class MockStats:
+    requests: int = 0
+    rate_limited: int = 0
+    errors: int = 0
+    by_route: dict[str, int] = dataclasses.field(default_factory=dict)
+
+
+def timestamp() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def create_app(
+    latency: float = 0.05,
+    jitter: float = 0.05,
+    error_rate: float = 0.0,
+    route_limits: dict[str, tuple[int, float]] = ROUTE_LIMITS,
+    global_limit: tuple[int, float] = GLOBAL_LIMIT,
+) -> FastAPI:
+    """
+    Creates the mock API app.
+
+    Parameters
+    ----------
+    latency : float
+        base latency of every request in seconds
+    jitter : float
+        random extra latency of up to this many seconds
+    error_rate : float
+        share of requests that fail with a 500 error
+    route_limits : dict[str, (int, float)]
+        requests per window (seconds) of every route, per channel
+    global_limit : (int, float)
+        requests per window (seconds) over all routes
+    """
+    app = FastAPI()
+    stats = MockStats()
+    buckets: dict[tuple[str, str], Bucket] = {}
+    global_bucket = Bucket("global", *global_limit)
+
+    channels: dict[int, dict] = {
+        CHANNEL_ID: {
+            "id": str(CHANNEL_ID),
+            "type": 0,
+            "guild_id": str(GUILD_ID),
+            "name": "accountability",
+            "position": 0,
+            "permission_overwrites": [],
+            "nsfw": False,
+            "parent_id": None,
+            "topic": None,
+            "last_message_id": None,
+            "rate_limit_per_user": 0,
+        }
+    }
+    # messages of every channel in the order they were posted
+    messages: dict[int, dict[int, dict]] = {CHANNEL_ID: {}}
+
+    def not_found(what: str, code: int) -> JSONResponse:
+        return JSONResponse({"message": f"Unknown {what}", "code": code}, status_code=404)
+
+    async def limited(route: str, major: str, request: Request, handler) -> Response:
+        stats.requests += 1
+        stats.by_route[route] = stats.by_route.get(route, 0) + 1
+        await asyncio.sleep(latency + random.uniform(0, jitter))
+
+        now = time.monotonic()
+        bucket = buckets.get((route, major))
+        if bucket is None:
+            bucket = buckets[(route, major)] = Bucket(f"{route}:{major}", *route_limits[route])
+
+        for scope, limiter in (("global", global_bucket), ("user", bucket)):
+            if not limiter.take(now):
+                stats.rate_limited += 1
+                retry_after = max(0.001, limiter.reset_at - now)
+                return JSONResponse(
+                    {"message": "You are being rate limited.", "retry_after": retry_after, "global": scope == "global"},
+                    status_code=429,
+                    headers={
+                        **bucket.headers(now),
+                        "Retry-After": f"{retry_after:.3f}",
+                        "X-RateLimit-Scope": scope,
+                        **({"X-RateLimit-Global": "true"} if scope == "global" else {}),
+                    },
+                )
+
+        if random.random() < error_rate:
+            stats.errors += 1
+            return JSONResponse({"message": "Internal Server Error", "code": 0}, status_code=500)
+
+        response = await handler()
+        response.headers.update(bucket.headers(now))
+        return response
+
+    def message_data(channel_id: int, content: str) -> dict:
+        return {
+            "id": str(next(_snowflakes)),
+            "channel_id": str(channel_id),
+            "author": BOT_USER,
+            "content": content,
+            "timestamp": timestamp(),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0,
+        }
+
+    @app.get("/api/v10/users/@me")
+    async def get_user(request: Request):
+        async def handler():
+            return JSONResponse(BOT_USER)
+        return await limited("get_user", "", request, handler)
+
+    @app.get("/api/v10/oauth2/applications/@me")
+    async def get_application(request: Request):
+        async def handler():
+            return JSONResponse({
+                "id": BOT_USER["id"],
+                "name": BOT_USER["username"],
+                "description": "",
+                "icon": None,
+                "bot_public": False,
+                "bot_require_code_grant": False,
+                "owner": BOT_USER,
+                "verify_key": "",
+                "flags": 0,
+            })
+        return await limited("get_application", "", request, handler)
+
+    @app.get("/api/v10/channels/{channel_id}")
+    async def get_channel(channel_id: int, request: Request):
+        async def handler():
+            if channel_id not in channels:
+                return not_found("Channel", 10003)
+            return JSONResponse(channels[channel_id])
+        return await limited("get_channel", str(channel_id), request, handler)
+
+    @app.delete("/api/v10/channels/{channel_id}")
+    async def delete_channel(channel_id: int, request: Request):
+        async def handler():
+            channel = channels.pop(channel_id, None)
+            if channel is None:
+                return not_found("Channel", 10003)
+            messages.pop(channel_id, None)
+            return JSONResponse(channel)
+        return await limited("delete_channel", str(channel_id), request, handler)
+
+    @app.post("/api/v10/channels/{channel_id}/threads")
+    async def create_thread(channel_id: int, request: Request):
+        async def handler():
+            if channel_id not in channels:
+                return not_found("Channel", 10003)
+            body = await request.json()
+            thread_id = next(_snowflakes)
+            channels[thread_id] = {
+                "id": str(thread_id),
+                "type": body.get("type", 11),
+                "guild_id": str(GUILD_ID),
+                "parent_id": str(channel_id),
+                "owner_id": BOT_USER["id"],
+                "name": body["name"],
+                "last_message_id": None,
+                "rate_limit_per_user": 0,
+                "message_count": 0,
+                "member_count": 1,
+                "flags": 0,
+                "thread_metadata": {
+                    "archived": False,
+                    "auto_archive_duration": body.get("auto_archive_duration", 1440),
+                    "archive_timestamp": timestamp(),
+                    "locked": False,
+                },
+            }
+            messages[thread_id] = {}
+            return JSONResponse(channels[thread_id], status_code=201)
+        return await limited("create_thread", str(channel_id), request, handler)
+
+    @app.post("/api/v10/channels/{channel_id}/messages")
+    async def send_message(channel_id: int, request: Request):
+        async def handler():
+            if channel_id not in channels:
+                return not_found("Channel", 10003)
+            body = await request.json()
+            message = message_data(channel_id, body.get("content", ""))
+            messages[channel_id][int(message["id"])] = message
+            return JSONResponse(message)
+        return await limited("send_message", str(channel_id), request, handler)
+
+    @app.get("/api/v10/channels/{channel_id}/messages")
+    async def get_messages(
+        channel_id: int,
+        request: Request,
+        limit: int = 50,
+        before: int | None = None,
+        after: int | None = None,
+    ):
+        async def handler():
+            if channel_id not in channels:
+                return not_found("Channel", 10003)
+            ids = sorted(messages[channel_id])
+            if after is not None:
+                # oldest messages after the ID
+                page = [i for i in ids if i > after][:limit]
+            else:
+                page = [i for i in ids if before is None or i < before][-limit:]
+            # discord returns messages newest first
+            return JSONResponse([messages[channel_id][i] for i in reversed(page)])
+        return await limited("get_messages", str(channel_id), request, handler)
+
+    @app.get("/api/v10/channels/{channel_id}/messages/{message_id}")
+    async def get_message(channel_id: int, message_id: int, request: Request):
+        async def handler():
+            message = messages.get(channel_id, {}).get(message_id)
+            if message is None:
+                return not_found("Message", 10008)
+            return JSONResponse(message)
+        return await limited("get_message", str(channel_id), request, handler)
+
+    @app.delete("/api/v10/channels/{channel_id}/messages/{message_id}")
+    async def delete_message(channel_id: int, message_id: int, request: Request):
+        async def handler():
+            if messages.get(channel_id, {}).pop(message_id, None) is None:
+                return not_found("Message", 10008)
+            return Response(status_code=204)
+        return await limited("delete_message", str(channel_id), request, handler)
+
+    @app.get("/_mock/stats")
+    async def get_stats():
+        return dataclasses.asdict(stats)
+
+    app.state.stats = stats
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mock Discord REST API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    uvicorn.run(
+        create_app(args.latency, args.jitter, args.error_rate),
+        host=args.host,
+        port=args.port,
+        log_level="warning",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+19.10.26, 05:20
+
+Read-only JSON API of the accountability data for the web app.
+
+Lists are paginated by key (the year and week of the last period on the
+page) instead of offsets, so every page is a range scan on the period
+index no matter how deep it is. Related rows are loaded in the same query.
+Every response carries an ETag built from the data versions, which are
+checked before anything is queried, so polling unchanged data costs a
+304 and no database access.
+"""
+
+import re
+import typing
+
+from fastapi import Request, Query, HTTPException
+from fastapi.responses import JSONResponse, Response, FileResponse
+from starlette.background import BackgroundTask
+from sqlmodel import select
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload, contains_eager
+
+from compass_app.database import CompassUser
+from .tables import AccountabilityPeriod, AccountabilityEntry, AccountabilityGoal, AccountabilityResult
+from .versions import DataVersions
+from .export import FORMATS
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+    from compass_app.sessions import Session
+
+
+# cursors are the year and week of the last item of the previous page
+_CURSOR = re.compile(r"(\d{4})-(\d{1,2})")
+
+
+def _parse_cursor(cursor: str | None) -> tuple[int, int] | None:
+    if cursor is None:
+        return None
+    match = _CURSOR.fullmatch(cursor)
+    if match is None:
+        raise HTTPException(status_code=400, detail="Invalid cursor, expected <year>-<week>")
+    return int(match[1]), int(match[2])
+
+
+def _cursor(period: AccountabilityPeriod) -> str:
+    return f"{period.year}-{period.week:02d}"
+
+
+def _id(value: int | None) -> str | None:
+    # discord IDs don't fit into the numbers of JavaScript
+    return str(value) if value is not None else None
+
+
+def _period_json(period: AccountabilityPeriod) -> dict:
+    return {
+        "id": period.id,
+        "year": period.year,
+        "week": period.week,
+        "start": period.period_start.isoformat(),
+        "end": period.period_end.isoformat(),
+        "goal_thread_id": _id(period.goal_channel_id),
+        "result_thread_id": _id(period.result_channel_id),
+    }
+
+
+def _user_json(user: CompassUser) -> dict:
+    return {
+        "id": user.id,
+        "discord_id": _id(user.discord_id),
+        "username": user.username,
+        "avatar": user.avatar,
+    }
+
+
+def _goal_json(goal: AccountabilityGoal | None) -> dict | None:
+    if goal is None:
+        return None
+    return {
+        "message_id": _id(goal.message_id),
+        "text": goal.text,
+        "date_created": goal.date_created.isoformat() if goal.date_created is not None else None,
+    }
+
+
+def _result_json(result: AccountabilityResult | None) -> dict | None:
+    if result is None:
+        return None
+    return {
+        "message_id": _id(result.message_id),
+        "text": result.text,
+        "success_count": result.success_count,
+        "fail_count": result.fail_count,
+        "date_created": result.date_created.isoformat(),
+    }
+
+
+def _not_modified(request: Request, etag: str) -> Response | None:
+    """Returns a 304 response if the client already has the current version"""
+    if etag in (tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    return None
+
+
+def _json(content: typing.Any, etag: str) -> JSONResponse:
+    # clients have to revalidate every time, which is cheap thanks to the ETag
+    return JSONResponse(content, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+
+class AccountabilityAPI:
+    """
+    Registers the accountability endpoints on the web server. All of them
+    require a logged in user.
+    """
+
+    def __init__(self, app: "CompassApp", versions: DataVersions):
+        self._app = app
+        web = self._app.web
+
+        @web.get("/api/accountability/periods")
+        async def list_periods(
+            request: Request,
+            before: str | None = None,
+            limit: int = Query(50, ge=1, le=200),
+        ):
+            """Periods from the newest to the oldest"""
+            await self._check_session(request)
+            etag = versions.etag(versions.periods)
+            if (response := _not_modified(request, etag)) is not None:
+                return response
+
+            cursor = _parse_cursor(before)
+            stmt = (
+                select(AccountabilityPeriod)
+                .order_by(AccountabilityPeriod.year.desc(), AccountabilityPeriod.week.desc())
+                .limit(limit + 1)
+            )
+            if cursor is not None:
+                stmt = stmt.where(tuple_(AccountabilityPeriod.year, AccountabilityPeriod.week) < cursor)
+            async with self._app.db.read_session() as session:
+                periods = (await session.exec(stmt)).all()
+
+            page = periods[:limit]
+            return _json({
+                "periods": [_period_json(period) for period in page],
+                "next": _cursor(page[-1]) if len(periods) > limit else None,
+            }, etag)
+
+        @web.get("/api/accountability/periods/{period_id}")
+        async def get_period(request: Request, period_id: int):
+            """A period with the goals and results of all users"""
+            await self._check_session(request)
+            etag = versions.etag(versions.period(period_id))
+            if (response := _not_modified(request, etag)) is not None:
+                return response
+
+            async with self._app.db.read_session() as session:
+                period = (await session.exec(
+                    select(AccountabilityPeriod)
+                    .where(AccountabilityPeriod.id == period_id)
+                    .options(joinedload(AccountabilityPeriod.entries).options(
+                        joinedload(AccountabilityEntry.user),
+                        joinedload(AccountabilityEntry.goal),
+                        joinedload(AccountabilityEntry.result),
+                    ))
+                )).unique().one_or_none()
+            if period is None:
+                raise HTTPException(status_code=404, detail="Period not found")
+
+            return _json({
+                **_period_json(period),
+                "entries": [
+                    {
+                        "user": _user_json(entry.user),
+                        "goal": _goal_json(entry.goal),
+                        "result": _result_json(entry.result),
+                    }
+                    for entry in sorted(period.entries, key=lambda entry: entry.id)
+                ],
+            }, etag)
+
+        @web.get("/api/accountability/users/{user_id}/entries")
+        async def list_user_entries(
+            request: Request,
+            user_id: int,
+            before: str | None = None,
+            limit: int = Query(20, ge=1, le=200),
+        ):
+            """Goals and results of a user from the newest period to the oldest"""
+            await self._check_session(request)
+            # entries reference their period, so both need to be unchanged
+            etag = versions.etag(versions.entries, versions.periods)
+            if (response := _not_modified(request, etag)) is not None:
+                return response
+
+            cursor = _parse_cursor(before)
+            stmt = (
+                select(AccountabilityEntry)
+                .join(AccountabilityEntry.period)
+                .where(AccountabilityEntry.user_id == user_id)
+                .options(
+                    contains_eager(AccountabilityEntry.period),
+                    joinedload(AccountabilityEntry.goal),
+                    joinedload(AccountabilityEntry.result),
+                )
+                .order_by(AccountabilityPeriod.year.desc(), AccountabilityPeriod.week.desc())
+                .limit(limit + 1)
+            )
+            if cursor is not None:
+                stmt = stmt.where(tuple_(AccountabilityPeriod.year, AccountabilityPeriod.week) < cursor)
+            async with self._app.db.read_session() as session:
+                user = await session.get(CompassUser, user_id)
+                if user is None:
+                    raise HTTPException(status_code=404, detail="User not found")
+                entries = (await session.exec(stmt)).all()
+
+            page = entries[:limit]
+            return _json({
+                "user": _user_json(user),
+                "entries": [
+                    {
+                        "period": _period_json(entry.period),
+                        "goal": _goal_json(entry.goal),
+                        "result": _result_json(entry.result),
+                    }
+                    for entry in page
+                ],
+                "next": _cursor(page[-1].period) if len(entries) > limit else None,
+            }, etag)
+
+        @web.get("/api/accountability/export")
+        async def export(request: Request, format: str = "ndjson"):
+            """The full history as a download"""
+            session = await self._check_session(request)
+            if not session.has_role("admin"):
+                raise HTTPException(status_code=403, detail="Requires the admin role")
+            exporter = self._app.accountability.export
+            if format not in exporter.available_formats():
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Unsupported format, available: {', '.join(exporter.available_formats())}"
+                )
+            try:
+                path = await exporter.spool(format)
+            except TimeoutError as e:
+                raise HTTPException(status_code=503, detail=str(e))
+            return FileResponse(
+                path,
+                media_type=FORMATS[format][1],
+                filename=exporter.file_name(format),
+                background=BackgroundTask(path.unlink, missing_ok=True),
+            )
+
+    async def _check_session(self, request: Request) -> "Session":
+        # resolved on every request, so the API can be set up before the auth subsystem
+        return await self._app.auth.sessions(request)
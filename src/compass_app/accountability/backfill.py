@@ -0,0 +1,299 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 18:05
+
+Backfill of accountability data from the discord thread history
+and catch up on messages missed while disconnected
+"""
+
+import re
+import typing
+import asyncio
+import logging
+import dataclasses
+from datetime import date, timedelta
+
+import discord
+from sqlmodel import select
+
+from compass_app import weeks
+from compass_app.weeks import CompassWeek
+from .tables import AccountabilityPeriod, AccountabilityCheckpoint
+from .index import ThreadRole
+from .ingest import IngestEvent
+from .journal import PeriodEvent, PeriodEventKind
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+# names of the threads created by the accountability manager
+_THREAD_NAME = re.compile(r"^Week (\d+) Accountability (Setting|Check In)")
+
+
+@dataclasses.dataclass
+class BackfillProgress:
+    periods: int = 0
+    periods_created: int = 0
+    threads_total: int = 0
+    threads_done: int = 0
+    threads_failed: int = 0
+    # messages that were not recorded before
+    recorded: int = 0
+    # messages that were already recorded and have been updated
+    updated: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.threads_done}/{self.threads_total} threads of {self.periods} periods "
+            f"({self.threads_failed} failed, {self.periods_created} periods recovered), "
+            f"{self.recorded} messages recorded, {self.updated} updated"
+        )
+
+
+ProgressCallback = typing.Callable[[BackfillProgress], typing.Awaitable[None]]
+
+
+class AccountabilityBackfill:
+    """
+    Rebuilds accountability data of a range of weeks from the message history
+    of the goal and result threads.
+
+    Threads are read with bounded concurrency (`accountability_backfill_concurrency`)
+    and discord.py pages through the history and waits out rate limits.
+    All messages go through the ingest queue, so they are written in batches and
+    scored like live messages. Messages that are already recorded are sent as edits,
+    so running a backfill multiple times is safe.
+
+    The catch up after (re)connecting to the gateway works the same way but only
+    reads the threads of recent periods after their checkpoint.
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        # there is only one backfill at a time
+        self._lock = asyncio.Lock()
+        self._catch_up_lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def rebuild(
+        self,
+        first: CompassWeek,
+        last: CompassWeek,
+        progress: ProgressCallback | None = None,
+    ) -> BackfillProgress:
+        """
+        Backfills all periods from week `first` to week `last` (inclusive).
+        Periods that are missing in the database (e.g. after a reset) are recovered
+        from the threads in the accountability channel first.
+
+        Raises
+        ------
+        RuntimeError
+            Another backfill is already running
+        """
+        if self._lock.locked():
+            raise RuntimeError("A backfill is already running")
+        async with self._lock:
+            state = BackfillProgress()
+            _log.info(f"Backfilling accountability from {first} to {last}")
+
+            try:
+                await self._recover_periods(first, last, state)
+            except discord.DiscordException as e:
+                _log.warning(f"Failed to recover accountability periods from discord: {e}")
+
+            async with self._app.db.read_session() as session:
+                periods = (await session.exec(
+                    select(AccountabilityPeriod).where(
+                        AccountabilityPeriod.year * 100 + AccountabilityPeriod.week >= first.year * 100 + first.week,
+                        AccountabilityPeriod.year * 100 + AccountabilityPeriod.week <= last.year * 100 + last.week,
+                    )
+                )).all()
+            state.periods = len(periods)
+
+            threads: list[tuple[int, int, ThreadRole]] = []
+            for period in periods:
+                if period.goal_channel_id is not None:
+                    threads.append((period.id, period.goal_channel_id, ThreadRole.GOAL))
+                if period.result_channel_id is not None:
+                    threads.append((period.id, period.result_channel_id, ThreadRole.RESULT))
+            state.threads_total = len(threads)
+
+            semaphore = asyncio.Semaphore(max(1, self._app.settings.accountability_backfill_concurrency))
+            async def backfill_thread(period_id: int, thread_id: int, role: ThreadRole):
+                async with semaphore:
+                    try:
+                        await self._backfill_thread(period_id, thread_id, role, state)
+                    except discord.DiscordException as e:
+                        state.threads_failed += 1
+                        _log.warning(f"Failed to backfill accountability thread {thread_id}: {e}")
+                    state.threads_done += 1
+                    if progress is not None:
+                        await progress(state)
+
+            await asyncio.gather(*(backfill_thread(*thread) for thread in threads))
+
+            # everything is only backfilled once it is written
+            await self._app.accountability.ingest.join()
+            # streaks are numbered over all periods, so a recovered week changes
+            # the scores of users without a result in it as well
+            if state.periods_created > 0:
+                await self._app.accountability.scoring.recompute()
+            _log.info(f"Backfill finished: {state}")
+            return state
+
+    async def catch_up(self) -> BackfillProgress | None:
+        """
+        Records messages that were posted in the threads of recent periods after
+        their checkpoint, e.g. while the bot was disconnected. Returns None if a
+        catch up is already running.
+        """
+        if self._catch_up_lock.locked():
+            return None
+        async with self._catch_up_lock:
+            state = BackfillProgress()
+            oldest_end = date.today() - timedelta(weeks=self._app.settings.accountability_catch_up_weeks)
+            async with self._app.db.read_session() as session:
+                periods = (await session.exec(
+                    select(AccountabilityPeriod).where(AccountabilityPeriod.period_end >= oldest_end)
+                )).all()
+                checkpoints = dict((await session.exec(
+                    select(AccountabilityCheckpoint.thread_id, AccountabilityCheckpoint.message_id)
+                )).all())
+            state.periods = len(periods)
+
+            for period in periods:
+                for thread_id, role in (
+                    (period.goal_channel_id, ThreadRole.GOAL),
+                    (period.result_channel_id, ThreadRole.RESULT),
+                ):
+                    if thread_id is None:
+                        continue
+                    state.threads_total += 1
+                    # without checkpoint, all messages after the thread creation are read
+                    after = checkpoints.get(thread_id, thread_id)
+                    try:
+                        await self._backfill_thread(period.id, thread_id, role, state, after)
+                    except discord.DiscordException as e:
+                        state.threads_failed += 1
+                        _log.warning(f"Failed to catch up on accountability thread {thread_id}: {e}")
+                    state.threads_done += 1
+
+            if state.recorded > 0:
+                _log.info(f"Caught up on missed accountability messages: {state}")
+            return state
+
+    async def _backfill_thread(
+        self,
+        period_id: int,
+        thread_id: int,
+        role: ThreadRole,
+        state: BackfillProgress,
+        after: int | None = None,
+    ) -> None:
+        bot = self._app.bot
+        thread = await bot.get_or_fetch_channel(thread_id)
+
+        messages = self._app.accountability.messages
+        ingest = self._app.accountability.ingest
+        # oldest first, so the first message of a user wins like it does live
+        async for message in thread.history(
+            limit=None,
+            after=discord.Object(after) if after is not None else None,
+            oldest_first=True,
+        ):
+            if message.author == bot.user or message.type not in (discord.MessageType.default, discord.MessageType.reply):
+                continue
+            if messages.lookup(message.id) is not None:
+                await ingest.put(IngestEvent.from_edit(message, role))
+                state.updated += 1
+            else:
+                await ingest.put(IngestEvent.from_message(message, period_id, role))
+                state.recorded += 1
+
+    @staticmethod
+    def _thread_week(thread: discord.Thread) -> tuple[CompassWeek, ThreadRole] | None:
+        """
+        Finds the week and role of an accountability thread from its name. The name
+        only contains the week number, so the year is the one where that week is
+        closest to the time the thread was created.
+        """
+        match = _THREAD_NAME.match(thread.name)
+        if match is None or thread.created_at is None:
+            return None
+        number = int(match.group(1))
+        role = ThreadRole.GOAL if match.group(2) == "Setting" else ThreadRole.RESULT
+
+        created = thread.created_at.date()
+        candidates = []
+        for year in (created.year - 1, created.year):
+            try:
+                candidates.append(weeks.week(year, number))
+            except ValueError:
+                pass
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda week: abs((created - week.start).days)), role
+
+    async def _recover_periods(self, first: CompassWeek, last: CompassWeek, state: BackfillProgress) -> None:
+        """Recreates missing periods and thread IDs from the threads in the accountability channel"""
+        channel = await self._app.bot.get_or_fetch_channel(self._app.config.accountability_channel_id)
+
+        found: dict[tuple[int, int], dict[ThreadRole, int]] = {}
+        def collect(thread: discord.Thread):
+            result = self._thread_week(thread)
+            if result is None:
+                return
+            week, role = result
+            if (first.year, first.week) <= (week.year, week.week) <= (last.year, last.week):
+                # if there are multiple threads for a week, the oldest one (lowest ID) is used
+                thread_ids = found.setdefault((week.year, week.week), {})
+                thread_ids[role] = min(thread_ids.get(role, thread.id), thread.id)
+
+        async for thread in channel.archived_threads(limit=None):
+            collect(thread)
+        for thread in channel.threads:
+            collect(thread)
+
+        changed: list[AccountabilityPeriod] = []
+        async with self._app.db.session() as session:
+            for (year, week), thread_ids in found.items():
+                period = (await session.exec(
+                    select(AccountabilityPeriod).where(
+                        AccountabilityPeriod.week == week,
+                        AccountabilityPeriod.year == year,
+                    )
+                )).one_or_none()
+                if period is None:
+                    period = AccountabilityPeriod.from_week(year, week)
+                    state.periods_created += 1
+                elif (
+                    (period.goal_channel_id is not None or ThreadRole.GOAL not in thread_ids)
+                    and (period.result_channel_id is not None or ThreadRole.RESULT not in thread_ids)
+                ):
+                    continue
+                # never replace threads that are known already
+                if period.goal_channel_id is None:
+                    period.goal_channel_id = thread_ids.get(ThreadRole.GOAL)
+                if period.result_channel_id is None:
+                    period.result_channel_id = thread_ids.get(ThreadRole.RESULT)
+                session.add(period)
+                changed.append(period)
+
+        if len(changed) > 0:
+            self._app.accountability.versions.periods_changed(period.id for period in changed)
+        for period in changed:
+            self._app.accountability.threads.add_period(period)
+            journal = self._app.accountability.journal
+            journal.append(PeriodEvent(PeriodEventKind.START, period.year, period.week, period.goal_channel_id))
+            if period.result_channel_id is not None:
+                journal.append(PeriodEvent(PeriodEventKind.END, period.year, period.week, period.result_channel_id))
+        if len(changed) > 0:
+            _log.info(f"Recovered threads of {len(changed)} accountability periods ({state.periods_created} new)")
@@ -19,10 +19,15 @@ from discord import ChannelType, app_commands
 from discord.ext import commands
 from el.async_tools import synchronize
 from el.errors import DuplicateError
-from sqlmodel import select, or_
+from sqlmodel import select
 
-from compass_app.database import CompassUser
-from .tables import AccountabilityPeriod, AccountabilityEntry, AccountabilityGoal, AccountabilityResult
+from compass_app import weeks, metrics
+from .tables import AccountabilityPeriod, AccountabilityEntry, AccountabilityGoal, AccountabilityResult, AccountabilityOutbox, OutboundKind
+from .index import ThreadRole
+from .ingest import IngestEvent
+from .stats import LeaderboardRow, UserStats
+from .backfill import BackfillProgress
+from .journal import PeriodEvent, PeriodEventKind
 
 if typing.TYPE_CHECKING:
     from compass_app.main import CompassApp
@@ -87,23 +92,39 @@ class AccountabilityCommands(
         # Thread creation might take a while
         await interaction.response.defer(ephemeral=True)
 
-        today = datetime.date.today()
+        # compass accountability uses US-style weeks starting on Sunday
+        current = weeks.current_week()
         if year is None:
-            year = today.year
+            year = current.year
         if week is None:
-            # compass accountability uses US-style week numbers
-            # (%U: weeks start on Sunday)
-            # TODO: this may break after 2025, maybe switch to ISO numbering after that?
-            week = int(today.strftime("%U"))
+            week = current.week
 
         try:
             thread = await self._app.accountability.start_period(week, year)
+        except ValueError:
+            await interaction.followup.send(
+                f"Week {week} of {year} doesn't exist.",
+                ephemeral=True
+            )
+            return
         except DuplicateError:
             await interaction.followup.send(
                 f"A goal setting thread for week {week} of {year} already exists, can't create another one.",
                 ephemeral=True
             )
             return
+        except (TimeoutError, discord.HTTPException) as e:
+            await interaction.followup.send(
+                f"The period for week {week} of {year} has been started, but the goal setting thread couldn't be created yet ({str(e) or 'discord is not responding'}). It will be retried in the background.",
+                ephemeral=True
+            )
+            return
+        if thread is None:
+            await interaction.followup.send(
+                f"The period for week {week} of {year} has been reset before its goal setting thread was created.",
+                ephemeral=True
+            )
+            return
         await interaction.followup.send(
             f"Goal setting thread has been created: {thread.jump_url}",
             ephemeral=True
@@ -129,14 +150,12 @@ class AccountabilityCommands(
         # Thread creation might take a while
         await interaction.response.defer(ephemeral=True)
 
-        today = datetime.date.today()
+        # by default the previous week is ended, which may be in the previous year
+        previous = weeks.week_of(datetime.date.today() - datetime.timedelta(days=7))
         if year is None:
-            year = today.year
+            year = previous.year
         if week is None:
-            # compass accountability uses US-style week numbers
-            # (%U: weeks start on Sunday)
-            # TODO: this may break after 2025, maybe switch to ISO numbering after that?
-            week = int(today.strftime("%U")) - 1
+            week = previous.week
 
         try:
             thread = await self._app.accountability.end_period(week, year)
@@ -152,7 +171,19 @@ class AccountabilityCommands(
                 ephemeral=True
             )
             return
-        
+        except (TimeoutError, discord.HTTPException) as e:
+            await interaction.followup.send(
+                f"The results thread for week {week} of {year} couldn't be created yet ({str(e) or 'discord is not responding'}). It will be retried in the background.",
+                ephemeral=True
+            )
+            return
+        if thread is None:
+            await interaction.followup.send(
+                f"The period for week {week} of {year} has been reset before its results thread was created.",
+                ephemeral=True
+            )
+            return
+
         await interaction.followup.send(
             f"Results thread has been created: {thread.jump_url}",
             ephemeral=True
@@ -196,44 +227,126 @@ class AccountabilityCommands(
                 )
                 return
 
+            # threads are deleted by the outbound queue once the reset is committed,
+            # including ones that were created but not attached to the period yet
+            deletions: list[AccountabilityOutbox] = []
             if delete_threads:
-                try:
-                    if period.goal_channel_id is not None:
-                        # delete thread itself
-                        ch = self._app.bot.get_channel(period.goal_channel_id)
-                        if ch is not None:
-                            await ch.delete()
-                        # delete starter message
-                        ach = self._app.bot.get_channel(self._app.config.accountability_channel_id)
-                        if ach is not None:
-                            msg = await ach.fetch_message(period.goal_channel_id) # has same ID as thread
-                            if msg is not None:
-                                await msg.delete()
-                    if period.result_channel_id is not None:
-                        ch = self._app.bot.get_channel(period.result_channel_id)
-                        if ch is not None:
-                            await ch.delete()
-                        # delete starter message
-                        ach = self._app.bot.get_channel(self._app.config.accountability_channel_id)
-                        if ach is not None:
-                            msg = await ach.fetch_message(period.result_channel_id) # has same ID as thread
-                            if msg is not None:
-                                await msg.delete()
-
-                except discord.errors.Forbidden as e:
-                    await interaction.followup.send(
-                        f"Failed to delete threads: {e}",
-                        ephemeral=True
+                pending_thread_ids = (await session.exec(
+                    select(AccountabilityOutbox.channel_id).where(
+                        AccountabilityOutbox.period_id == period.id,
+                        AccountabilityOutbox.channel_id.is_not(None),
                     )
-                    return
+                )).all()
+                for thread_id in (period.goal_channel_id, period.result_channel_id, *pending_thread_ids):
+                    if thread_id is not None:
+                        deletions.append(AccountabilityOutbox(kind=OutboundKind.DELETE_THREAD, channel_id=thread_id))
+                session.add_all(deletions)
+
+            # collect the recorded messages that are deleted along with the period
+            goal_message_ids = (await session.exec(
+                select(AccountabilityGoal.message_id)
+                .join(AccountabilityEntry, AccountabilityEntry.goal_id == AccountabilityGoal.id)
+                .where(AccountabilityEntry.period_id == period.id)
+            )).all()
+            result_message_ids = (await session.exec(
+                select(AccountabilityResult.message_id)
+                .join(AccountabilityEntry, AccountabilityEntry.result_id == AccountabilityResult.id)
+                .where(AccountabilityEntry.period_id == period.id)
+            )).all()
 
             await session.delete(period)
+            # the scores of the period are deleted with it, so the totals need updating
+            await session.flush()
+            await self._app.accountability.scoring.recompute_all(session)
+
+        self._app.accountability.scoring.notify(None)
+        # stop routing messages of the deleted period
+        self._app.accountability.threads.remove_period(period)
+        self._app.accountability.versions.periods_changed([period.id])
+        self._app.accountability.versions.entries_changed(())
+        self._app.accountability.journal.append(PeriodEvent(PeriodEventKind.RESET, year, week))
+        for message_id in goal_message_ids:
+            self._app.accountability.messages.discard(ThreadRole.GOAL, message_id)
+        for message_id in result_message_ids:
+            self._app.accountability.messages.discard(ThreadRole.RESULT, message_id)
+
+        outbound = self._app.accountability.outbound
+        try:
+            await asyncio.gather(*(
+                outbound.wait(outbound.submit(action.id)) for action in deletions
+            ))
+        except (TimeoutError, discord.HTTPException) as e:
+            await interaction.followup.send(
+                f"Accountability for week {week} of year {year} has been reset, but the threads couldn't be deleted yet ({str(e) or 'discord is not responding'}). It will be retried in the background.",
+                ephemeral=True
+            )
+            return
 
         await interaction.followup.send(
             f"Accountability for week {week} of year {year} has been reset{", threads have been deleted." if delete_threads else "."}",
             ephemeral=True
         )
 
+    @accountability.command()
+    async def backfill(
+        self, 
+        interaction: discord.Interaction,
+        from_week: int,
+        from_year: int,
+        to_week: int | None = None,
+        to_year: int | None = None,
+    ):
+        """
+        Rebuilds recorded accountability of a range of weeks from the discord threads.
+
+        Parameters
+        ----------
+        from_week : int
+            First calendar week to rebuild
+        from_year : int
+            Year of the first week
+        to_week : int | None, optional
+            Last calendar week to rebuild, by default only the first week
+        to_year : int | None, optional
+            Year of the last week, by default the year of the first week
+        """
+        try:
+            first = weeks.week(from_year, from_week)
+            last = weeks.week(
+                to_year if to_year is not None else from_year,
+                to_week if to_week is not None else from_week,
+            )
+        except ValueError as e:
+            await interaction.response.send_message(f"Invalid week: {e}", ephemeral=True)
+            return
+
+        if self._app.accountability.backfill.running:
+            await interaction.response.send_message("A backfill is already running.", ephemeral=True)
+            return
+
+        # Reading the threads might take a while
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
+        # progress is shown by editing the response, but not more often than every few seconds
+        last_update = 0.0
+        async def progress(state: BackfillProgress):
+            nonlocal last_update
+            now = asyncio.get_running_loop().time()
+            if now - last_update < 3:
+                return
+            last_update = now
+            try:
+                await interaction.edit_original_response(content=f"Backfilling from {first} to {last}: {state}")
+            except discord.HTTPException:
+                pass
+
+        try:
+            state = await self._app.accountability.backfill.rebuild(first, last, progress)
+        except RuntimeError as e:
+            await interaction.edit_original_response(content=f"Backfill failed: {e}")
+            return
+        await interaction.edit_original_response(content=f"Backfill from {first} to {last} finished: {state}")
+
     @accountability.command()
     async def automation(
         self, 
@@ -261,13 +374,117 @@ class AccountabilityCommands(
         if time is not None:
             self._app.settings.accountability_period_time = time
 
-        self._app.settings.model_save_to_disk()
+        # written in the background, the scheduler picks up the change right away
+        self._app.settings_store.save([
+            "accountability_period_automation",
+            "accountability_period_weekday",
+            "accountability_period_time",
+        ])
 
         await interaction.response.send_message(
             f"Automatic accountability period creation at {self._app.settings.accountability_period_time.strftime("%H:%M")} every {Weekday(self._app.settings.accountability_period_weekday).name} is {"enabled :green_square:" if self._app.settings.accountability_period_automation else "disabled :red_square:"}.",
             ephemeral=True,
         )
 
+    @accountability.command()
+    async def leaderboard(
+        self, 
+        interaction: discord.Interaction,
+        week: int | None = None,
+        year: int | None = None,
+        limit: app_commands.Range[int, 1, 25] = 10,
+    ):
+        """
+        Shows the members with the most accountability points.
+
+        Parameters
+        ----------
+        week : int | None, optional
+            Calendar week to show the leaderboard of, by default all time
+        year : int | None, optional
+            Year of the week, by default the current year
+        limit : int, optional
+            Number of members to show, by default 10
+        """
+        if week is None:
+            key = ("leaderboard", limit)
+            title = "Accountability Leaderboard"
+            query = lambda: self._app.accountability.stats.leaderboard(limit)
+        else:
+            if year is None:
+                year = weeks.current_week().year
+            key = ("leaderboard", limit, year, week)
+            title = f"Accountability Leaderboard for week {week} of {year}"
+            query = lambda: self._app.accountability.stats.period_leaderboard(week, year, limit)
+
+        async def build():
+            return self._leaderboard_embed(title, await query()), None
+
+        try:
+            embed = await self._app.accountability.stats.cache.get(key, build)
+        except IndexError:
+            await interaction.response.send_message(
+                f"No accountability period exists for week {week} of {year}.",
+                ephemeral=True
+            )
+            return
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @accountability.command()
+    async def me(
+        self, 
+        interaction: discord.Interaction,
+    ):
+        """
+        Shows your accountability points, streaks and recent check-ins.
+        """
+        async def build():
+            stats = await self._app.accountability.stats.user_stats(interaction.user.id)
+            if stats is None:
+                # not scored yet, so this is dropped with any score change
+                return None, None
+            return self._user_embed(stats), stats.user_id
+
+        embed = await self._app.accountability.stats.cache.get(("me", interaction.user.id), build)
+        if embed is None:
+            await interaction.response.send_message(
+                "You haven't checked in with any accountability results yet.",
+                ephemeral=True
+            )
+            return
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @staticmethod
+    def _leaderboard_embed(title: str, rows: list[LeaderboardRow]) -> discord.Embed:
+        embed = discord.Embed(title=title)
+        if len(rows) == 0:
+            embed.description = "Nobody has checked in yet."
+            return embed
+        embed.description = "\n".join(
+            f"**{row.rank}.** {discord.utils.escape_markdown(row.username)}: {row.points} points "
+            f"(✅ {row.success_count} ❌ {row.fail_count}, 🔥 {row.streak})"
+            for row in rows
+        )
+        return embed
+
+    @staticmethod
+    def _user_embed(stats: UserStats) -> discord.Embed:
+        embed = discord.Embed(title=f"Accountability of {stats.username}")
+        embed.add_field(name="Points", value=f"{stats.total_points} (rank {stats.rank})")
+        embed.add_field(name="Completion", value=f"{stats.ratio:.0%} (✅ {stats.success_count} ❌ {stats.fail_count})")
+        embed.add_field(name="Check-ins", value=str(stats.periods))
+        embed.add_field(name="Current streak", value=f"🔥 {stats.current_streak}")
+        embed.add_field(name="Best streak", value=f"🔥 {stats.best_streak}")
+        embed.add_field(
+            name="Recent check-ins",
+            value="\n".join(
+                f"Week {period.week} of {period.year}: ✅ {period.success_count} ❌ {period.fail_count}"
+                for period in stats.history
+            ),
+            inline=False,
+        )
+        return embed
+
     def _is_relevante_message(self, message: discord.Message) -> bool:
         """Checks whether `message` is relevant for accountability"""
         if message.author == self._app.bot.user:
@@ -282,130 +499,78 @@ class AccountabilityCommands(
 
         return True
 
+    async def _catch_up(self) -> None:
+        await self._app.accountability.threads.wait_warm()
+        try:
+            await self._app.accountability.backfill.catch_up()
+        except Exception as e:
+            _log.warning(f"Failed to catch up on missed accountability messages: {e}", exc_info=e)
+
     @commands.Cog.listener()
+    @metrics.timed(metrics.LISTENER_SECONDS.labels("on_ready"))
+    async def on_ready(self):
+        # messages may have been posted while the bot was offline
+        await self._catch_up()
+
+    @commands.Cog.listener()
+    @metrics.timed(metrics.LISTENER_SECONDS.labels("on_resumed"))
+    async def on_resumed(self):
+        # events missed during the disconnect are replayed by discord on resume,
+        # but only if the session could be resumed in time
+        await self._catch_up()
+
+    @commands.Cog.listener()
+    @metrics.timed(metrics.LISTENER_SECONDS.labels("on_message"))
     async def on_message(self, message: discord.Message):
         # some pre-filtering to avoid frequent database queries
         if not self._is_relevante_message(message):
             return
 
-        async with self._app.db.session() as session:
-            # get the accountability period this message belongs to
-            period = (await session.exec(
-                select(AccountabilityPeriod).where(or_(
-                    AccountabilityPeriod.goal_channel_id == message.channel.id,
-                    AccountabilityPeriod.result_channel_id == message.channel.id
-                ))
-            )).one_or_none()
-
-            if period is None:
-                # message not associated with any accountability thread -> ignore it
-                return
-            
-            # get the user and entry associated with the message
-            user = await CompassUser.get_or_create_from_discord(session, message.author)
-            entry = await AccountabilityEntry.get_or_create(session, period, user)
-            
-            _log.info(f"Received accountability message in '{message.channel}' from '{message.author}' ({user}): '{message.content}'")
-
-            # goal setting message
-            if period.goal_channel_id == message.channel.id:
-                # If the user posts a second message here, we ignore it
-                goal: AccountabilityGoal | None = await entry.awaitable_attrs.goal
-                if goal is not None:
-                    _log.warning(f"Duplicate accountability goal for {user.username} in period {period}, ignoring")
-                    return
-                
-                # otherwise save the goal
-                entry.goal = AccountabilityGoal(
-                    message_id=message.id,
-                    text=message.content,
-                )
-                session.add(entry)
-                return
+        # find the period this message belongs to in the thread index
+        threads = self._app.accountability.threads
+        await threads.wait_warm()
+        route = threads.lookup(message.channel.id)
+        if route is None:
+            # message not associated with any accountability thread -> ignore it
+            return
+        period_id, role = route
 
-            # result message
-            else:
-                # If the user posts a second message here, we ignore it
-                result: AccountabilityResult | None = await entry.awaitable_attrs.result
-                if result is not None:
-                    _log.warning(f"Duplicate accountability result for {user.username} in period {period}, ignoring")
-                    return
-                
-                # otherwise save the result
-                entry.result = AccountabilityResult(
-                    message_id=message.id,
-                    text=message.content,
-                )
-                entry.result.update_count()
-                session.add(entry)
-                return
+        # the message is recorded in the background
+        await self._app.accountability.ingest.put(
+            IngestEvent.from_message(message, period_id, role)
+        )
 
     @commands.Cog.listener()
+    @metrics.timed(metrics.LISTENER_SECONDS.labels("on_raw_message_edit"))
     #async def on_message_edit(self, old: discord.Message, new: discord.Message):
     # we use raw message edit to also detect old messages being edited that are not in our local cache
     async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
-        new = payload.message
-        # some pre-filtering to avoid frequent database queries
-        if not self._is_relevante_message(new):
+        # only recorded goals and results are of interest, this drops
+        # almost all events without touching the database
+        await self._app.accountability.threads.wait_warm()
+        role = self._app.accountability.messages.lookup(payload.message_id)
+        if role is None:
             return
-        
-        async with self._app.db.session() as session:
-            # find the message if it is a recorded goal
-            goal = (await session.exec(
-                select(AccountabilityGoal).where(
-                    AccountabilityGoal.message_id == new.id
-                )
-            )).one_or_none()
 
-            if goal is not None:
-                _log.info(f"Accountability goal of {new.author.name} updated.")
-                goal.text = new.content
-                session.add(goal)
-                return
-                
-            # or if it is a recorded result
-            result = (await session.exec(
-                select(AccountabilityResult).where(
-                    AccountabilityResult.message_id == new.id
-                )
-            )).one_or_none()
+        if not self._is_relevante_message(payload.message):
+            return
 
-            if result is not None:
-                _log.info(f"Accountability result of {new.author.name} updated.")
-                result.text = new.content   # This may cause a problem according to docs, but we haven't yet observed any issues
-                result.update_count()
-                session.add(result)
-                return
+        await self._app.accountability.ingest.put(
+            IngestEvent.from_edit(payload.message, role)
+        )
 
     @commands.Cog.listener()
+    @metrics.timed(metrics.LISTENER_SECONDS.labels("on_raw_message_delete"))
     #async def on_message_delete(self, old: discord.Message):
     # we use raw message delete to also detect old messages being deleted that are not in our local cache
     async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
-        # some pre-filtering to avoid frequent database queries
-        if payload.cached_message is not None and not self._is_relevante_message(payload.cached_message):
+        # only recorded goals and results are of interest, this drops
+        # almost all events without touching the database
+        await self._app.accountability.threads.wait_warm()
+        role = self._app.accountability.messages.lookup(payload.message_id)
+        if role is None:
             return
-        
-        async with self._app.db.session() as session:
-            # find the message if it is a recorded goal
-            goal = (await session.exec(
-                select(AccountabilityGoal).where(
-                    AccountabilityGoal.message_id == payload.message_id
-                )
-            )).one_or_none()
 
-            if goal is not None:
-                _log.info(f"Accountability goal (message {payload.message_id}) deleted.")
-                await session.delete(goal)
-                return
-                
-            # or if it is a recorded result
-            result = (await session.exec(
-                select(AccountabilityResult).where(
-                    AccountabilityResult.message_id == payload.message_id
-                )
-            )).one_or_none()
-
-            if result is not None:
-                _log.info(f"Accountability result (message {payload.message_id}) deleted.")
-                await session.delete(result)
-                return
+        await self._app.accountability.ingest.put(
+            IngestEvent.from_delete(payload.message_id, payload.channel_id, role)
+        )
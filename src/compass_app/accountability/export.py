@@ -0,0 +1,281 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+19.10.26, 06:00
+
+Streaming export of the full accountability history.
+
+The history is read through a server-side cursor in chunks of
+`accountability_export_chunk_size` rows and every chunk is encoded and
+handed out before the next one is fetched, so memory use doesn't depend
+on the amount of exported data. All chunks are read in one transaction,
+so the export is a consistent snapshot even while messages are recorded.
+The snapshot blocks WAL checkpoints, so an export is aborted after
+`accountability_export_timeout` seconds and downloads are sent from a
+temporary file instead of holding the snapshot while the client reads.
+"""
+
+import io
+import os
+import csv
+import json
+import time
+import typing
+import tempfile
+import asyncio
+import logging
+from pathlib import Path
+from datetime import date, datetime
+
+from sqlmodel import select
+
+from compass_app.database import CompassUser
+from .tables import AccountabilityPeriod, AccountabilityEntry, AccountabilityGoal, AccountabilityResult
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+# one row per entry, periods without entries have a row with empty entry columns
+COLUMNS = (
+    ("period_id", AccountabilityPeriod.id),
+    ("year", AccountabilityPeriod.year),
+    ("week", AccountabilityPeriod.week),
+    ("period_start", AccountabilityPeriod.period_start),
+    ("period_end", AccountabilityPeriod.period_end),
+    ("goal_thread_id", AccountabilityPeriod.goal_channel_id),
+    ("result_thread_id", AccountabilityPeriod.result_channel_id),
+    ("user_id", CompassUser.id),
+    ("discord_id", CompassUser.discord_id),
+    ("username", CompassUser.username),
+    ("goal_message_id", AccountabilityGoal.message_id),
+    ("goal_text", AccountabilityGoal.text),
+    ("goal_date_created", AccountabilityGoal.date_created),
+    ("result_message_id", AccountabilityResult.message_id),
+    ("result_text", AccountabilityResult.text),
+    ("success_count", AccountabilityResult.success_count),
+    ("fail_count", AccountabilityResult.fail_count),
+    ("result_date_created", AccountabilityResult.date_created),
+)
+COLUMN_NAMES = tuple(name for name, _ in COLUMNS)
+
+# file extension and content type of every format
+FORMATS = {
+    "ndjson": ("ndjson", "application/x-ndjson"),
+    "csv": ("csv", "text/csv; charset=utf-8"),
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+
+Row = typing.Sequence[typing.Any]
+
+
+def _json_value(value: typing.Any) -> typing.Any:
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+class _NDJSONEncoder:
+    def header(self) -> bytes:
+        return b""
+
+    def encode(self, rows: list[Row]) -> bytes:
+        return "".join(
+            json.dumps(dict(zip(COLUMN_NAMES, map(_json_value, row))), ensure_ascii=False) + "\n"
+            for row in rows
+        ).encode()
+
+    def finish(self) -> bytes:
+        return b""
+
+
+class _CSVEncoder:
+    def __init__(self) -> None:
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+
+    def _take(self) -> bytes:
+        data = self._buffer.getvalue().encode()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+    def header(self) -> bytes:
+        self._writer.writerow(COLUMN_NAMES)
+        return self._take()
+
+    def encode(self, rows: list[Row]) -> bytes:
+        self._writer.writerows(rows)
+        return self._take()
+
+    def finish(self) -> bytes:
+        return b""
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that collects the written bytes until they are taken"""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class _ParquetEncoder:
+    """Writes every chunk as a row group, so only one chunk is held in memory"""
+
+    def __init__(self) -> None:
+        self._schema = pyarrow.schema([
+            ("period_id", pyarrow.int64()),
+            ("year", pyarrow.int32()),
+            ("week", pyarrow.int32()),
+            ("period_start", pyarrow.date32()),
+            ("period_end", pyarrow.date32()),
+            ("goal_thread_id", pyarrow.int64()),
+            ("result_thread_id", pyarrow.int64()),
+            ("user_id", pyarrow.int64()),
+            ("discord_id", pyarrow.int64()),
+            ("username", pyarrow.string()),
+            ("goal_message_id", pyarrow.int64()),
+            ("goal_text", pyarrow.string()),
+            ("goal_date_created", pyarrow.timestamp("us", tz="UTC")),
+            ("result_message_id", pyarrow.int64()),
+            ("result_text", pyarrow.string()),
+            ("success_count", pyarrow.int32()),
+            ("fail_count", pyarrow.int32()),
+            ("result_date_created", pyarrow.timestamp("us", tz="UTC")),
+        ])
+        self._sink = _ChunkSink()
+        self._writer = pyarrow.parquet.ParquetWriter(self._sink, self._schema, compression="zstd")
+
+    def header(self) -> bytes:
+        return self._sink.take()
+
+    def encode(self, rows: list[Row]) -> bytes:
+        columns = list(zip(*rows))
+        self._writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, self._schema)],
+            schema=self._schema,
+        ))
+        return self._sink.take()
+
+    def finish(self) -> bytes:
+        self._writer.close()
+        return self._sink.take()
+
+
+class AccountabilityExport:
+    """
+    Exports all accountability periods with their entries, goals and
+    results as NDJSON, CSV or Parquet (if pyarrow is installed).
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+
+    @staticmethod
+    def available_formats() -> list[str]:
+        return [f for f in FORMATS if f != "parquet" or pyarrow is not None]
+
+    @staticmethod
+    def file_name(format: str) -> str:
+        return f"accountability-{datetime.now():%Y%m%d-%H%M%S}.{FORMATS[format][0]}"
+
+    async def stream(self, format: str) -> typing.AsyncIterator[bytes]:
+        """
+        Yields the encoded export in chunks.
+
+        Raises
+        ------
+        ValueError
+            The format is unknown or its dependencies aren't installed
+        TimeoutError
+            The export took longer than `accountability_export_timeout`
+        """
+        if format not in self.available_formats():
+            raise ValueError(f"Unsupported export format {format}, available: {', '.join(self.available_formats())}")
+        encoder = {
+            "ndjson": _NDJSONEncoder,
+            "csv": _CSVEncoder,
+            "parquet": _ParquetEncoder,
+        }[format]()
+        chunk_size = self._app.settings.accountability_export_chunk_size
+        timeout = self._app.settings.accountability_export_timeout
+
+        stmt = (
+            select(*(column for _, column in COLUMNS))
+            .select_from(AccountabilityPeriod)
+            .outerjoin(AccountabilityEntry, AccountabilityEntry.period_id == AccountabilityPeriod.id)
+            .outerjoin(CompassUser, CompassUser.id == AccountabilityEntry.user_id)
+            .outerjoin(AccountabilityGoal, AccountabilityGoal.id == AccountabilityEntry.goal_id)
+            .outerjoin(AccountabilityResult, AccountabilityResult.id == AccountabilityEntry.result_id)
+            .order_by(AccountabilityPeriod.year, AccountabilityPeriod.week, AccountabilityEntry.id)
+            .execution_options(yield_per=chunk_size)
+        )
+        yield encoder.header()
+        rows = 0
+        async with self._app.db.read_session() as session:
+            deadline = time.monotonic() + timeout
+            result = await session.stream(stmt)
+            async for partition in result.partitions(chunk_size):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Export took longer than {timeout:.0f}s and was aborted after {rows} rows")
+                rows += len(partition)
+                # parquet encodes in native code that releases the GIL
+                if format == "parquet":
+                    yield await asyncio.to_thread(encoder.encode, partition)
+                else:
+                    yield encoder.encode(partition)
+        yield encoder.finish()
+        _log.info(f"Exported {rows} accountability rows as {format}")
+
+    async def to_file(self, format: str, path: Path) -> int:
+        """Writes the export to a file, returns the number of written bytes"""
+        if format not in self.available_formats():
+            raise ValueError(f"Unsupported export format {format}, available: {', '.join(self.available_formats())}")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        written = 0
+        with await asyncio.to_thread(open, path, "wb") as file:
+            async for chunk in self.stream(format):
+                written += len(chunk)
+                await asyncio.to_thread(file.write, chunk)
+        return written
+
+    async def spool(self, format: str) -> Path:
+        """
+        Writes the export to a temporary file, which the caller has to remove.
+        Downloads are sent from this file, so slow clients don't keep a
+        connection of the read pool and its snapshot for the whole transfer.
+        """
+        fd, name = tempfile.mkstemp(prefix="accountability-", suffix=f".{FORMATS[format][0]}")
+        os.close(fd)
+        path = Path(name)
+        try:
+            await self.to_file(format, path)
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+        return path
@@ -0,0 +1,470 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+19.10.26, 07:00
+
+Bulk import of accountability data from NDJSON or CSV files, e.g. the
+spreadsheets from before the bot or an export (see export.py).
+
+The file is read as a stream in chunks of `accountability_import_batch_size`
+rows. Every chunk is written in one transaction with multi-row inserts,
+and periods and users are resolved through in-memory maps instead of
+a query per row. The progress is stored in the same transaction, so an
+interrupted import continues after the last committed chunk. Scores are
+updated once when the import is finished.
+"""
+
+import csv
+import json
+import typing
+import asyncio
+import logging
+import itertools
+import dataclasses
+from pathlib import Path
+from datetime import datetime, timezone
+
+import pydantic
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import update, func
+from sqlalchemy.dialects.sqlite import insert
+
+from compass_app import weeks
+from compass_app.database import CompassUser
+from .tables import (
+    AccountabilityPeriod,
+    AccountabilityEntry,
+    AccountabilityGoal,
+    AccountabilityResult,
+    AccountabilityImportProgress,
+)
+from .index import ThreadRole
+from .scoring import ScoringEngine
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+class ImportRow(pydantic.BaseModel):
+    """
+    A row of an import file. The columns are the ones of the export, only
+    year and week are required. Rows without a discord ID only create the
+    period, the success and fail counts are always recomputed from the text.
+    """
+    model_config = {
+        "extra": "ignore",
+    }
+
+    year: int
+    week: int
+    goal_thread_id: int | None = None
+    result_thread_id: int | None = None
+    discord_id: int | None = None
+    username: str | None = None
+    # imported goals and results without a discord message have the message ID 0
+    goal_message_id: int | None = None
+    goal_text: str | None = None
+    goal_date_created: datetime | None = None
+    result_message_id: int | None = None
+    result_text: str | None = None
+    result_date_created: datetime | None = None
+
+    @pydantic.model_validator(mode="after")
+    def _check(self) -> "ImportRow":
+        weeks.week(self.year, self.week)
+        if self.discord_id is None and (self.goal_text is not None or self.result_text is not None):
+            raise ValueError("Goals and results need a discord_id")
+        return self
+
+
+@dataclasses.dataclass
+class ImportStats:
+    path: Path
+    rows_done: int
+    rows_imported: int
+    rows_skipped: int
+    resumed: bool
+
+    def __str__(self) -> str:
+        return (
+            f"{self.rows_done} rows read, {self.rows_imported} imported, {self.rows_skipped} skipped"
+            f"{' (resumed)' if self.resumed else ''}"
+        )
+
+
+ImportProgressCallback = typing.Callable[[ImportStats], typing.Awaitable[None]]
+
+
+def _read_rows(path: Path, format: str, skip: int) -> typing.Iterator[dict | ValueError]:
+    """Yields the raw rows of a file after the first `skip` ones, or the error of unreadable rows"""
+    with open(path, newline="" if format == "csv" else None, encoding="utf-8") as file:
+        if format == "csv":
+            # empty cells are missing values
+            rows = (
+                {key: value for key, value in row.items() if value != ""}
+                for row in csv.DictReader(file)
+            )
+        else:
+            rows = (_parse_json(line) for line in file if line.strip() != "")
+        yield from itertools.islice(rows, skip, None)
+
+
+def _parse_json(line: str) -> dict | ValueError:
+    try:
+        row = json.loads(line)
+    except ValueError as e:
+        return e
+    return row if isinstance(row, dict) else ValueError("Row is not an object")
+
+
+class AccountabilityImporter:
+    """
+    Imports accountability data into the database. Entries that exist
+    already are kept (like for messages, the first goal or result wins),
+    so importing the same data twice doesn't duplicate anything.
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        # IDs of all periods by year and week and of all users by discord ID
+        self._periods: dict[tuple[int, int], AccountabilityPeriod] = {}
+        self._users: dict[int, int] = {}
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def import_file(
+        self,
+        path: Path,
+        format: str | None = None,
+        progress: ImportProgressCallback | None = None,
+    ) -> ImportStats:
+        """
+        Imports a file, continuing a previous import of it if that was
+        interrupted.
+
+        Parameters
+        ----------
+        path : Path
+            NDJSON or CSV file
+        format : str | None, optional
+            "ndjson" or "csv", by default from the file extension
+        progress : ImportProgressCallback | None, optional
+            called after every committed chunk
+
+        Raises
+        ------
+        ValueError
+            The format is not supported
+        RuntimeError
+            Another import is running
+        """
+        path = path.resolve()
+        format = format or path.suffix.lstrip(".").lower()
+        if format not in ("ndjson", "csv"):
+            raise ValueError(f"Unsupported import format {format}, available: ndjson, csv")
+        if self.running:
+            raise RuntimeError("Another import is running")
+
+        async with self._lock:
+            stat = await asyncio.to_thread(path.stat)
+            state, resumed = await self._start(path, stat.st_size, stat.st_mtime_ns)
+            stats = ImportStats(path, state.rows_done, state.rows_imported, state.rows_skipped, resumed)
+            await self._load_maps()
+            known_periods = len(self._periods)
+
+            batch_size = self._app.settings.accountability_import_batch_size
+            # scores are computed once at the end, recomputing them for every
+            # chunk would read the growing history of the users over and over
+            scored_users: set[int] = set()
+            reader = _read_rows(path, format, state.rows_done)
+            try:
+                while True:
+                    raw = await asyncio.to_thread(lambda: list(itertools.islice(reader, batch_size)))
+                    if len(raw) == 0:
+                        break
+                    rows = self._validate(raw, stats.rows_done)
+                    scored_users |= await self._write(state.id, rows, len(raw))
+                    stats.rows_done += len(raw)
+                    stats.rows_imported += len(rows)
+                    stats.rows_skipped += len(raw) - len(rows)
+                    if progress is not None:
+                        await progress(stats)
+            finally:
+                await asyncio.to_thread(reader.close)
+
+            # the users of the chunks before an interruption are unknown, and streaks
+            # are numbered over all periods, so new periods change the scores of everyone
+            rescore_all = resumed or len(self._periods) > known_periods
+            async with self._app.db.session() as session:
+                if rescore_all:
+                    await ScoringEngine.recompute_all(session)
+                else:
+                    await ScoringEngine.update_users(session, scored_users)
+                await session.execute(
+                    update(AccountabilityImportProgress)
+                    .where(AccountabilityImportProgress.id == state.id)
+                    .values(finished=True)
+                )
+            self._app.accountability.scoring.notify(None if rescore_all else scored_users)
+            _log.info(f"Imported {path}: {stats}")
+            return stats
+
+    async def _start(self, path: Path, size: int, mtime_ns: int) -> tuple[AccountabilityImportProgress, bool]:
+        """
+        Returns the progress of an interrupted import of the same file or starts
+        a new one. Finished imports are started again, e.g. to restore a reset
+        period, which is safe as existing entries are kept.
+        """
+        async with self._app.db.session() as session:
+            state = (await session.exec(
+                select(AccountabilityImportProgress)
+                .where(
+                    AccountabilityImportProgress.source == str(path),
+                    AccountabilityImportProgress.size == size,
+                    AccountabilityImportProgress.mtime_ns == mtime_ns,
+                    AccountabilityImportProgress.finished.is_(False),
+                )
+                .order_by(AccountabilityImportProgress.id.desc())
+                .limit(1)
+            )).one_or_none()
+            if state is not None:
+                return state, state.rows_done > 0
+            state = AccountabilityImportProgress(source=str(path), size=size, mtime_ns=mtime_ns)
+            session.add(state)
+        return state, False
+
+    async def _load_maps(self) -> None:
+        async with self._app.db.read_session() as session:
+            periods = (await session.exec(select(AccountabilityPeriod))).all()
+            users = (await session.exec(select(CompassUser.discord_id, CompassUser.id))).all()
+        self._periods = {(period.year, period.week): period for period in periods}
+        self._users = dict(users)
+
+    @staticmethod
+    def _validate(raw: list[dict | ValueError], first_row: int) -> list[ImportRow]:
+        rows = []
+        for number, row in enumerate(raw, start=first_row + 1):
+            try:
+                if isinstance(row, ValueError):
+                    raise row
+                rows.append(ImportRow.model_validate(row))
+            except ValueError as e:
+                # pydantic's ValidationError is a ValueError as well
+                _log.warning(f"Skipping invalid import row {number}: {e}")
+        return rows
+
+    async def _write(self, state_id: int, rows: list[ImportRow], rows_read: int) -> set[int]:
+        """
+        Writes a chunk of rows and the progress in one transaction,
+        returns the IDs of the users with new results
+        """
+        async with self._app.db.session() as session:
+            # writing the progress first takes the database's write lock,
+            # so the IDs allocated below can't be taken by anyone else
+            await session.execute(
+                update(AccountabilityImportProgress)
+                .where(AccountabilityImportProgress.id == state_id)
+                .values(
+                    rows_done=AccountabilityImportProgress.rows_done + rows_read,
+                    rows_imported=AccountabilityImportProgress.rows_imported + len(rows),
+                    rows_skipped=AccountabilityImportProgress.rows_skipped + rows_read - len(rows),
+                )
+            )
+            changed_periods = await self._write_periods(session, rows)
+            await self._write_users(session, rows)
+            changed_entries, scored_users, messages = await self._write_entries(session, rows)
+
+        # the in-memory state is only updated once everything is committed
+        accountability = self._app.accountability
+        for period in changed_periods:
+            accountability.threads.add_period(period)
+        for role, message_ids in messages.items():
+            accountability.messages.update(role, message_ids)
+        if len(changed_periods) > 0:
+            accountability.versions.periods_changed(period.id for period in changed_periods)
+        if len(changed_entries) > 0:
+            accountability.versions.entries_changed(changed_entries)
+        return scored_users
+
+    async def _write_periods(self, session: AsyncSession, rows: list[ImportRow]) -> list[AccountabilityPeriod]:
+        """Creates missing periods and adds missing threads, returns the changed periods"""
+        new: dict[tuple[int, int], AccountabilityPeriod] = {}
+        changed: dict[tuple[int, int], AccountabilityPeriod] = {}
+        for row in rows:
+            key = (row.year, row.week)
+            period = self._periods.get(key) or new.get(key)
+            if period is None:
+                period = new[key] = AccountabilityPeriod.from_week(row.year, row.week)
+            elif key not in new and (
+                (period.goal_channel_id is None and row.goal_thread_id is not None)
+                or (period.result_channel_id is None and row.result_thread_id is not None)
+            ):
+                changed[key] = period
+            # threads that are known already are never replaced
+            if period.goal_channel_id is None:
+                period.goal_channel_id = row.goal_thread_id
+            if period.result_channel_id is None:
+                period.result_channel_id = row.result_thread_id
+
+        if len(new) > 0:
+            created = await session.execute(
+                insert(AccountabilityPeriod)
+                .values([
+                    {
+                        "year": period.year,
+                        "week": period.week,
+                        "period_start": period.period_start,
+                        "period_end": period.period_end,
+                        "goal_channel_id": period.goal_channel_id,
+                        "result_channel_id": period.result_channel_id,
+                    }
+                    for period in new.values()
+                ])
+                .returning(AccountabilityPeriod.id, AccountabilityPeriod.year, AccountabilityPeriod.week)
+            )
+            # the order of returned rows is not guaranteed, so they are matched by week
+            for period_id, year, week in created:
+                new[(year, week)].id = period_id
+        for period in changed.values():
+            await session.execute(
+                update(AccountabilityPeriod)
+                .where(AccountabilityPeriod.id == period.id)
+                .values(goal_channel_id=period.goal_channel_id, result_channel_id=period.result_channel_id)
+            )
+        # the map is updated right away, a failed import reloads it when it is started again
+        self._periods.update(new)
+        return [*new.values(), *changed.values()]
+
+    async def _write_users(self, session: AsyncSession, rows: list[ImportRow]) -> None:
+        """Creates the users that are not known yet"""
+        missing: dict[int, str] = {}
+        for row in rows:
+            if row.discord_id is not None and row.discord_id not in self._users:
+                missing.setdefault(row.discord_id, row.username or str(row.discord_id))
+        if len(missing) == 0:
+            return
+        stmt = insert(CompassUser).values([
+            {"discord_id": discord_id, "username": username}
+            for discord_id, username in missing.items()
+        ])
+        # users created in the meantime are returned as well
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CompassUser.discord_id],
+            set_={"username": CompassUser.username},
+        ).returning(CompassUser.discord_id, CompassUser.id)
+        self._users.update((await session.execute(stmt)).all())
+
+    async def _write_entries(
+        self,
+        session: AsyncSession,
+        rows: list[ImportRow],
+    ) -> tuple[set[int], set[int], dict[ThreadRole, list[int]]]:
+        """
+        Inserts the goals, results and entries of the rows.
+
+        Returns
+        -------
+        tuple[set[int], set[int], dict[ThreadRole, list[int]]]
+            IDs of the periods with changed entries, IDs of the users with new
+            results and the discord message IDs of the new goals and results
+        """
+        # the first row of a user in a period wins, like for messages
+        wanted: dict[tuple[int, int], ImportRow] = {}
+        for row in rows:
+            if row.discord_id is None:
+                continue
+            key = (self._users[row.discord_id], self._periods[(row.year, row.week)].id)
+            wanted.setdefault(key, row)
+        if len(wanted) == 0:
+            return set(), set(), {}
+
+        existing = {
+            (user_id, period_id): (entry_id, goal_id, result_id)
+            for entry_id, user_id, period_id, goal_id, result_id in (await session.execute(
+                select(
+                    AccountabilityEntry.id,
+                    AccountabilityEntry.user_id,
+                    AccountabilityEntry.period_id,
+                    AccountabilityEntry.goal_id,
+                    AccountabilityEntry.result_id,
+                ).where(
+                    AccountabilityEntry.user_id.in_({user_id for user_id, _ in wanted}),
+                    AccountabilityEntry.period_id.in_({period_id for _, period_id in wanted}),
+                )
+            )).all()
+        }
+
+        # IDs are allocated here, so goals and results can be linked without reading them back
+        next_goal_id = (await session.execute(select(func.max(AccountabilityGoal.id)))).scalar_one() or 0
+        next_result_id = (await session.execute(select(func.max(AccountabilityResult.id)))).scalar_one() or 0
+        first_result_id = next_result_id + 1
+        goals: list[dict] = []
+        results: list[dict] = []
+        new_entries: list[dict] = []
+        # existing entries that get a goal or result, by entry ID
+        linked: dict[int, dict[str, int]] = {}
+        messages: dict[ThreadRole, list[int]] = {ThreadRole.GOAL: [], ThreadRole.RESULT: []}
+        now = datetime.now(timezone.utc)
+
+        for (user_id, period_id), row in wanted.items():
+            entry_id, goal_id, result_id = existing.get((user_id, period_id), (None, None, None))
+            links = {}
+            if row.goal_text is not None and goal_id is None:
+                next_goal_id += 1
+                links["goal_id"] = next_goal_id
+                goals.append({
+                    "id": next_goal_id,
+                    "message_id": row.goal_message_id or 0,
+                    "text": row.goal_text,
+                    "date_created": row.goal_date_created or now,
+                })
+                if row.goal_message_id:
+                    messages[ThreadRole.GOAL].append(row.goal_message_id)
+            if row.result_text is not None and result_id is None:
+                next_result_id += 1
+                links["result_id"] = next_result_id
+                results.append({
+                    "id": next_result_id,
+                    "message_id": row.result_message_id or 0,
+                    "text": row.result_text,
+                    "date_created": row.result_date_created or now,
+                })
+                if row.result_message_id:
+                    messages[ThreadRole.RESULT].append(row.result_message_id)
+            if entry_id is None:
+                new_entries.append({"user_id": user_id, "period_id": period_id, "goal_id": None, "result_id": None, **links})
+            elif len(links) > 0:
+                linked[entry_id] = links
+
+        # executed as executemany of one cached statement, building a multi-row
+        # VALUES clause costs more than the insert for chunks of this size
+        if len(goals) > 0:
+            await session.execute(insert(AccountabilityGoal), goals)
+        if len(results) > 0:
+            await session.execute(insert(AccountabilityResult), results)
+            # the counts of the whole chunk are computed by one statement
+            success_count, fail_count = AccountabilityResult.count_sql(AccountabilityResult.text)
+            await session.execute(
+                update(AccountabilityResult)
+                .where(AccountabilityResult.id.between(first_result_id, next_result_id))
+                .values(success_count=success_count, fail_count=fail_count)
+            )
+        if len(new_entries) > 0:
+            await session.execute(insert(AccountabilityEntry), new_entries)
+        for entry_id, links in linked.items():
+            await session.execute(
+                update(AccountabilityEntry).where(AccountabilityEntry.id == entry_id).values(**links)
+            )
+
+        changed = [(key, row) for key, row in wanted.items() if key not in existing or existing[key][0] in linked]
+        scored_users = {
+            user_id for (user_id, period_id), row in changed
+            if row.result_text is not None
+        }
+        return {period_id for (_, period_id), _ in changed}, scored_users, messages
@@ -0,0 +1,163 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 10:12
+
+In-memory indices to route accountability events without
+hitting the database for every message.
+"""
+
+import enum
+import typing
+import asyncio
+import logging
+from array import array
+from bisect import bisect_left
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .tables import AccountabilityPeriod, AccountabilityGoal, AccountabilityResult
+
+_log = logging.getLogger(__name__)
+
+
+class ThreadRole(enum.Enum):
+    GOAL = "goal"
+    RESULT = "result"
+
+
+class ThreadIndex:
+    """
+    Maps the IDs of accountability goal and result threads to the ID
+    of the period they belong to and the role of the thread in it.
+
+    The index is warmed from the database at startup and then kept
+    consistent by everything that creates, ends or deletes periods,
+    so that messages in untracked threads can be rejected without
+    querying the database.
+    """
+
+    def __init__(self) -> None:
+        self._threads: dict[int, tuple[int, ThreadRole]] = {}
+        self._warm = asyncio.Event()
+
+    async def warm(self, session: AsyncSession) -> None:
+        """Loads the thread IDs of all periods from the database"""
+        periods = (await session.exec(select(AccountabilityPeriod))).all()
+        self._threads.clear()
+        for period in periods:
+            self.add_period(period)
+        _log.debug(f"Thread index warmed with {len(self._threads)} threads of {len(periods)} periods")
+
+    def set_warm(self) -> None:
+        """Marks the index as ready for event handlers, even if it could not be loaded"""
+        self._warm.set()
+
+    async def wait_warm(self) -> None:
+        """Waits until the index has been loaded"""
+        await self._warm.wait()
+
+    def add_period(self, period: AccountabilityPeriod) -> None:
+        """Adds (or updates) the threads of a period"""
+        if period.goal_channel_id is not None:
+            self._threads[period.goal_channel_id] = (period.id, ThreadRole.GOAL)
+        if period.result_channel_id is not None:
+            self._threads[period.result_channel_id] = (period.id, ThreadRole.RESULT)
+
+    def remove_period(self, period: AccountabilityPeriod) -> None:
+        """Removes all threads of a period"""
+        for thread_id in (period.goal_channel_id, period.result_channel_id):
+            if thread_id is not None:
+                self._threads.pop(thread_id, None)
+
+    def lookup(self, thread_id: int) -> tuple[int, ThreadRole] | None:
+        """
+        Returns the period ID and the role of the thread or None if
+        the thread doesn't belong to any accountability period.
+        """
+        return self._threads.get(thread_id)
+
+    def __contains__(self, thread_id: int) -> bool:
+        return thread_id in self._threads
+
+    def __len__(self) -> int:
+        return len(self._threads)
+
+
+class MessageIndex:
+    """
+    Set of the message IDs of all recorded goals and results.
+
+    The IDs are kept in one sorted array per role, which is much more
+    compact than a set of python ints and allows binary search lookups.
+    This lets the raw edit and delete handlers drop events of untracked
+    messages without any database access.
+
+    The index is exact, so a false positive only happens when the index
+    got out of sync with the database (e.g. a row was removed by a cascade).
+    Lookups, hits and false positives are counted for monitoring.
+    """
+
+    def __init__(self) -> None:
+        self._ids: dict[ThreadRole, array[int]] = {
+            ThreadRole.GOAL: array("q"),
+            ThreadRole.RESULT: array("q"),
+        }
+        self.lookups = 0
+        self.hits = 0
+        self.false_positives = 0
+
+    async def warm(self, session: AsyncSession) -> None:
+        """Loads the message IDs of all goals and results from the database"""
+        goal_ids = (await session.exec(select(AccountabilityGoal.message_id))).all()
+        result_ids = (await session.exec(select(AccountabilityResult.message_id))).all()
+        self._ids[ThreadRole.GOAL] = array("q", sorted(goal_ids))
+        self._ids[ThreadRole.RESULT] = array("q", sorted(result_ids))
+        _log.debug(f"Message index warmed with {len(goal_ids)} goals and {len(result_ids)} results")
+
+    def add(self, role: ThreadRole, message_id: int) -> None:
+        """Adds a message ID, does nothing if it is already present"""
+        ids = self._ids[role]
+        i = bisect_left(ids, message_id)
+        if i == len(ids) or ids[i] != message_id:
+            ids.insert(i, message_id)
+
+    def update(self, role: ThreadRole, message_ids: typing.Iterable[int]) -> None:
+        """Adds many message IDs at once, with one sort instead of an insert per ID"""
+        self._ids[role] = array("q", sorted(set(self._ids[role]).union(message_ids)))
+
+    def discard(self, role: ThreadRole, message_id: int) -> None:
+        """Removes a message ID, does nothing if it is not present"""
+        ids = self._ids[role]
+        i = bisect_left(ids, message_id)
+        if i != len(ids) and ids[i] == message_id:
+            del ids[i]
+
+    def lookup(self, message_id: int) -> ThreadRole | None:
+        """
+        Returns whether the message is a tracked goal or result
+        or None if it isn't tracked at all.
+        """
+        self.lookups += 1
+        for role, ids in self._ids.items():
+            i = bisect_left(ids, message_id)
+            if i != len(ids) and ids[i] == message_id:
+                self.hits += 1
+                return role
+        return None
+
+    def report_false_positive(self) -> None:
+        """Called when a hit could not be found in the database"""
+        self.false_positives += 1
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups > 0 else 0
+
+    @property
+    def false_positive_rate(self) -> float:
+        return self.false_positives / self.hits if self.hits > 0 else 0
+
+    def __len__(self) -> int:
+        return sum(len(ids) for ids in self._ids.values())
@@ -0,0 +1,459 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 11:05
+
+Write-behind queue for recording accountability messages
+"""
+
+import enum
+import typing
+import asyncio
+import logging
+import dataclasses
+
+import discord
+from datetime import datetime, timezone
+from sqlmodel import select
+from sqlalchemy import update, delete
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+from el.observable import filters
+from el.async_tools import synchronize
+
+from compass_app.database import CompassUser
+from .tables import AccountabilityEntry, AccountabilityGoal, AccountabilityResult, AccountabilityCheckpoint
+from .index import ThreadRole
+from .scoring import ScoringEngine
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+class IngestKind(enum.Enum):
+    MESSAGE = "message"
+    EDIT = "edit"
+    DELETE = "delete"
+
+
+@dataclasses.dataclass(slots=True)
+class IngestEvent:
+    """
+    A single accountability relevant gateway event. This only holds plain
+    data copied from the discord objects, so it can outlive them.
+    """
+    kind: IngestKind
+    role: ThreadRole
+    message_id: int
+    channel_id: int | None = None
+    period_id: int | None = None
+    author_id: int | None = None
+    author_name: str | None = None
+    author_avatar: str | None = None
+    content: str = ""
+    # sequence number in the journal, 0 if not journaled
+    seq: int = 0
+
+    @classmethod
+    def from_message(
+        cls,
+        message: discord.Message,
+        period_id: int,
+        role: ThreadRole
+    ) -> "IngestEvent":
+        """Creates an event for a new goal or result message"""
+        return cls(
+            kind=IngestKind.MESSAGE,
+            role=role,
+            message_id=message.id,
+            channel_id=message.channel.id,
+            period_id=period_id,
+            author_id=message.author.id,
+            author_name=message.author.name,
+            author_avatar=message.author.display_avatar.url,
+            content=message.content,
+        )
+
+    @classmethod
+    def from_edit(cls, message: discord.Message, role: ThreadRole) -> "IngestEvent":
+        """Creates an event for an edited goal or result message"""
+        return cls(
+            kind=IngestKind.EDIT,
+            role=role,
+            message_id=message.id,
+            channel_id=message.channel.id,
+            author_id=message.author.id,
+            author_name=message.author.name,
+            content=message.content,
+        )
+
+    @classmethod
+    def from_delete(
+        cls,
+        message_id: int,
+        channel_id: int,
+        role: ThreadRole
+    ) -> "IngestEvent":
+        """Creates an event for a deleted goal or result message"""
+        return cls(
+            kind=IngestKind.DELETE,
+            role=role,
+            message_id=message_id,
+            channel_id=channel_id,
+        )
+
+
+class IngestQueue:
+    """
+    Bounded queue that records accountability events in the background.
+
+    Events are collected into batches of up to `accountability_ingest_batch_size`
+    events or whatever arrives within `accountability_ingest_flush_interval` seconds
+    and each batch is written in a single transaction. Events are applied
+    strictly in the order they were received, so edits and deletes of a message
+    are always applied after the message itself.
+
+    When the queue is full, `put()` blocks the producer until there is space again.
+    On app exit, all queued events are written before `run()` returns.
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        self._queue = asyncio.Queue[IngestEvent | None](
+            maxsize=self._app.settings.accountability_ingest_queue_size
+        )
+        # DB user IDs by discord ID, so known users need no upsert
+        self._user_ids: dict[int, int] = {}
+        # users upserted in the current transaction, only cached after commit
+        self._new_user_ids: dict[int, int] = {}
+        # users whose results changed in the current transaction
+        self._scored_users: set[int] = set()
+        # periods whose entries changed in the current transaction
+        self._changed_periods: set[int] = set()
+        # lowest journal sequence number of the events that failed with a database error,
+        # nothing from there on is marked as committed, so they are recovered on the next start
+        self._held_seq: int | None = None
+        # threads with such a failed message, their checkpoints must not move past it
+        self._held_threads: set[int] = set()
+
+    async def put(self, event: IngestEvent, journal: bool = True) -> None:
+        """
+        Enqueues an event for recording, waiting for space in the queue
+        if it is full. The event is appended to the journal first unless
+        `journal` is False (e.g. when it is replayed from the journal).
+        """
+        if journal:
+            event.seq = self._app.accountability.journal.append(event)
+        # new messages need to be in the filter right away so
+        # edits and deletes that arrive before the flush are not dropped.
+        if event.kind == IngestKind.MESSAGE:
+            self._app.accountability.messages.add(event.role, event.message_id)
+        await self._queue.put(event)
+
+    async def join(self) -> None:
+        """Waits until all events queued so far have been written"""
+        await self._queue.join()
+
+    @synchronize
+    async def _stop(self) -> None:
+        # the stop marker is queued behind all pending events
+        await self._queue.put(None)
+
+    async def run(self) -> None:
+        self._app.exited >> filters.call_if_true(self._stop)
+
+        loop = asyncio.get_running_loop()
+        stopped = False
+        while not stopped:
+            event = await self._queue.get()
+            if event is None:
+                self._queue.task_done()
+                break
+            batch = [event]
+
+            # collect more events until the batch is full or the interval is over
+            deadline = loop.time() + self._app.settings.accountability_ingest_flush_interval
+            while len(batch) < self._app.settings.accountability_ingest_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), timeout)
+                except TimeoutError:
+                    break
+                if event is None:
+                    self._queue.task_done()
+                    stopped = True
+                    break
+                batch.append(event)
+
+            await self._flush(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+        # write anything that has been added after the stop marker
+        batch: list[IngestEvent] = []
+        drained = 0
+        while not self._queue.empty():
+            event = self._queue.get_nowait()
+            drained += 1
+            if event is not None:
+                batch.append(event)
+        if len(batch) > 0:
+            await self._flush(batch)
+        for _ in range(drained):
+            self._queue.task_done()
+        _log.debug("Accountability ingest queue drained")
+
+    @staticmethod
+    def _coalesce(batch: list[IngestEvent]) -> list[IngestEvent]:
+        """
+        Drops edits that are overwritten by a later edit of the same
+        message in the same batch. This never changes the relative
+        order of the events of a message.
+        """
+        last_edit: dict[int, int] = {}
+        for i, event in enumerate(batch):
+            if event.kind == IngestKind.EDIT:
+                last_edit[event.message_id] = i
+        return [
+            event for i, event in enumerate(batch)
+            if event.kind != IngestKind.EDIT or last_edit[event.message_id] == i
+        ]
+
+    async def _flush(self, batch: list[IngestEvent]) -> None:
+        """Writes a batch of events in one transaction"""
+        # events are applied in order, so everything up to the last one is done afterwards,
+        # except for events held back by a database error. If the write is cancelled,
+        # the events stay uncommitted and are recovered on the next start.
+        seq = max(event.seq for event in batch)
+        await self._write(self._coalesce(batch))
+        if self._held_seq is not None:
+            seq = min(seq, self._held_seq - 1)
+        self._app.accountability.journal.mark_committed(seq)
+
+    async def _write(self, batch: list[IngestEvent]) -> None:
+        try:
+            async with self._app.db.session() as session:
+                for event in batch:
+                    await self._apply(session, event)
+                await ScoringEngine.update_users(session, self._scored_users)
+                await self._store_checkpoints(session, batch)
+            self._commit_transaction()
+            return
+        except Exception as e:
+            self._rollback_transaction()
+            _log.warning(f"Failed to record batch of {len(batch)} accountability events, retrying individually: {e}")
+
+        # if the batch failed, we apply the events one by one so a
+        # single bad event doesn't loose all others
+        for event in batch:
+            await self._write_event(event)
+
+    async def _write_event(self, event: IngestEvent) -> None:
+        """
+        Writes a single event. Database errors (e.g. a lock that wasn't released
+        in time) are retried with a backoff, and if they persist, the event is
+        held in the journal. Other errors would fail again, so the event is dropped.
+        """
+        settings = self._app.settings
+        attempts = max(1, settings.accountability_ingest_retries)
+        for attempt in range(attempts):
+            try:
+                async with self._app.db.session() as session:
+                    await self._apply(session, event)
+                    await ScoringEngine.update_users(session, self._scored_users)
+                    await self._store_checkpoints(session, [event])
+                self._commit_transaction()
+                return
+            except OperationalError as e:
+                self._rollback_transaction()
+                error = e
+                if attempt + 1 < attempts:
+                    await asyncio.sleep(settings.accountability_ingest_retry_base * 2 ** attempt)
+            except Exception as e:
+                self._rollback_transaction()
+                _log.error(f"Failed to record accountability event {event}: {e}", exc_info=e)
+                return
+
+        _log.error(f"Failed to record accountability event {event}, retrying it on the next start: {error}")
+        if event.seq > 0:
+            self._held_seq = min(self._held_seq or event.seq, event.seq)
+        if event.kind == IngestKind.MESSAGE:
+            self._held_threads.add(event.channel_id)
+
+    async def _store_checkpoints(self, session: AsyncSession, batch: list[IngestEvent]) -> None:
+        """
+        Advances the checkpoints of the threads of all new messages in a batch,
+        except for threads with a message that couldn't be recorded
+        """
+        newest: dict[int, int] = {}
+        for event in batch:
+            if event.kind == IngestKind.MESSAGE and event.channel_id not in self._held_threads:
+                newest[event.channel_id] = max(newest.get(event.channel_id, 0), event.message_id)
+        for thread_id, message_id in newest.items():
+            await AccountabilityCheckpoint.advance(session, thread_id, message_id)
+
+    def _commit_transaction(self) -> None:
+        self._user_ids.update(self._new_user_ids)
+        self._new_user_ids.clear()
+        if len(self._scored_users) > 0:
+            self._app.accountability.scoring.notify(self._scored_users)
+            self._scored_users = set()
+        if len(self._changed_periods) > 0:
+            self._app.accountability.versions.entries_changed(self._changed_periods)
+            self._changed_periods.clear()
+
+    def _rollback_transaction(self) -> None:
+        self._new_user_ids.clear()
+        self._scored_users.clear()
+        self._changed_periods.clear()
+
+    async def _get_user_id(self, session: AsyncSession, event: IngestEvent) -> int:
+        """Returns the DB user ID of the event author, creating the user if needed"""
+        user_id = self._user_ids.get(event.author_id) or self._new_user_ids.get(event.author_id)
+        if user_id is None:
+            user_id = await CompassUser.upsert_from_discord(
+                session,
+                event.author_id,
+                event.author_name,
+                event.author_avatar
+            )
+            self._new_user_ids[event.author_id] = user_id
+        return user_id
+
+    async def _apply(self, session: AsyncSession, event: IngestEvent) -> None:
+        route = self._app.accountability.threads.lookup(event.channel_id)
+        if route is not None:
+            self._changed_periods.add(route[0])
+        match event.kind:
+            case IngestKind.MESSAGE:
+                await self._apply_message(session, event)
+            case IngestKind.EDIT:
+                await self._apply_edit(session, event)
+            case IngestKind.DELETE:
+                await self._apply_delete(session, event)
+
+    async def _apply_message(self, session: AsyncSession, event: IngestEvent) -> None:
+        messages = self._app.accountability.messages
+
+        # the period may have been reset while the event was queued
+        route = self._app.accountability.threads.lookup(event.channel_id)
+        if route is None or route[0] != event.period_id:
+            _log.warning(f"Accountability period {event.period_id} no longer exists, ignoring message")
+            messages.discard(event.role, event.message_id)
+            return
+
+        user_id = await self._get_user_id(session, event)
+
+        _log.info(f"Received accountability {event.role.value} in period {event.period_id} from '{event.author_name}': '{event.content}'")
+
+        # the goal/result is inserted first and then linked to the entry,
+        # so the common case needs no more than two statements
+        if event.role is ThreadRole.GOAL:
+            record_id = (await session.execute(
+                insert(AccountabilityGoal).values(
+                    message_id=event.message_id,
+                    text=event.content,
+                    date_created=datetime.now(timezone.utc),
+                ).returning(AccountabilityGoal.id)
+            )).scalar_one()
+            _, linked_id, _ = await AccountabilityEntry.upsert(
+                session, user_id, event.period_id, goal_id=record_id
+            )
+            table = AccountabilityGoal
+        else:
+            success_count, fail_count = AccountabilityResult.count(event.content)
+            record_id = (await session.execute(
+                insert(AccountabilityResult).values(
+                    message_id=event.message_id,
+                    text=event.content,
+                    success_count=success_count,
+                    fail_count=fail_count,
+                    date_created=datetime.now(timezone.utc),
+                ).returning(AccountabilityResult.id)
+            )).scalar_one()
+            _, _, linked_id = await AccountabilityEntry.upsert(
+                session, user_id, event.period_id, result_id=record_id
+            )
+            table = AccountabilityResult
+
+        # If the user posted a second message, the entry keeps the first
+        # one and we drop the new one again
+        if linked_id != record_id:
+            await session.execute(delete(table).where(table.id == record_id))
+            linked_message_id = (await session.execute(
+                select(table.message_id).where(table.id == linked_id)
+            )).scalar_one()
+            if linked_message_id == event.message_id:
+                # the same message was delivered twice, e.g. live and by a catch up
+                return
+            _log.warning(f"Duplicate accountability {event.role.value} from {event.author_name} in period {event.period_id}, ignoring")
+            messages.discard(event.role, event.message_id)
+        elif event.role is ThreadRole.RESULT:
+            self._scored_users.add(user_id)
+
+    async def _apply_edit(self, session: AsyncSession, event: IngestEvent) -> None:
+        if event.role is ThreadRole.GOAL:
+            stmt = update(AccountabilityGoal).where(
+                AccountabilityGoal.message_id == event.message_id
+            ).values(text=event.content)
+        else:
+            success_count, fail_count = AccountabilityResult.count(event.content)
+            stmt = update(AccountabilityResult).where(
+                AccountabilityResult.message_id == event.message_id
+            ).values(
+                text=event.content,
+                success_count=success_count,
+                fail_count=fail_count,
+            )
+
+        if (await session.execute(stmt)).rowcount == 0:
+            self._app.accountability.messages.report_false_positive()
+            return
+        if event.role is ThreadRole.RESULT:
+            self._scored_users.update((await session.exec(
+                select(AccountabilityEntry.user_id)
+                .join(AccountabilityResult, AccountabilityEntry.result_id == AccountabilityResult.id)
+                .where(AccountabilityResult.message_id == event.message_id)
+            )).all())
+        _log.info(f"Accountability {event.role.value} of {event.author_name} updated.")
+
+    async def _apply_delete(self, session: AsyncSession, event: IngestEvent) -> None:
+        messages = self._app.accountability.messages
+
+        # unlink the record from its entry before deleting it
+        if event.role is ThreadRole.GOAL:
+            table = AccountabilityGoal
+            record_ids = select(AccountabilityGoal.id).where(
+                AccountabilityGoal.message_id == event.message_id
+            )
+            await session.execute(
+                update(AccountabilityEntry)
+                .where(AccountabilityEntry.goal_id.in_(record_ids))
+                .values(goal_id=None)
+            )
+        else:
+            table = AccountabilityResult
+            record_ids = select(AccountabilityResult.id).where(
+                AccountabilityResult.message_id == event.message_id
+            )
+            unlinked = await session.execute(
+                update(AccountabilityEntry)
+                .where(AccountabilityEntry.result_id.in_(record_ids))
+                .values(result_id=None)
+                .returning(AccountabilityEntry.user_id)
+            )
+            self._scored_users.update(unlinked.scalars())
+
+        result = await session.execute(
+            delete(table).where(table.message_id == event.message_id)
+        )
+        if result.rowcount == 0:
+            messages.report_false_positive()
+        else:
+            _log.info(f"Accountability {event.role.value} (message {event.message_id}) deleted.")
+        messages.discard(event.role, event.message_id)
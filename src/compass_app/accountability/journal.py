@@ -0,0 +1,495 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 19:40
+
+Durable append-only journal of accountability events.
+
+Every event is appended to the journal before it is queued for recording, so
+events that were received but not yet committed to the database when the app
+crashed are recorded on the next start. The journal also allows rebuilding
+a fresh database by replaying it.
+
+The journal is a directory of segment files. Each record is a header
+(payload length, CRC32 of the payload, sequence number) followed by a compact
+JSON payload. Records are written to the OS right away and fsync'ed in
+batches. The active segment is named after its first sequence number and
+is renamed to `<first>-<last>.journal` when it is sealed, either because it
+got too large or on shutdown. Sealed segments that only contain committed
+events are compacted into a single segment with at most one record per
+message.
+"""
+
+import os
+import json
+import enum
+import zlib
+import struct
+import typing
+import asyncio
+import logging
+import dataclasses
+from pathlib import Path
+
+from sqlmodel import select
+from el.observable import filters
+
+from .tables import AccountabilityPeriod
+from .index import ThreadRole
+from .ingest import IngestEvent, IngestKind
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+# payload length, CRC32 of the payload, sequence number
+_HEADER = struct.Struct("<IIQ")
+_SUFFIX = ".journal"
+
+
+class PeriodEventKind(enum.Enum):
+    START = "period_start"
+    END = "period_end"
+    RESET = "period_reset"
+
+
+@dataclasses.dataclass(slots=True)
+class PeriodEvent:
+    """
+    Creation, ending or reset of a period. These are journaled after they are
+    committed, so that a replay into a fresh database can recreate the periods.
+    """
+    kind: PeriodEventKind
+    year: int
+    week: int
+    # goal thread for START, result thread for END
+    channel_id: int | None = None
+
+
+JournalRecord = IngestEvent | PeriodEvent
+_PERIOD_EVENT_KINDS = {kind.value for kind in PeriodEventKind}
+
+
+def _encode(record: JournalRecord) -> bytes:
+    data = {
+        field.name: getattr(record, field.name)
+        for field in dataclasses.fields(record)
+        if getattr(record, field.name) is not None and field.name != "seq"
+    }
+    data["kind"] = record.kind.value
+    if isinstance(record, IngestEvent):
+        data["role"] = record.role.value
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def _decode(payload: bytes) -> JournalRecord:
+    data = json.loads(payload)
+    kind = data.pop("kind")
+    if kind in _PERIOD_EVENT_KINDS:
+        return PeriodEvent(kind=PeriodEventKind(kind), **data)
+    return IngestEvent(kind=IngestKind(kind), role=ThreadRole(data.pop("role")), **data)
+
+
+def _read_segment(path: Path) -> typing.Iterator[tuple[int, JournalRecord]]:
+    """Reads the records of a segment, stopping at a torn or corrupt record"""
+    with open(path, "rb") as file:
+        while True:
+            header = file.read(_HEADER.size)
+            if len(header) == 0:
+                return
+            if len(header) < _HEADER.size:
+                _log.warning(f"Journal segment {path.name} ends with a torn record header")
+                return
+            length, crc, seq = _HEADER.unpack(header)
+            payload = file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                _log.warning(f"Journal segment {path.name} ends with a torn or corrupt record")
+                return
+            yield seq, _decode(payload)
+
+
+def _write_records(path: Path, records: typing.Iterable[tuple[int, JournalRecord]]) -> None:
+    with open(path, "wb") as file:
+        for seq, record in records:
+            payload = _encode(record)
+            file.write(_HEADER.pack(len(payload), zlib.crc32(payload), seq))
+            file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _segment_range(path: Path) -> tuple[int, int | None]:
+    """First and last sequence number of a segment (last is None for unsealed ones)"""
+    first, _, last = path.stem.partition("-")
+    return int(first), (int(last) if last else None)
+
+
+def _covered_segments(paths: list[Path]) -> set[Path]:
+    """
+    Sealed segments whose range is contained in another sealed segment. These are
+    the sources of a compaction that was interrupted after the compacted segment
+    was put in place, which already contains their records.
+    """
+    ranges = [(path, *_segment_range(path)) for path in paths]
+    return {
+        path for path, first, last in ranges
+        if last is not None and any(
+            other is not path and other_last is not None and other_first <= first and last <= other_last
+            for other, other_first, other_last in ranges
+        )
+    }
+
+
+def _compact(records: typing.Iterable[tuple[int, JournalRecord]]) -> list[tuple[int, JournalRecord]]:
+    """
+    Coalesces the records of committed segments:
+    - a message and its edits become one message record with the latest content
+    - deleted messages are dropped entirely
+    - periods that were reset are dropped together with the messages of their
+      threads that were recorded before the reset, a week restarted on the same
+      threads keeps its new messages
+
+    Records keep their position in the journal.
+    """
+    result: dict[int, tuple[int, JournalRecord]] = {}
+    # position of the record of every message in the result
+    messages: dict[int, int] = {}
+    # position of the start and end record of every week
+    periods: dict[tuple[int, int], list[int]] = {}
+    # threads of reset periods and the sequence number of their latest reset
+    reset_channels: dict[int, int] = {}
+
+    for seq, record in records:
+        if isinstance(record, PeriodEvent):
+            week = (record.year, record.week)
+            if record.kind is PeriodEventKind.RESET:
+                for position in periods.pop(week, []):
+                    _, period_record = result.pop(position)
+                    reset_channels[period_record.channel_id] = seq
+                result[seq] = (seq, record)
+            else:
+                periods.setdefault(week, []).append(seq)
+                result[seq] = (seq, record)
+            continue
+
+        previous = messages.get(record.message_id)
+        match record.kind:
+            case IngestKind.MESSAGE:
+                if previous is None:
+                    messages[record.message_id] = seq
+                    result[seq] = (seq, record)
+            case IngestKind.EDIT:
+                if previous is None:
+                    messages[record.message_id] = seq
+                    result[seq] = (seq, record)
+                else:
+                    _, kept = result[previous]
+                    kept.content = record.content
+                    if record.author_name is not None:
+                        kept.author_name = record.author_name
+            case IngestKind.DELETE:
+                if previous is not None:
+                    _, kept = result.pop(previous)
+                    del messages[record.message_id]
+                    # the delete is only needed if the message itself is older than the journal
+                    if kept.kind is IngestKind.MESSAGE:
+                        continue
+                result[seq] = (seq, record)
+
+    return [
+        (seq, record) for seq, record in sorted(result.values(), key=lambda item: item[0])
+        if isinstance(record, PeriodEvent) or seq > reset_channels.get(record.channel_id, 0)
+    ]
+
+
+class AccountabilityJournal:
+    """
+    Append-only journal of all accountability events.
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        self._path = self._app.data_path / "journal"
+        self._path.mkdir(parents=True, exist_ok=True)
+        self._committed_path = self._path / "committed"
+
+        # highest sequence number recorded in the DB and the last one written to disk
+        self._committed = self._load_committed()
+        self._stored_committed = self._committed
+
+        # finish a compaction that was interrupted before its sources were removed
+        for path in _covered_segments(self._all_segments()):
+            path.unlink()
+
+        # seal segments left open by the last run, which also finds the next sequence number
+        self._next_seq = 1
+        for path in self._segments():
+            first, last = _segment_range(path)
+            if last is None:
+                last = self._seal_segment(path)
+            if last is not None:
+                self._next_seq = max(self._next_seq, last + 1)
+
+        self._file: typing.BinaryIO | None = None
+        self._file_path: Path | None = None
+        self._file_first_seq = 0
+        self._unsynced = 0
+        # duplicated descriptors of the segments sealed since the last sync
+        self._sealed_fds: list[int] = []
+        # held while segments are read or replaced
+        self._files_lock = asyncio.Lock()
+
+    def _all_segments(self) -> list[Path]:
+        return sorted(self._path.glob(f"*{_SUFFIX}"), key=lambda path: _segment_range(path)[0])
+
+    def _segments(self) -> list[Path]:
+        """Segments in order, without the ones left over from an interrupted compaction"""
+        paths = self._all_segments()
+        covered = _covered_segments(paths)
+        return [path for path in paths if path not in covered]
+
+    def _load_committed(self) -> int:
+        try:
+            return int(self._committed_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _store_committed(self) -> None:
+        if self._committed == self._stored_committed:
+            return
+        tmp = self._committed_path.with_suffix(".tmp")
+        tmp.write_text(str(self._committed))
+        os.replace(tmp, self._committed_path)
+        self._stored_committed = self._committed
+
+    def _seal_segment(self, path: Path) -> int | None:
+        """Renames an unsealed segment to include its last sequence number, empty ones are removed"""
+        last = None
+        for seq, _ in _read_segment(path):
+            last = seq
+        if last is None:
+            path.unlink()
+            return None
+        first, _ = _segment_range(path)
+        path.rename(self._path / f"{first:016d}-{last:016d}{_SUFFIX}")
+        return last
+
+    def _close_segment(self) -> None:
+        """
+        Closes and seals the active segment without waiting for the disk. A duplicate
+        of its descriptor is kept, so the next sync can still fsync the closed file.
+        """
+        if self._file is None:
+            return
+        self._file.flush()
+        self._sealed_fds.append(os.dup(self._file.fileno()))
+        self._file.close()
+        self._file = None
+        self._unsynced = 0
+        if self._next_seq > self._file_first_seq:
+            self._file_path.rename(self._path / f"{self._file_first_seq:016d}-{self._next_seq - 1:016d}{_SUFFIX}")
+        else:
+            self._file_path.unlink()
+
+    def append(self, record: JournalRecord) -> int:
+        """
+        Appends a record to the journal and returns its sequence number. The record
+        is handed to the OS right away, so it survives a crash of the app. It is
+        only safe from power loss after the next fsync.
+        """
+        if self._file is None:
+            self._file_first_seq = self._next_seq
+            self._file_path = self._path / f"{self._file_first_seq:016d}{_SUFFIX}"
+            self._file = open(self._file_path, "ab")
+
+        seq = self._next_seq
+        self._next_seq += 1
+        payload = _encode(record)
+        self._file.write(_HEADER.pack(len(payload), zlib.crc32(payload), seq))
+        self._file.write(payload)
+        self._file.flush()
+        self._unsynced += 1
+
+        if self._file.tell() >= self._app.settings.accountability_journal_segment_size:
+            self._close_segment()
+        return seq
+
+    def mark_committed(self, seq: int) -> None:
+        """Marks all records up to a sequence number as recorded in the database"""
+        self._committed = max(self._committed, seq)
+
+    def _take_unsynced(self) -> list[int]:
+        """
+        Returns the descriptors of all segments with unsynced records, called on the loop.
+        These are duplicates owned by the caller, so the loop can close or seal
+        the active segment while they are synced by another thread.
+        """
+        fds, self._sealed_fds = self._sealed_fds, []
+        if self._file is not None and self._unsynced > 0:
+            self._unsynced = 0
+            fds.append(os.dup(self._file.fileno()))
+        return fds
+
+    def _sync(self, fds: list[int]) -> None:
+        """Syncs and closes descriptors from _take_unsynced() and stores the committed sequence number"""
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                _log.error(f"Failed to sync accountability journal: {e}")
+            finally:
+                os.close(fd)
+        self._store_committed()
+
+    async def compact(self) -> None:
+        """Compacts all sealed segments that only contain committed records into one"""
+        async with self._files_lock:
+            segments = [
+                path for path in self._segments()
+                if (last := _segment_range(path)[1]) is not None and last <= self._committed
+            ]
+            if len(segments) < 2:
+                return
+            await asyncio.get_running_loop().run_in_executor(None, self._compact_segments, segments)
+
+    def _compact_segments(self, segments: list[Path]) -> None:
+        records = _compact(
+            record for path in segments for record in _read_segment(path)
+        )
+        first, _ = _segment_range(segments[0])
+        _, last = _segment_range(segments[-1])
+        target = self._path / f"{first:016d}-{last:016d}{_SUFFIX}"
+        tmp = self._path / f"{first:016d}-{last:016d}.tmp"
+        _write_records(tmp, records)
+        # the sources are only removed once the compacted segment is in place,
+        # until then they are skipped by _segments() as they are covered by it
+        os.replace(tmp, target)
+        dir_fd = os.open(self._path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        for path in segments:
+            if path != target:
+                path.unlink()
+        _log.info(f"Compacted {len(segments)} journal segments into {len(records)} records")
+
+    async def _read(self, after: int = 0) -> list[tuple[int, JournalRecord]]:
+        """Reads all records after a sequence number from the sealed and active segments"""
+        def read():
+            return [
+                (seq, record)
+                for path in self._segments()
+                if (_segment_range(path)[1] or self._next_seq) > after
+                for seq, record in _read_segment(path)
+                if seq > after
+            ]
+        async with self._files_lock:
+            return await asyncio.get_running_loop().run_in_executor(None, read)
+
+    async def recover(self) -> int:
+        """
+        Queues the events that were journaled but not committed to the database
+        before the app stopped. Returns the number of recovered events.
+        """
+        records = await self._read(after=self._committed)
+        count = 0
+        for seq, record in records:
+            # period events are only journaled after they are committed
+            if isinstance(record, IngestEvent):
+                record.seq = seq
+                await self._queue(record)
+                count += 1
+        if count > 0:
+            _log.info(f"Recovered {count} uncommitted accountability events from the journal")
+        return count
+
+    async def replay(self) -> int:
+        """
+        Re-runs the whole journal into the database, e.g. to rebuild a fresh one.
+        Already recorded messages are not recorded again, so this can also be used
+        on an existing database. Returns the number of replayed records.
+        """
+        records = await self._read()
+        for seq, record in records:
+            if isinstance(record, PeriodEvent):
+                # messages before the period event need to be written first
+                await self._app.accountability.ingest.join()
+                await self._apply_period_event(record)
+            else:
+                record.seq = seq
+                await self._queue(record)
+        await self._app.accountability.ingest.join()
+        _log.info(f"Replayed {len(records)} journal records")
+        return len(records)
+
+    async def _queue(self, event: IngestEvent) -> None:
+        if event.kind == IngestKind.MESSAGE:
+            # period IDs are not the same in a different database, so they are looked up by thread
+            route = self._app.accountability.threads.lookup(event.channel_id)
+            if route is None:
+                return
+            event.period_id = route[0]
+        await self._app.accountability.ingest.put(event, journal=False)
+
+    async def _apply_period_event(self, event: PeriodEvent) -> None:
+        async with self._app.db.session() as session:
+            period = (await session.exec(
+                select(AccountabilityPeriod).where(
+                    AccountabilityPeriod.week == event.week,
+                    AccountabilityPeriod.year == event.year,
+                )
+            )).one_or_none()
+            match event.kind:
+                case PeriodEventKind.START:
+                    if period is not None:
+                        return
+                    period = AccountabilityPeriod.from_week(event.year, event.week)
+                    period.goal_channel_id = event.channel_id
+                    session.add(period)
+                case PeriodEventKind.END:
+                    if period is None or period.result_channel_id is not None:
+                        return
+                    period.result_channel_id = event.channel_id
+                    session.add(period)
+                case PeriodEventKind.RESET:
+                    if period is None:
+                        return
+                    await session.delete(period)
+
+        versions = self._app.accountability.versions
+        if event.kind is PeriodEventKind.RESET:
+            self._app.accountability.threads.remove_period(period)
+            versions.periods_changed([period.id])
+            versions.entries_changed(())
+            await self._app.accountability.scoring.recompute()
+        else:
+            self._app.accountability.threads.add_period(period)
+            versions.periods_changed([period.id])
+
+    async def run(self) -> None:
+        exited = asyncio.Event()
+        self._app.exited >> filters.call_if_true(exited.set)
+
+        loop = asyncio.get_running_loop()
+        while not exited.is_set():
+            try:
+                await asyncio.wait_for(exited.wait(), self._app.settings.accountability_journal_fsync_interval)
+            except TimeoutError:
+                pass
+            async with self._files_lock:
+                await loop.run_in_executor(None, self._sync, self._take_unsynced())
+
+            sealed = sum(1 for path in self._segments() if _segment_range(path)[1] is not None)
+            if sealed > self._app.settings.accountability_journal_compact_segments:
+                try:
+                    await self.compact()
+                except Exception as e:
+                    _log.error(f"Failed to compact accountability journal: {e}", exc_info=e)
+
+    def close(self) -> None:
+        """Syncs and seals the active segment, must be called once nothing is appended anymore"""
+        self._close_segment()
+        self._sync(self._take_unsynced())
@@ -7,16 +7,29 @@ Accountability manager
 """
 
 import typing
-import logging
 import asyncio
-from datetime import datetime, time, timezone, timedelta
+import logging
+from datetime import datetime, timedelta
 
 from sqlmodel import select
-from discord import Thread, ChannelType
+from sqlalchemy.exc import IntegrityError
+from discord import Thread
 from el.errors import DuplicateError
-from el.async_tools import synchronize
 
+from compass_app import weeks
+from compass_app.scheduler import weekly
 from .tables import *
+from .index import ThreadIndex, MessageIndex
+from .ingest import IngestQueue
+from .scoring import ScoringEngine
+from .stats import AccountabilityStats
+from .backfill import AccountabilityBackfill
+from .journal import AccountabilityJournal
+from .outbound import OutboundQueue
+from .versions import DataVersions
+from .api import AccountabilityAPI
+from .export import AccountabilityExport
+from .importer import AccountabilityImporter
 
 if typing.TYPE_CHECKING:
     from compass_app.main import CompassApp
@@ -27,127 +40,129 @@ _log = logging.getLogger(__name__)
 class AccountabilityManager():
     def __init__(self, app: "CompassApp"):
         self._app = app
+        # routing index of all accountability threads
+        self.threads = ThreadIndex()
+        # filter of all recorded goal and result messages
+        self.messages = MessageIndex()
+        # durable log of all events, written before they are recorded
+        self.journal = AccountabilityJournal(app)
+        # buffered recording of accountability messages
+        self.ingest = IngestQueue(app)
+        # materialized scores, updated by the ingest queue
+        self.scoring = ScoringEngine(app)
+        # leaderboards and personal stats
+        self.stats = AccountabilityStats(app)
+        self.scoring.add_listener(self.stats.cache.invalidate)
+        # rebuilding of data from the discord thread history
+        self.backfill = AccountabilityBackfill(app)
+        # discord side effects of period changes
+        self.outbound = OutboundQueue(app)
+        # read API of the web app, with ETags from the data versions
+        self.versions = DataVersions()
+        self.api = AccountabilityAPI(app, self.versions)
+        # bulk export of the history for offline analysis
+        self.export = AccountabilityExport(app)
+        # bulk import of old or exported data
+        self.importer = AccountabilityImporter(app)
+
+        # automations, the settings are read every time the jobs are scheduled
+        settings = self._app.settings
+        self._app.scheduler.add_job(
+            "accountability_period",
+            weekly(
+                lambda: settings.accountability_period_weekday,
+                lambda: settings.accountability_period_time,
+                lambda: settings.accountability_period_automation,
+            ),
+            self._period_automation,
+        )
+        self._app.scheduler.add_job(
+            "accountability_scoring",
+            weekly(
+                lambda: settings.accountability_scoring_weekday,
+                lambda: settings.accountability_scoring_time,
+                lambda: settings.accountability_scoring_automation,
+            ),
+            self._scoring_automation,
+        )
 
     async def run(self) -> None:
-        self._creation_automation()
-        #self._scoring_automation()
+        # these only return once all events are written on app exit
+        await asyncio.gather(
+            self.ingest.run(),
+            self.journal.run(),
+            self.outbound.run(),
+            self._startup(),
+        )
+        self.journal.close()
+
+    async def _startup(self) -> None:
+        try:
+            async with self._app.db.read_session() as session:
+                await self.messages.warm(session)
+                await self.threads.warm(session)
+        except Exception as e:
+            _log.warning(f"Failed to load accountability indices: {e}", exc_info=e)
+
+        # events that were not recorded before the last shutdown are queued
+        # before any new ones, so they stay in order
+        try:
+            await self.journal.recover()
+        except Exception as e:
+            _log.error(f"Failed to recover accountability events from the journal: {e}", exc_info=e)
+
+        # release waiting event handlers, even if the indices could not be loaded
+        self.threads.set_warm()
     
-    @synchronize
-    async def _creation_automation(self) -> None:
+    async def _period_automation(self, due: datetime) -> None:
         """
-        Runs the accountability automation in the background, periodically
-        checking whether it's time to start a new accountability period.
-        This is in a task so it's instantly stopped on app exit.
+        Scheduled job ending the previous accountability period and
+        starting the next one.
         """
-        while True:
-            await asyncio.sleep(30)
-            # if automation is disabled, do nothing
-            if not self._app.settings.accountability_period_automation:
-                continue
-    
-            # otherwise check if it's the right day
-            now = datetime.now(timezone.utc)    # we use UTC time for this
-            # here we use ISO weekdays
-            if now.weekday() != self._app.settings.accountability_period_weekday:
-                continue
-            
-            # create comparable datetime object 
-            target_dt = datetime.combine(
-                now.date(), 
-                self._app.settings.accountability_period_time, 
-                timezone.utc
-            )
-            
-            # if we are before the target time do nothing
-            if now < target_dt:
-                continue
-            
-            # were after the target time.
-            # calculate the difference between now and the set time
-            # and see if we are within one minute of it to avoid 
-            # running multiple times.
-            td = now - target_dt
-            if td > timedelta(minutes=1):
-                continue
-            
-            # at this point we can end the previous period and start the next one
-            year = now.year
-            week = int(now.strftime("%U"))  # here we now have to use the US weeks bc of compass convention
-            
-            _log.info(f"Accountability automation triggered, ending week {week - 1} and starting week {week}")
-            
-            try:
-                await self.end_period(week - 1, year)   # end last period
-            except (DuplicateError, IndexError) as e:
-                _log.warning(f"Failed to automatically end period for week {week - 1} of {year}: {e}")
+        # the week is calculated from the scheduled time and not the current time,
+        # so a run that is caught up late still handles the right week
+        current = weeks.week_of(due.date())
+        previous = weeks.get_calendar().previous_week(current)
+        
+        _log.info(f"Accountability automation triggered, ending {previous} and starting {current}")
+        
+        try:
+            await self.end_period(previous.week, previous.year)   # end last period
+        except (DuplicateError, IndexError) as e:
+            _log.warning(f"Failed to automatically end period for {previous}: {e}")
+        except TimeoutError:
+            _log.warning(f"Results thread for {previous} is not created yet, it is retried in the background")
 
-            try:
-                await self.start_period(week, year)
-            except DuplicateError:
-                # period for this week already exists, do nothing other than warn about it
-                _log.warning(f"Attempted to automatically start period for week {week} of {year} but it exists already")
-            
-            # then we wait longer than 1 minute to ensure we don't re-trigger in the same one-minute window
-            await asyncio.sleep(61)
+        try:
+            await self.start_period(current.week, current.year)
+        except DuplicateError:
+            # period for this week already exists, do nothing other than warn about it
+            _log.warning(f"Attempted to automatically start period for {current} but it exists already")
+        except TimeoutError:
+            _log.warning(f"Goal setting thread for {current} is not created yet, it is retried in the background")
 
-    @synchronize
-    async def _scoring_automation(self) -> None:
-        """
-        Runs the accountability scoring automation in the background, periodically
-        checking whether it's time to score an accountability period.
-        This is in a task so it's instantly stopped on app exit.
+    async def _scoring_automation(self, due: datetime) -> None:
         """
-        while True:
-            await asyncio.sleep(30)
-            # if automation is disabled, do nothing
-            if not self._app.settings.accountability_scoring_automation:
-                continue
-    
-            # otherwise check if it's the right day
-            now = datetime.now(timezone.utc)    # we use UTC time for this
-            # here we use ISO weekdays
-            if now.weekday() != self._app.settings.accountability_scoring_weekday:
-                continue
-            
-            # create comparable datetime object 
-            target_dt = datetime.combine(
-                now.date(), 
-                self._app.settings.accountability_scoring_time, 
-                timezone.utc
-            )
-            
-            # if we are before the target time do nothing
-            if now < target_dt:
-                continue
-            
-            # were after the target time.
-            # calculate the difference between now and the set time
-            # and see if we are within one minute of it to avoid 
-            # running multiple times.
-            td = now - target_dt
-            if td > timedelta(minutes=1):
-                continue
-            
-            # at this point we can end the previous period and start the next one
-            year = now.year
-            week = int(now.strftime("%U")) - 1  # here we now have to use the US weeks bc of compass convention
-            #                                ^ also we score the previous period 
+        Scheduled job scoring the previous accountability period.
 
-            
-            try:
-                # TODO: run scoring if needed
-                ...
-            except (DuplicateError, IndexError) as e:
-                _log.warning(f"Failed to score period for week {week} of {year}: {e}")
+        Scores are kept up to date incrementally, so this only
+        reconciles them with a full recompute.
+        """
+        # we score the previous period
+        previous = weeks.week_of(due.date() - timedelta(days=7))
 
-            # then we wait longer than 1 minute to ensure we don't re-trigger in the same time period
-            await asyncio.sleep(61)
+        try:
+            await self.scoring.recompute()
+        except Exception as e:
+            _log.warning(f"Failed to score period for {previous}: {e}")
+            return
+        _log.info(f"Scored accountability period for {previous}")
 
     async def start_period(
         self, 
         week: int,
         year: int,
-    ) -> Thread:
+    ) -> Thread | None:
         """
         Cerates a new accountability period and goal setting thread
         for it.
@@ -161,13 +176,19 @@ class AccountabilityManager():
 
         Returns
         -------
-        Thread
-            The discord thread that has been created.
+        Thread | None
+            The discord thread that has been created or None if the
+            period was reset before it was created.
 
         Raises
         ------
         DuplicateError
             A period for this year+week already exists
+        ValueError
+            The year doesn't have a week with this number
+        TimeoutError
+            The thread is not created yet (e.g. because discord is unavailable),
+            the period exists and the thread is created in the background
         """
         async with self._app.db.session() as session:
             # check for duplicates
@@ -180,35 +201,26 @@ class AccountabilityManager():
             if duplicate is not None:
                 raise DuplicateError()
             
-            # doesn't exist yet, so we create the period
+            # doesn't exist yet, so we create the period. The thread is
+            # created by the outbound queue once this is committed.
             period = AccountabilityPeriod.from_week(year, week)
-            
-            # create thread and send some initial message to inform people about what to do
-            channel = self._app.bot.get_channel(self._app.config.accountability_channel_id)
-            assert channel is not None, "Accountability channel must exits"
-            thread = await channel.create_thread(
-                name=f"Week {week} Accountability Setting 🎯",
-                type=ChannelType.public_thread
-            )
-            await thread.send(
-                f"""
-                ## :information_source:  Tell us about the goals you want to be held accountable for by the community in week {week} of {year} (1 message per user only).
-
-                ## :sunny:  Whether you want to take a break, keep the same habit or start a new initiative the community accountability is here for you.
-                """
-            )
-            if not thread:
-                raise RuntimeError("Failed to create thread")
-            period.goal_channel_id = thread.id
             session.add(period)
+            try:
+                # this also fails if a period for the same week was created concurrently
+                await session.flush()
+            except IntegrityError:
+                raise DuplicateError()
+            action = AccountabilityOutbox(kind=OutboundKind.GOAL_THREAD, period_id=period.id)
+            session.add(action)
 
-            return thread
+        self.versions.periods_changed([period.id])
+        return await self.outbound.wait(self.outbound.submit(action.id))
 
     async def end_period(
         self, 
         week: int,
         year: int,
-    ) -> Thread:
+    ) -> Thread | None:
         """
         Ends an existing accountability period by creating it's
         results thread.
@@ -222,8 +234,9 @@ class AccountabilityManager():
 
         Returns
         -------
-        Thread
-            The discord thread that has been created.
+        Thread | None
+            The discord thread that has been created or None if the
+            period was reset before it was created.
 
         Raises
         ------
@@ -231,6 +244,9 @@ class AccountabilityManager():
             This period doesn't exist yet, so we can't end it
         DuplicateError
             The period is already ended and a results thread exists
+        TimeoutError
+            The thread is not created yet (e.g. because discord is unavailable),
+            it is created in the background
         """
         async with self._app.db.session() as session:
             # find the period
@@ -246,23 +262,13 @@ class AccountabilityManager():
             if period.result_channel_id is not None:
                 raise DuplicateError("Period has already ended")
 
-            # create result thread and send some initial message to inform people about what to do
-            channel = self._app.bot.get_channel(self._app.config.accountability_channel_id)
-            assert channel is not None, "Accountability channel must exits"
-            thread = await channel.create_thread(
-                name=f"Week {week} Accountability Check In ✅❌",
-                type=ChannelType.public_thread
-            )
-            await thread.send(
-                f"""
-                ## :information_source:  How was week {week} for you? Tell us about the results for your goals using the :white_check_mark: symbol for success or the :x: symbol for failure. You can use more than one if you had multiple goals.
-                """
-            )
-            if not thread:
-                raise RuntimeError("Failed to create thread")
-            period.result_channel_id = thread.id
-            session.add(period)
-
-            return thread
-
+            # the results thread is created by the outbound queue once this is
+            # committed, a pending one makes this fail on the unique index
+            action = AccountabilityOutbox(kind=OutboundKind.RESULT_THREAD, period_id=period.id)
+            session.add(action)
+            try:
+                await session.flush()
+            except IntegrityError:
+                raise DuplicateError("Period is already being ended")
 
+        return await self.outbound.wait(self.outbound.submit(action.id))
@@ -0,0 +1,348 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 23:30
+
+Queue performing the discord side effects of accountability changes
+"""
+
+import time
+import random
+import typing
+import asyncio
+import logging
+
+import aiohttp
+import discord
+from discord import ChannelType
+from sqlmodel import select
+from sqlalchemy import update, delete
+from el.observable import filters
+
+from compass_app import metrics
+from .tables import AccountabilityPeriod, AccountabilityOutbox, OutboundKind
+from .index import ThreadRole
+from .journal import PeriodEvent, PeriodEventKind
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+T = typing.TypeVar("T")
+
+
+def thread_name(kind: OutboundKind, week: int) -> str:
+    match kind:
+        case OutboundKind.GOAL_THREAD:
+            return f"Week {week} Accountability Setting 🎯"
+        case OutboundKind.RESULT_THREAD:
+            return f"Week {week} Accountability Check In ✅❌"
+    raise ValueError(f"{kind} doesn't create a thread")
+
+
+def thread_announcement(kind: OutboundKind, week: int, year: int) -> str:
+    match kind:
+        case OutboundKind.GOAL_THREAD:
+            return f"""
+                ## :information_source:  Tell us about the goals you want to be held accountable for by the community in week {week} of {year} (1 message per user only).
+
+                ## :sunny:  Whether you want to take a break, keep the same habit or start a new initiative the community accountability is here for you.
+                """
+        case OutboundKind.RESULT_THREAD:
+            return f"""
+                ## :information_source:  How was week {week} for you? Tell us about the results for your goals using the :white_check_mark: symbol for success or the :x: symbol for failure. You can use more than one if you had multiple goals.
+                """
+    raise ValueError(f"{kind} doesn't create a thread")
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether an error of a discord call may go away by retrying it"""
+    if isinstance(error, discord.HTTPException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, OSError, TimeoutError))
+
+
+class OutboundQueue:
+    """
+    Performs the discord side effects of accountability changes (creating
+    and deleting threads) outside of DB transactions.
+
+    Changes record their side effects as `AccountabilityOutbox` rows in
+    their own transaction and submit them here after committing. Up to
+    `accountability_outbound_concurrency` actions are performed in parallel
+    and every route (e.g. thread creation) is limited to
+    `accountability_outbound_route_concurrency` concurrent requests, so a
+    burst of actions doesn't run into discord's rate limits all at once.
+
+    discord.py already waits out 429s it is told about, so failures that
+    reach us mean discord is unavailable. Transient failures are retried
+    with jittered exponential backoff up to `accountability_outbound_retry_cap`
+    seconds, other failures (e.g. missing permissions) every
+    `accountability_outbound_retry_cap` seconds until they succeed. An
+    action is only removed from the outbox once it is done, so pending
+    actions are picked up again after a restart.
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        self._queue = asyncio.Queue[int]()
+        # actions that are queued or waiting for a retry and the ones being performed
+        self._scheduled: set[int] = set()
+        self._active: set[int] = set()
+        self._retries: dict[int, asyncio.TimerHandle] = {}
+        self._attempts: dict[int, int] = {}
+        # callers waiting for the result of an action
+        self._waiters: dict[int, asyncio.Future] = {}
+        self._routes: dict[str, asyncio.Semaphore] = {}
+
+    @property
+    def pending(self) -> int:
+        """Number of actions that are not done yet"""
+        return len(self._scheduled | self._active)
+
+    def submit(self, action_id: int) -> asyncio.Future:
+        """
+        Queues an outbox action that has been committed.
+
+        Returns
+        -------
+        asyncio.Future
+            Resolves to the result of the action once it is done (the created
+            thread or None) or to the first non-transient error. Transient
+            errors are retried without resolving it.
+        """
+        future = self._waiters.get(action_id)
+        if future is None:
+            future = self._waiters[action_id] = asyncio.get_running_loop().create_future()
+        self._schedule(action_id, 0)
+        return future
+
+    async def wait(self, future: asyncio.Future) -> typing.Any:
+        """
+        Waits for the result of a submitted action for up to
+        `accountability_outbound_wait` seconds.
+
+        Raises
+        ------
+        TimeoutError
+            The action is not done yet, it is still retried in the background
+        """
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(future),
+                self._app.settings.accountability_outbound_wait
+            )
+        except TimeoutError:
+            # nobody is going to look at the result anymore
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            raise
+
+    def _schedule(self, action_id: int, delay: float) -> None:
+        if action_id in self._scheduled:
+            return
+        self._scheduled.add(action_id)
+        if delay <= 0:
+            self._queue.put_nowait(action_id)
+        else:
+            self._retries[action_id] = asyncio.get_running_loop().call_later(
+                delay, self._queue.put_nowait, action_id
+            )
+
+    async def run(self) -> None:
+        exited = asyncio.Event()
+        self._app.exited >> filters.call_if_true(exited.set)
+
+        # actions left over from the last run
+        try:
+            async with self._app.db.read_session() as session:
+                actions = (await session.exec(select(AccountabilityOutbox))).all()
+            for action in actions:
+                self._attempts[action.id] = action.attempts
+                self._schedule(action.id, 0)
+            if len(actions) > 0:
+                _log.info(f"Resuming {len(actions)} pending accountability discord actions")
+        except Exception as e:
+            _log.error(f"Failed to load pending accountability discord actions: {e}", exc_info=e)
+
+        workers = [
+            asyncio.create_task(self._worker())
+            for _ in range(self._app.settings.accountability_outbound_concurrency)
+        ]
+        await exited.wait()
+
+        # anything not done stays in the outbox for the next start
+        left = self.pending
+        for retry in self._retries.values():
+            retry.cancel()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if left > 0:
+            _log.info(f"{left} accountability discord actions are left for the next start")
+
+    async def _worker(self) -> None:
+        while True:
+            action_id = await self._queue.get()
+            self._scheduled.discard(action_id)
+            self._retries.pop(action_id, None)
+            if action_id in self._active:
+                # already being performed, which resolves the waiters as well
+                continue
+            self._active.add(action_id)
+            try:
+                result = await self._perform(action_id)
+            except Exception as e:
+                await self._failed(action_id, e)
+            else:
+                metrics.OUTBOUND_ACTIONS.labels("done").inc()
+                self._attempts.pop(action_id, None)
+                future = self._waiters.pop(action_id, None)
+                if future is not None and not future.done():
+                    future.set_result(result)
+            finally:
+                self._active.discard(action_id)
+
+    async def _failed(self, action_id: int, error: Exception) -> None:
+        attempts = self._attempts[action_id] = self._attempts.get(action_id, 0) + 1
+        cap = self._app.settings.accountability_outbound_retry_cap
+        metrics.OUTBOUND_ACTIONS.labels("failed").inc()
+        if is_transient(error):
+            # half of the backoff is random, so actions that failed together don't retry together
+            backoff = min(cap, self._app.settings.accountability_outbound_retry_base * 2 ** (attempts - 1))
+            delay = backoff / 2 + random.uniform(0, backoff / 2)
+            _log.warning(f"Accountability discord action {action_id} failed (attempt {attempts}), retrying in {delay:.1f}s: {error}")
+        else:
+            delay = cap
+            _log.error(f"Accountability discord action {action_id} failed (attempt {attempts}), retrying in {delay:.0f}s: {error}", exc_info=error)
+            future = self._waiters.pop(action_id, None)
+            if future is not None and not future.done():
+                future.set_exception(error)
+
+        try:
+            async with self._app.db.session() as session:
+                await session.execute(
+                    update(AccountabilityOutbox)
+                    .where(AccountabilityOutbox.id == action_id)
+                    .values(attempts=attempts, last_error=str(error))
+                )
+        except Exception as e:
+            _log.warning(f"Failed to record failure of accountability discord action {action_id}: {e}")
+        self._schedule(action_id, delay)
+
+    async def _call(self, route: str, request: typing.Awaitable[T]) -> T:
+        """Performs a discord request, limiting the concurrent requests per route"""
+        semaphore = self._routes.get(route)
+        if semaphore is None:
+            semaphore = self._routes[route] = asyncio.Semaphore(
+                self._app.settings.accountability_outbound_route_concurrency
+            )
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                return await request
+            finally:
+                metrics.OUTBOUND_CALL_SECONDS.labels(route).observe(time.perf_counter() - started)
+
+    async def _perform(self, action_id: int) -> discord.Thread | None:
+        async with self._app.db.read_session() as session:
+            action = await session.get(AccountabilityOutbox, action_id)
+        if action is None:
+            # the period of the action has been reset in the meantime
+            return None
+
+        await self._app.bot.wait_until_logged_in()
+        match action.kind:
+            case OutboundKind.GOAL_THREAD | OutboundKind.RESULT_THREAD:
+                return await self._create_thread(action)
+            case OutboundKind.DELETE_THREAD:
+                await self._delete_thread(action)
+                return None
+
+    async def _create_thread(self, action: AccountabilityOutbox) -> discord.Thread | None:
+        async with self._app.db.read_session() as session:
+            period = await session.get(AccountabilityPeriod, action.period_id)
+        if period is None:
+            return None
+        bot = self._app.bot
+
+        # a thread created by an earlier attempt is reused
+        thread = None
+        if action.channel_id is not None:
+            try:
+                thread = await self._call("get_channel", bot.get_or_fetch_channel(action.channel_id))
+            except discord.NotFound:
+                pass
+        if thread is None:
+            channel = await self._call(
+                "get_channel", bot.get_or_fetch_channel(self._app.config.accountability_channel_id)
+            )
+            thread = await self._call("create_thread", channel.create_thread(
+                name=thread_name(action.kind, period.week),
+                type=ChannelType.public_thread
+            ))
+            # remember the thread right away, so a retry doesn't create another one
+            async with self._app.db.session() as session:
+                await session.execute(
+                    update(AccountabilityOutbox)
+                    .where(AccountabilityOutbox.id == action.id)
+                    .values(channel_id=thread.id)
+                )
+        # the announcement is only missing if an earlier attempt failed to send it
+        if thread.last_message_id is None:
+            await self._call("send_message", thread.send(
+                thread_announcement(action.kind, period.week, period.year)
+            ))
+
+        if action.kind is OutboundKind.GOAL_THREAD:
+            column, role, event_kind = AccountabilityPeriod.goal_channel_id, ThreadRole.GOAL, PeriodEventKind.START
+        else:
+            column, role, event_kind = AccountabilityPeriod.result_channel_id, ThreadRole.RESULT, PeriodEventKind.END
+        async with self._app.db.session() as session:
+            attached = (await session.execute(
+                update(AccountabilityPeriod)
+                .where(AccountabilityPeriod.id == period.id, column.is_(None))
+                .values({column: thread.id})
+            )).rowcount
+            await session.execute(
+                delete(AccountabilityOutbox).where(AccountabilityOutbox.id == action.id)
+            )
+            if attached == 0:
+                # the period was reset while we were creating the thread
+                cleanup = AccountabilityOutbox(kind=OutboundKind.DELETE_THREAD, channel_id=thread.id)
+                session.add(cleanup)
+                await session.flush()
+
+        if attached == 0:
+            _log.warning(f"Accountability period {period.id} no longer exists, deleting its new thread {thread.id}")
+            self._schedule(cleanup.id, 0)
+            return None
+
+        # only route messages to the period once the thread is committed
+        setattr(period, column.key, thread.id)
+        self._app.accountability.threads.add_period(period)
+        self._app.accountability.versions.periods_changed([period.id])
+        self._app.accountability.journal.append(PeriodEvent(event_kind, period.year, period.week, thread.id))
+        _log.info(f"Created accountability {role.value} thread for week {period.week} of {period.year}")
+        return thread
+
+    async def _delete_thread(self, action: AccountabilityOutbox) -> None:
+        bot = self._app.bot
+        # threads or messages that are gone already count as deleted
+        try:
+            thread = await self._call("get_channel", bot.get_or_fetch_channel(action.channel_id))
+            await self._call("delete_channel", thread.delete())
+        except discord.NotFound:
+            pass
+        # the starter message has the same ID as the thread, so it can be deleted without fetching anything
+        channel = bot.get_partial_messageable(self._app.config.accountability_channel_id)
+        try:
+            await self._call("delete_message", channel.get_partial_message(action.channel_id).delete())
+        except discord.NotFound:
+            pass
+
+        async with self._app.db.session() as session:
+            await session.execute(
+                delete(AccountabilityOutbox).where(AccountabilityOutbox.id == action.id)
+            )
+        _log.info(f"Deleted accountability thread {action.channel_id}")
@@ -0,0 +1,157 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 16:30
+
+Scoring of accountability results.
+
+Scores are materialized into the `accountability_score` (per user and
+period) and `accountability_user_score` (per user) tables, so leaderboards
+and streaks are plain index reads. Whenever a result is recorded, edited or
+deleted, the scores of the affected users are recomputed with a few set-based
+statements. A full recompute uses the same statements without user filter.
+
+A user scores one point per success in a period. The streak of a period
+score is the number of consecutive periods (in week order, across all
+periods that exist) with a result of the user, ending with that period.
+"""
+
+import typing
+import logging
+
+from sqlalchemy import text, bindparam
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+# consecutive numbering of all periods in week order
+_PERIOD_SEQUENCE = """
+    seq AS (
+        SELECT id, ROW_NUMBER() OVER (ORDER BY year, week) AS n
+        FROM accountability_period
+    )
+"""
+
+# Period scores. Consecutive periods of a user have the same difference between
+# the period number and the user's running result number, so that difference
+# groups them into streaks (gaps and islands).
+INSERT_PERIOD_SCORES = f"""
+    WITH {_PERIOD_SEQUENCE},
+    scored AS (
+        SELECT
+            e.user_id, e.period_id, r.success_count, r.fail_count, seq.n,
+            seq.n - ROW_NUMBER() OVER (PARTITION BY e.user_id ORDER BY seq.n) AS grp
+        FROM accountability_entry e
+        JOIN accountability_result r ON r.id = e.result_id
+        JOIN seq ON seq.id = e.period_id
+        {{where}}
+    )
+    INSERT INTO accountability_score (user_id, period_id, success_count, fail_count, points, streak)
+    SELECT
+        user_id, period_id, success_count, fail_count, success_count,
+        ROW_NUMBER() OVER (PARTITION BY user_id, grp ORDER BY n)
+    FROM scored
+"""
+
+# user totals aggregated from the period scores
+INSERT_USER_SCORES = f"""
+    WITH {_PERIOD_SEQUENCE},
+    ranked AS (
+        SELECT
+            s.*,
+            ROW_NUMBER() OVER (PARTITION BY s.user_id ORDER BY seq.n DESC) AS recency
+        FROM accountability_score s
+        JOIN seq ON seq.id = s.period_id
+        {{where}}
+    )
+    INSERT INTO accountability_user_score (
+        user_id, total_points, success_count, fail_count, periods,
+        best_streak, last_period_id, last_streak
+    )
+    SELECT
+        user_id, SUM(points), SUM(success_count), SUM(fail_count), COUNT(*),
+        MAX(streak),
+        MAX(CASE WHEN recency = 1 THEN period_id END),
+        MAX(CASE WHEN recency = 1 THEN streak END)
+    FROM ranked
+    GROUP BY user_id
+"""
+
+
+class ScoringEngine:
+    """
+    Maintains the materialized accountability scores.
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        # called with the affected user IDs (None for all users) after scores are committed
+        self._listeners: list[typing.Callable[[set[int] | None], None]] = []
+
+    def add_listener(self, listener: typing.Callable[[set[int] | None], None]) -> None:
+        """
+        Registers a function that is called after scores have changed,
+        e.g. to invalidate caches.
+        """
+        self._listeners.append(listener)
+
+    def notify(self, user_ids: set[int] | None) -> None:
+        """
+        Informs listeners that the scores of some users (or all users if None)
+        have changed. This must be called after the transaction that
+        updated the scores was committed.
+        """
+        for listener in self._listeners:
+            try:
+                listener(user_ids)
+            except Exception as e:
+                _log.error(f"Score listener failed: {e}", exc_info=e)
+
+    @staticmethod
+    async def update_users(session: AsyncSession, user_ids: typing.Collection[int]) -> None:
+        """
+        Recomputes all scores of some users within an existing transaction.
+        This is used when results of the users have changed and only touches
+        their own rows.
+        """
+        if len(user_ids) == 0:
+            return
+        params = {"users": list(user_ids)}
+        def filtered(sql: str, column: str):
+            return text(sql.format(where=f"WHERE {column} IN :users")).bindparams(
+                bindparam("users", expanding=True)
+            )
+
+        await session.execute(
+            filtered("DELETE FROM accountability_score {where}", "user_id"), params
+        )
+        await session.execute(filtered(INSERT_PERIOD_SCORES, "e.user_id"), params)
+        await session.execute(
+            filtered("DELETE FROM accountability_user_score {where}", "user_id"), params
+        )
+        await session.execute(filtered(INSERT_USER_SCORES, "s.user_id"), params)
+
+    @staticmethod
+    async def recompute_all(session: AsyncSession) -> None:
+        """
+        Rebuilds the scores of all users from the recorded results
+        within an existing transaction.
+        """
+        await session.execute(text("DELETE FROM accountability_score"))
+        await session.execute(text(INSERT_PERIOD_SCORES.format(where="")))
+        await session.execute(text("DELETE FROM accountability_user_score"))
+        await session.execute(text(INSERT_USER_SCORES.format(where="")))
+
+    async def recompute(self) -> None:
+        """
+        Rebuilds all scores in a new transaction, e.g. to reconcile
+        after periods were reset or results were changed manually.
+        """
+        async with self._app.db.session() as session:
+            await self.recompute_all(session)
+        _log.info("Recomputed all accountability scores")
+        self.notify(None)
@@ -0,0 +1,283 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 17:20
+
+Aggregate queries on the accountability scores for leaderboards
+and personal stats, with a cache for their rendered results.
+"""
+
+import time
+import typing
+import asyncio
+import logging
+import dataclasses
+
+from sqlmodel import select, func
+
+from compass_app.database import CompassUser
+from .tables import AccountabilityPeriod, AccountabilityResult, AccountabilityScore, AccountabilityUserScore
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(slots=True)
+class LeaderboardRow:
+    rank: int
+    discord_id: int
+    username: str
+    points: int
+    success_count: int
+    fail_count: int
+    # best streak for the all-time leaderboard, streak in the period otherwise
+    streak: int
+
+
+@dataclasses.dataclass(slots=True)
+class PeriodStats:
+    year: int
+    week: int
+    success_count: int
+    fail_count: int
+    points: int
+    streak: int
+
+
+@dataclasses.dataclass(slots=True)
+class UserStats:
+    user_id: int
+    username: str
+    rank: int
+    total_points: int
+    success_count: int
+    fail_count: int
+    periods: int
+    current_streak: int
+    best_streak: int
+    # most recent periods first
+    history: list[PeriodStats]
+
+    @property
+    def ratio(self) -> float:
+        return AccountabilityResult.completion_ratio(self.success_count, self.fail_count)
+
+
+@dataclasses.dataclass(slots=True)
+class _CacheEntry:
+    value: typing.Any
+    expires: float
+    # DB user the value belongs to or None if it depends on all users
+    user_id: int | None
+
+
+class StatsCache:
+    """
+    TTL cache for values derived from the scores, e.g. rendered embeds.
+
+    Entries are dropped when the scores of their user change (or of any user
+    for entries that don't belong to a single user). Concurrent requests for
+    a missing key share a single build.
+    """
+
+    def __init__(self, ttl: typing.Callable[[], float]):
+        self._ttl = ttl
+        self._entries: dict[typing.Hashable, _CacheEntry] = {}
+        self._building: dict[typing.Hashable, asyncio.Future] = {}
+        # incremented by every invalidation, so builds that started before are not stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(
+        self,
+        key: typing.Hashable,
+        build: typing.Callable[[], typing.Awaitable[tuple[typing.Any, int | None]]],
+    ) -> typing.Any:
+        """
+        Returns the cached value of a key or builds it if it is missing or expired.
+
+        Parameters
+        ----------
+        key : Hashable
+            cache key
+        build : () -> Awaitable[(value, user_id)]
+            creates the value and returns it together with the DB user ID
+            it belongs to (None if it depends on all users)
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires > time.monotonic():
+            self.hits += 1
+            return entry.value
+        self.misses += 1
+
+        pending = self._building.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._building[key] = future
+        generation = self._generation
+        try:
+            value, user_id = await build()
+        except BaseException as e:
+            # waiters get cancellations as well, otherwise they would wait forever
+            future.set_exception(e)
+            # mark as retrieved, as there may be nobody else waiting for it
+            future.exception()
+            raise
+        finally:
+            del self._building[key]
+
+        if generation == self._generation:
+            self._entries[key] = _CacheEntry(value, time.monotonic() + self._ttl(), user_id)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, user_ids: typing.Collection[int] | None = None) -> None:
+        """Drops the entries of some users and all shared entries, or everything if None"""
+        self._generation += 1
+        if user_ids is None:
+            self._entries.clear()
+            return
+        now = time.monotonic()
+        self._entries = {
+            key: entry for key, entry in self._entries.items()
+            if entry.expires > now
+            and entry.user_id is not None
+            and entry.user_id not in user_ids
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class AccountabilityStats:
+    """
+    Read-only queries on the materialized scores. All of them
+    are index reads on the score tables.
+    """
+
+    # number of recent periods in the personal stats
+    HISTORY_LENGTH = 5
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        # rendered results, invalidated by the scoring engine
+        self.cache = StatsCache(lambda: self._app.settings.accountability_stats_cache_ttl)
+
+    async def leaderboard(self, limit: int = 10) -> list[LeaderboardRow]:
+        """Returns the users with the most points of all time"""
+        async with self._app.db.read_session() as session:
+            rows = (await session.exec(
+                select(
+                    CompassUser.discord_id,
+                    CompassUser.username,
+                    AccountabilityUserScore.total_points,
+                    AccountabilityUserScore.success_count,
+                    AccountabilityUserScore.fail_count,
+                    AccountabilityUserScore.best_streak,
+                )
+                .join(CompassUser, CompassUser.id == AccountabilityUserScore.user_id)
+                .order_by(AccountabilityUserScore.total_points.desc())
+                .limit(limit)
+            )).all()
+        return [LeaderboardRow(rank, *row) for rank, row in enumerate(rows, start=1)]
+
+    async def period_leaderboard(self, week: int, year: int, limit: int = 10) -> list[LeaderboardRow]:
+        """
+        Returns the users with the most points in a period.
+
+        Raises
+        ------
+        IndexError
+            There is no period for this week
+        """
+        async with self._app.db.read_session() as session:
+            period_id = (await session.exec(
+                select(AccountabilityPeriod.id).where(
+                    AccountabilityPeriod.week == week,
+                    AccountabilityPeriod.year == year,
+                )
+            )).one_or_none()
+            if period_id is None:
+                raise IndexError("Period doesn't exist")
+            rows = (await session.exec(
+                select(
+                    CompassUser.discord_id,
+                    CompassUser.username,
+                    AccountabilityScore.points,
+                    AccountabilityScore.success_count,
+                    AccountabilityScore.fail_count,
+                    AccountabilityScore.streak,
+                )
+                .join(CompassUser, CompassUser.id == AccountabilityScore.user_id)
+                .where(AccountabilityScore.period_id == period_id)
+                .order_by(AccountabilityScore.points.desc())
+                .limit(limit)
+            )).all()
+        return [LeaderboardRow(rank, *row) for rank, row in enumerate(rows, start=1)]
+
+    async def user_stats(self, discord_id: int) -> UserStats | None:
+        """Returns the stats of a member or None if they have never checked in"""
+        async with self._app.db.read_session() as session:
+            row = (await session.exec(
+                select(CompassUser.username, AccountabilityUserScore)
+                .join(CompassUser, CompassUser.id == AccountabilityUserScore.user_id)
+                .where(CompassUser.discord_id == discord_id)
+            )).one_or_none()
+            if row is None:
+                return None
+            username, score = row
+
+            rank = 1 + (await session.exec(
+                select(func.count()).where(AccountabilityUserScore.total_points > score.total_points)
+            )).one()
+
+            history = [
+                PeriodStats(*row) for row in (await session.exec(
+                    select(
+                        AccountabilityPeriod.year,
+                        AccountabilityPeriod.week,
+                        AccountabilityScore.success_count,
+                        AccountabilityScore.fail_count,
+                        AccountabilityScore.points,
+                        AccountabilityScore.streak,
+                    )
+                    .join(AccountabilityPeriod, AccountabilityPeriod.id == AccountabilityScore.period_id)
+                    .where(AccountabilityScore.user_id == score.user_id)
+                    .order_by(AccountabilityPeriod.year.desc(), AccountabilityPeriod.week.desc())
+                    .limit(self.HISTORY_LENGTH)
+                )).all()
+            ]
+
+            # the streak is only still going if the user checked in for the latest ended period
+            latest_ended = (await session.exec(
+                select(AccountabilityPeriod.year, AccountabilityPeriod.week)
+                .where(AccountabilityPeriod.result_channel_id != None)
+                .order_by(AccountabilityPeriod.year.desc(), AccountabilityPeriod.week.desc())
+                .limit(1)
+            )).one_or_none()
+
+        current_streak = score.last_streak
+        if (
+            latest_ended is not None
+            and len(history) > 0
+            and (history[0].year, history[0].week) < tuple(latest_ended)
+        ):
+            current_streak = 0
+
+        return UserStats(
+            user_id=score.user_id,
+            username=username,
+            rank=rank,
+            total_points=score.total_points,
+            success_count=score.success_count,
+            fail_count=score.fail_count,
+            periods=score.periods,
+            current_streak=current_streak,
+            best_streak=score.best_streak,
+            history=history,
+        )
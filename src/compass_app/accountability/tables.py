@@ -6,19 +6,28 @@ www.thecompass.diy
 database tables for accountability tracking
 """
 
+import enum
+import typing
 from typing import Optional
 
 import discord
 from datetime import date, datetime, timezone, timedelta
 from sqlmodel import SQLModel, Field, Relationship, BigInteger, select
 from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import Index, func
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.asyncio import AsyncAttrs
 
+from compass_app import weeks
 from compass_app.database import CompassUser
 
 
 class AccountabilityPeriod(SQLModel, table=True):
     __tablename__ = "accountability_period"
+    __table_args__ = (
+        # there can only be one period per week
+        Index("ix_accountability_period_year_week", "year", "week", unique=True),
+    )
     id: int = Field(primary_key=True)
 
     year: int
@@ -26,8 +35,8 @@ class AccountabilityPeriod(SQLModel, table=True):
     period_start: date
     period_end: date
 
-    goal_channel_id: int | None = Field(sa_type=BigInteger, default=None)
-    result_channel_id: int | None = Field(sa_type=BigInteger, default=None)
+    goal_channel_id: int | None = Field(sa_type=BigInteger, default=None, index=True)
+    result_channel_id: int | None = Field(sa_type=BigInteger, default=None, index=True)
 
     entries: list["AccountabilityEntry"] = Relationship(back_populates="period", cascade_delete=True)
 
@@ -39,49 +48,23 @@ class AccountabilityPeriod(SQLModel, table=True):
     ):
         """
         Creates a new accountability period for the specified 
-        calendar week or the current one.
+        compass calendar week.
         """
-        
-        # TODO: Fix this absolute bullshit of US year calculations.
-        # This current botch might not even work for 2026 or any other
-        # year than 2025, I don't even know. These fucking US weeks seem
-        # to be impossible to calculate arrrr.... there doesn't even seem to be
-        # a proper standard, some websites give an answer similar to ISO but with sunday
-        # as first, others give one week earlier, and nothing makes any sense.
-        # https://support.claris.com/s/article/ISO-Week-Number-Calculation-1503692914822?language=en_US
-        # https://savvytime.com/current-week
-        # https://chatgpt.com/share/68db1ce1-f96c-8001-b841-e3010c0aa1db
-        # https://chatgpt.com/share/68db1cf2-4730-8001-b865-5052c50739e7
-        # For compass we need the weird week where sunday is first day and
-        # Sunday Jan. 5th 2025 is the first day of week 1 anyway, whatever
-        # standard that is and the following is working for 2025.
-        jan1 = datetime(year, 1, 1)
-        # Find the Sunday on or before Jan 1
-        days_to_sunday = jan1.weekday() + 1  # weekday(): Mon=0, Sun=6
-        first_sunday = jan1 - timedelta(days=days_to_sunday % 7)
-        
-        # Calculate start and end dates of the requested week
-        start_date = first_sunday + timedelta(weeks=week)
-        end_date = start_date + timedelta(days=6)
-
-        #today = date.today()
-        ## weekday(): Monday=0 ... Sunday=6
-        #weekday = today.weekday()
-        ## find Sunday (start of week in US style)
-        #sunday = today - datetime.timedelta(days=(weekday + 1) % 7)
-        ## the next Saturday (end of week) is 6 days after Sunday
-        #saturday = sunday + datetime.timedelta(days=6)
-        
+        compass_week = weeks.week(year, week)
         return AccountabilityPeriod(
             year=year,
             week=week,
-            period_start=start_date.date(),
-            period_end=end_date.date(),
+            period_start=compass_week.start,
+            period_end=compass_week.end,
         )
 
 
 class AccountabilityEntry(AsyncAttrs, SQLModel, table=True):
     __tablename__ = "accountability_entry"
+    __table_args__ = (
+        # every user has at most one entry per period, also needed for upserts
+        Index("ix_accountability_entry_user_period", "user_id", "period_id", unique=True),
+    )
     id: int = Field(primary_key=True)
 
     user_id: int = Field(foreign_key="compass_user.id", ondelete="CASCADE")
@@ -98,26 +81,42 @@ class AccountabilityEntry(AsyncAttrs, SQLModel, table=True):
     result: Optional["AccountabilityResult"] = Relationship(back_populates="entry", cascade_delete=True, sa_relationship_kwargs={"single_parent": True})
 
     @classmethod
-    async def get_or_create(
+    async def upsert(
         cls, 
         session: AsyncSession,
-        period: AccountabilityPeriod,
-        user: CompassUser,
-    ):
-        """Gets or creates an entry matching a user and period"""
-        entry = await session.scalar(
-            select(AccountabilityEntry).where(
-                AccountabilityEntry.user == user,
-                AccountabilityEntry.period == period
-            )
+        user_id: int,
+        period_id: int,
+        goal_id: int | None = None,
+        result_id: int | None = None,
+    ) -> tuple[int, int | None, int | None]:
+        """
+        Creates the entry matching a user and period or updates the existing one
+        in a single statement. An existing goal or result is never replaced,
+        so the first one recorded wins.
+
+        Returns
+        -------
+        tuple[int, int | None, int | None]
+            ID, goal ID and result ID of the entry after the upsert
+        """
+        stmt = insert(AccountabilityEntry).values(
+            user_id=user_id,
+            period_id=period_id,
+            goal_id=goal_id,
+            result_id=result_id,
         )
-        if entry is None:
-            entry = AccountabilityEntry(
-                user=user,
-                period=period,
-            )
-            session.add(entry)
-        return entry
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[AccountabilityEntry.user_id, AccountabilityEntry.period_id],
+            set_={
+                "goal_id": func.coalesce(AccountabilityEntry.goal_id, stmt.excluded.goal_id),
+                "result_id": func.coalesce(AccountabilityEntry.result_id, stmt.excluded.result_id),
+            }
+        ).returning(
+            AccountabilityEntry.id,
+            AccountabilityEntry.goal_id,
+            AccountabilityEntry.result_id,
+        )
+        return tuple((await session.execute(stmt)).one())
 
 
 class AccountabilityGoal(SQLModel, table=True):
@@ -133,6 +132,10 @@ class AccountabilityGoal(SQLModel, table=True):
 
 class AccountabilityResult(SQLModel, table=True):
     __tablename__ = "accountability_result"
+    # the discord or unicode representation of the emojis
+    SUCCESS_TOKENS: typing.ClassVar[tuple[str, ...]] = (":white_check_mark:", "✅")
+    FAIL_TOKENS: typing.ClassVar[tuple[str, ...]] = (":x:", "❌")
+
     id: int = Field(primary_key=True)
     
     message_id: int = Field(sa_type=BigInteger, default=None, index=True)
@@ -143,20 +146,151 @@ class AccountabilityResult(SQLModel, table=True):
 
     entry: AccountabilityEntry = Relationship(back_populates="result")
 
+    @classmethod
+    def count(cls, text: str) -> tuple[int, int]:
+        """Counts the successes and fails in a result text"""
+        return (
+            sum(text.count(token) for token in cls.SUCCESS_TOKENS),
+            sum(text.count(token) for token in cls.FAIL_TOKENS),
+        )
+
+    @classmethod
+    def count_sql(cls, column) -> tuple[typing.Any, typing.Any]:
+        """
+        SQL expressions counting the successes and fails in a text column
+        the same way as `count()`, for updating many rows in one statement
+        """
+        def occurrences(token: str):
+            # the length difference after removing all occurrences, in characters
+            return (func.length(column) - func.length(func.replace(column, token, ""))) // len(token)
+        return (
+            sum((occurrences(token) for token in cls.SUCCESS_TOKENS[1:]), occurrences(cls.SUCCESS_TOKENS[0])),
+            sum((occurrences(token) for token in cls.FAIL_TOKENS[1:]), occurrences(cls.FAIL_TOKENS[0])),
+        )
+
     def update_count(self) -> None:
         """Updates success and fail count from text"""
-        self.success_count = 0
-        self.fail_count = 0
-        # count both the discord or unicode representation of the emojis 
-        self.success_count += self.text.count(":white_check_mark:")
-        self.success_count += self.text.count("✅")
-        self.fail_count += self.text.count(":x:")
-        self.fail_count += self.text.count("❌")
+        self.success_count, self.fail_count = self.count(self.text)
+
+    @staticmethod
+    def completion_ratio(success_count: int, fail_count: int) -> float:
+        """Share of successes in all reported goals, 0 if nothing was reported"""
+        total = success_count + fail_count
+        return success_count / total if total > 0 else 0
 
     @property
     def ratio(self) -> float:
-        return (
-            (self.success_count / (self.success_count + self.fail_count))
-            if self.fail_count > 0 
-            else 0
-        )
\ No newline at end of file
+        return self.completion_ratio(self.success_count, self.fail_count)
+
+
+class AccountabilityScore(SQLModel, table=True):
+    """
+    Materialized score of a user in a period, maintained by the scoring engine.
+    There is only a row if the user checked in with a result in the period.
+    """
+    __tablename__ = "accountability_score"
+    __table_args__ = (
+        # period leaderboards
+        Index("ix_accountability_score_period_points", "period_id", "points"),
+    )
+
+    user_id: int = Field(foreign_key="compass_user.id", ondelete="CASCADE", primary_key=True)
+    period_id: int = Field(foreign_key="accountability_period.id", ondelete="CASCADE", primary_key=True)
+
+    success_count: int = 0
+    fail_count: int = 0
+    points: int = 0
+    # number of consecutive periods with a result, ending with this one
+    streak: int = 0
+
+
+class AccountabilityUserScore(SQLModel, table=True):
+    """
+    Materialized all-time totals of a user, maintained by the scoring engine
+    from the user's period scores.
+    """
+    __tablename__ = "accountability_user_score"
+
+    user_id: int = Field(foreign_key="compass_user.id", ondelete="CASCADE", primary_key=True)
+
+    total_points: int = Field(default=0, index=True)
+    success_count: int = 0
+    fail_count: int = 0
+    # number of periods with a result
+    periods: int = 0
+    best_streak: int = Field(default=0, index=True)
+    # latest period with a result and the streak in it
+    last_period_id: int | None = Field(foreign_key="accountability_period.id", default=None, ondelete="SET NULL")
+    last_streak: int = 0
+
+
+class AccountabilityCheckpoint(SQLModel, table=True):
+    """
+    Newest message of an accountability thread that has been recorded, so
+    messages missed while the bot was disconnected can be fetched after it.
+    """
+    __tablename__ = "accountability_checkpoint"
+
+    thread_id: int = Field(sa_type=BigInteger, primary_key=True)
+    message_id: int = Field(sa_type=BigInteger)
+
+    @classmethod
+    async def advance(cls, session: AsyncSession, thread_id: int, message_id: int) -> None:
+        """Moves the checkpoint of a thread forward to a message, never backwards"""
+        stmt = insert(AccountabilityCheckpoint).values(thread_id=thread_id, message_id=message_id)
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[AccountabilityCheckpoint.thread_id],
+            set_={"message_id": func.max(AccountabilityCheckpoint.message_id, stmt.excluded.message_id)}
+        ))
+
+
+class OutboundKind(enum.Enum):
+    GOAL_THREAD = "goal_thread"
+    RESULT_THREAD = "result_thread"
+    DELETE_THREAD = "delete_thread"
+
+
+class AccountabilityOutbox(SQLModel, table=True):
+    """
+    Discord side effect of an accountability change that is still to be
+    carried out. It is added in the same transaction as the change and
+    removed once the outbound queue has performed it.
+    """
+    __tablename__ = "accountability_outbox"
+    __table_args__ = (
+        # a period can only have one pending thread of every kind
+        Index("ix_accountability_outbox_period_kind", "period_id", "kind", unique=True),
+    )
+    id: int = Field(primary_key=True)
+
+    kind: OutboundKind
+    # period to create a thread for, pending creations are dropped with their period
+    period_id: int | None = Field(foreign_key="accountability_period.id", default=None, ondelete="CASCADE")
+    # thread to delete or the thread that has been created but is not attached yet
+    channel_id: int | None = Field(sa_type=BigInteger, default=None)
+
+    attempts: int = 0
+    last_error: str | None = None
+    date_created: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class AccountabilityImportProgress(SQLModel, table=True):
+    """
+    Progress of a bulk import of a file, updated in the transaction of
+    every imported chunk, so an interrupted import continues after the
+    last committed row.
+    """
+    __tablename__ = "accountability_import_progress"
+    id: int = Field(primary_key=True)
+
+    # absolute path, size and modification time identify the imported file
+    source: str = Field(index=True)
+    size: int
+    mtime_ns: int
+
+    # rows of the file processed so far, including the skipped ones
+    rows_done: int = 0
+    rows_imported: int = 0
+    rows_skipped: int = 0
+    finished: bool = False
+    date_created: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -0,0 +1,52 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+19.10.26, 05:00
+
+In-memory version counters of the accountability data, used as ETags
+by the read API so unchanged data is never queried again.
+"""
+
+import typing
+import secrets
+
+
+class DataVersions:
+    """
+    Counters that are incremented after every committed change of the
+    accountability data:
+     - per period, when the period or any of its entries changes
+     - `periods`, when any period is created, changed or deleted
+     - `entries`, when any entry, goal or result changes
+
+    The counters start over on every start of the app, so ETags also
+    contain a random boot ID that makes tags of a previous run invalid.
+    Versions must be read before the data is queried, so a change that
+    is committed in between can only make the tag older than the data,
+    never newer.
+    """
+
+    def __init__(self) -> None:
+        self.boot_id = secrets.token_hex(8)
+        self._periods: dict[int, int] = {}
+        self.periods = 0
+        self.entries = 0
+
+    def period(self, period_id: int) -> int:
+        return self._periods.get(period_id, 0)
+
+    def periods_changed(self, period_ids: typing.Iterable[int]) -> None:
+        """Marks periods as changed that have been created, updated or deleted"""
+        for period_id in period_ids:
+            self._periods[period_id] = self._periods.get(period_id, 0) + 1
+        self.periods += 1
+
+    def entries_changed(self, period_ids: typing.Iterable[int]) -> None:
+        """Marks the entries of periods as changed"""
+        for period_id in period_ids:
+            self._periods[period_id] = self._periods.get(period_id, 0) + 1
+        self.entries += 1
+
+    def etag(self, *versions: int) -> str:
+        """Strong ETag of a response built from the provided versions"""
+        return f'"{self.boot_id}-{"-".join(str(v) for v in versions)}"'
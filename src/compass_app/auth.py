@@ -8,15 +8,22 @@ User authentication portal to access the web-app.
 
 import os
 import typing
+import asyncio
 import logging
+import dataclasses
+from datetime import datetime, timezone, timedelta
 
 import httpx
 from urllib.parse import urlencode
 from fastapi import Depends, HTTPException
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, JSONResponse
 from sqlmodel import select
+from sqlalchemy import update, or_
+from el.observable import filters
 
+from compass_app import metrics
 from compass_app.database import CompassUser
+from compass_app.sessions import SessionManager, Session, COOKIE_NAME
 
 if typing.TYPE_CHECKING:
     from compass_app.main import CompassApp
@@ -24,14 +31,301 @@ if typing.TYPE_CHECKING:
 _log = logging.getLogger(__name__)
 
 
-class CompassAuth():
+DISCORD_AUTH_URL = "https://discord.com/api/oauth2/authorize"
+DISCORD_TOKEN_URL = "https://discord.com/api/oauth2/token"
+DISCORD_API_URL = "https://discord.com/api/users/@me"
+
+
+def _utc(value: datetime) -> datetime:
+    """SQLite returns naive datetimes, which are stored in UTC"""
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+@dataclasses.dataclass
+class TokenGrant:
+    """Tokens returned by the discord OAuth token endpoint"""
+    access_token: str
+    refresh_token: str | None
+    expires_at: datetime | None
+
+    @classmethod
+    def from_response(cls, data: dict) -> "TokenGrant":
+        expires_in = data.get("expires_in")
+        return cls(
+            access_token=data["access_token"],
+            refresh_token=data.get("refresh_token"),
+            expires_at=(
+                datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+                if expires_in is not None else None
+            ),
+        )
+
+
+class TokenRejected(Exception):
+    """The token endpoint refused a grant, e.g. because the user revoked access"""
+
+
+class TokenManager:
+    """
+    Keeps the discord OAuth tokens of users valid.
+
+    Every `auth_refresh_interval` seconds, the tokens that expire within
+    `auth_refresh_margin` seconds are refreshed in batches of
+    `auth_refresh_batch_size`, with up to `auth_refresh_concurrency`
+    requests in parallel, so users don't have to log in again when their
+    access token expires. Tokens whose refresh is rejected are removed.
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        # refreshes in progress by user ID, so a token is never refreshed twice at once
+        # (discord invalidates the old refresh token on every refresh)
+        self._refreshing: dict[int, asyncio.Future[str | None]] = {}
+        self._refreshes_done = metrics.AUTH_TOKEN_REFRESHES.labels("done")
+        self._refreshes_rejected = metrics.AUTH_TOKEN_REFRESHES.labels("rejected")
+        self._refreshes_failed = metrics.AUTH_TOKEN_REFRESHES.labels("failed")
+
+    async def _request_token(self, data: dict[str, str]) -> TokenGrant:
+        """
+        Posts a grant to the discord token endpoint.
+
+        Raises
+        ------
+        TokenRejected
+            discord refused the grant
+        httpx.HTTPError
+            the request failed or discord is unavailable
+        """
+        response = await self._app.http.client.post(
+            DISCORD_TOKEN_URL,
+            data={
+                "client_id": self._app.config.discord_client_id,
+                "client_secret": self._app.config.discord_client_secret,
+                **data,
+            },
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        )
+        if response.status_code in (400, 401):
+            raise TokenRejected(response.text)
+        response.raise_for_status()
+        return TokenGrant.from_response(response.json())
+
+    async def exchange_code(self, code: str) -> TokenGrant:
+        """Exchanges the code of an OAuth redirect for the user's tokens"""
+        return await self._request_token({
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": self._app.config.discord_redirect_url,
+        })
+
+    async def access_token(self, user_id: int) -> str | None:
+        """
+        Returns a valid access token of a user, refreshing it first if it
+        has expired.
+
+        Returns
+        -------
+        str | None
+            the access token or None if the user has no (valid) tokens and
+            needs to log in again
+        """
+        async with self._app.db.read_session() as session:
+            user = await session.get(CompassUser, user_id)
+        if user is None or user.access_token is None:
+            return None
+        if user.token_expires_at is None or _utc(user.token_expires_at) > datetime.now(timezone.utc):
+            return user.access_token
+        if user.refresh_token is None:
+            return None
+        return await self._refresh(user.id, user.refresh_token)
+
+    async def _refresh(self, user_id: int, refresh_token: str) -> str | None:
+        """Refreshes and stores the tokens of a user, returns the new access token"""
+        future = self._refreshing.get(user_id)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self._refreshing[user_id] = asyncio.get_running_loop().create_future()
+        try:
+            grant = await self._refresh_grant(user_id, refresh_token)
+            await self._store([(user_id, grant)])
+        except BaseException as e:
+            # waiters get the error as well, the next caller tries again
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self._refreshing[user_id]
+        result = grant.access_token if grant is not None else None
+        future.set_result(result)
+        return result
+
+    async def _refresh_grant(self, user_id: int, refresh_token: str) -> TokenGrant | None:
+        """Requests new tokens, returns None if the refresh token was rejected"""
+        try:
+            grant = await self._request_token({
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token,
+            })
+        except TokenRejected as e:
+            self._refreshes_rejected.inc()
+            _log.info(f"Refresh token of user {user_id} was rejected, they need to log in again: {e}")
+            return None
+        except Exception:
+            self._refreshes_failed.inc()
+            raise
+        self._refreshes_done.inc()
+        return grant
+
+    async def _store(self, grants: list[tuple[int, TokenGrant | None]]) -> None:
+        """Stores refreshed tokens in one transaction, None removes the tokens of a user"""
+        async with self._app.db.session() as session:
+            for user_id, grant in grants:
+                await session.execute(
+                    update(CompassUser)
+                    .where(CompassUser.id == user_id)
+                    .values(
+                        access_token=grant.access_token if grant is not None else None,
+                        # discord may keep the refresh token, then it isn't returned again
+                        refresh_token=(
+                            grant.refresh_token or CompassUser.refresh_token
+                            if grant is not None else None
+                        ),
+                        token_expires_at=grant.expires_at if grant is not None else None,
+                    )
+                )
+
+    async def _store_each(
+        self,
+        grants: list[tuple[int, TokenGrant | None]],
+        failed: set[int],
+    ) -> list[tuple[int, TokenGrant | None]]:
+        """
+        Stores the grants of a batch, one by one if storing them together fails,
+        as discord has already replaced the old refresh tokens. Returns the
+        stored grants and adds the users that couldn't be stored to `failed`.
+        """
+        try:
+            await self._store(grants)
+            return grants
+        except Exception as e:
+            _log.warning(f"Failed to store {len(grants)} refreshed tokens, storing them individually: {e}")
+        stored = []
+        for user_id, grant in grants:
+            try:
+                await self._store([(user_id, grant)])
+                stored.append((user_id, grant))
+            except Exception as e:
+                _log.error(f"Failed to store refreshed token of user {user_id}: {e}", exc_info=e)
+                failed.add(user_id)
+        return stored
 
-    DISCORD_AUTH_URL = "https://discord.com/api/oauth2/authorize"
-    DISCORD_TOKEN_URL = "https://discord.com/api/oauth2/token"
-    DISCORD_API_URL = "https://discord.com/api/users/@me"
+    async def refresh_expiring(self) -> int:
+        """
+        Refreshes the tokens of all users that expire within
+        `auth_refresh_margin` seconds.
+
+        Returns
+        -------
+        int
+            number of refreshed tokens
+        """
+        settings = self._app.settings
+        semaphore = asyncio.Semaphore(settings.auth_refresh_concurrency)
+        deadline = datetime.now(timezone.utc) + timedelta(seconds=settings.auth_refresh_margin)
+        refreshed = 0
+        # users that failed in this round are not tried again before the next one
+        failed: set[int] = set()
+
+        async def refresh(user_id: int, refresh_token: str) -> tuple[int, TokenGrant | None] | None:
+            async with semaphore:
+                try:
+                    return user_id, await self._refresh_grant(user_id, refresh_token)
+                except Exception as e:
+                    # e.g. an unexpected response, this must not discard the grants of the others
+                    _log.warning(f"Failed to refresh token of user {user_id}: {e!r}")
+                    failed.add(user_id)
+                    return None
+
+        while True:
+            async with self._app.db.read_session() as session:
+                rows = (await session.exec(
+                    select(CompassUser.id, CompassUser.refresh_token)
+                    .where(
+                        CompassUser.refresh_token.is_not(None),
+                        # tokens stored before expiries were recorded are refreshed as well
+                        or_(
+                            CompassUser.token_expires_at.is_(None),
+                            CompassUser.token_expires_at <= deadline,
+                        ),
+                        CompassUser.id.not_in(list(failed | self._refreshing.keys())),
+                    )
+                    .order_by(CompassUser.token_expires_at)
+                    .limit(settings.auth_refresh_batch_size)
+                )).all()
+            if len(rows) == 0:
+                break
+            # on-demand refreshes may have started while the batch was queried, their users are skipped
+            batch = [(user_id, token) for user_id, token in rows if user_id not in self._refreshing]
+
+            # on-demand refreshes of these users wait for the batch
+            loop = asyncio.get_running_loop()
+            futures = {user_id: loop.create_future() for user_id, _ in batch}
+            self._refreshing.update(futures)
+            try:
+                results = [
+                    result for result in await asyncio.gather(
+                        *(refresh(user_id, token) for user_id, token in batch)
+                    )
+                    if result is not None
+                ]
+                results = await self._store_each(results, failed)
+            except BaseException as e:
+                for future in futures.values():
+                    future.set_exception(e)
+                    future.exception()
+                raise
+            finally:
+                for user_id in futures:
+                    del self._refreshing[user_id]
+
+            grants = dict(results)
+            for user_id, future in futures.items():
+                if user_id in grants:
+                    grant = grants[user_id]
+                    future.set_result(grant.access_token if grant is not None else None)
+                elif not future.done():
+                    future.set_exception(RuntimeError(f"Failed to refresh token of user {user_id}"))
+                    future.exception()
+            refreshed += sum(1 for grant in grants.values() if grant is not None)
+
+            if len(rows) < settings.auth_refresh_batch_size:
+                break
+
+        if refreshed > 0 or len(failed) > 0:
+            _log.info(f"Refreshed {refreshed} discord tokens, {len(failed)} failed")
+        return refreshed
+
+    async def run(self) -> None:
+        exited = asyncio.Event()
+        self._app.exited >> filters.call_if_true(exited.set)
+
+        while not exited.is_set():
+            try:
+                await self.refresh_expiring()
+            except Exception as e:
+                _log.error(f"Failed to refresh discord tokens: {e}", exc_info=e)
+            try:
+                await asyncio.wait_for(exited.wait(), self._app.settings.auth_refresh_interval)
+            except TimeoutError:
+                pass
+
+
+class CompassAuth():
 
     def __init__(self, app: "CompassApp"):
         self._app = app
+        self.tokens = TokenManager(app)
+        self.sessions = SessionManager(app)
 
         @app.web.get("/login")
         async def login():
@@ -41,35 +335,23 @@ class CompassAuth():
                 "response_type": "code",
                 "scope": "identify email",
             }
-            return RedirectResponse(f"{self.DISCORD_AUTH_URL}?{urlencode(params)}")
+            return RedirectResponse(f"{DISCORD_AUTH_URL}?{urlencode(params)}")
 
         @app.web.get("/callback")
         async def callback(code: str):
             # Exchange code for token
-            data = {
-                "client_id": self._app.config.discord_client_id,
-                "client_secret": self._app.config.discord_client_secret,
-                "grant_type": "authorization_code",
-                "code": code,
-                "redirect_uri": self._app.config.discord_redirect_url,
-            }
-            headers = {"Content-Type": "application/x-www-form-urlencoded"}
-
-            async with httpx.AsyncClient() as client:
-                token_resp = await client.post(self.DISCORD_TOKEN_URL, data=data, headers=headers)
-                token_data = token_resp.json()
-
-                if "access_token" not in token_data:
-                    raise HTTPException(status_code=400, detail="Failed to get access token")
+            try:
+                grant = await self.tokens.exchange_code(code)
+            except (TokenRejected, httpx.HTTPError, KeyError) as e:
+                _log.warning(f"Failed to get access token: {e!r}")
+                raise HTTPException(status_code=400, detail="Failed to get access token")
 
-                access_token = token_data["access_token"]
-
-                # Get user info
-                user_resp = await client.get(
-                    self.DISCORD_API_URL,
-                    headers={"Authorization": f"Bearer {access_token}"}
-                )
-                user_data = user_resp.json()
+            # Get user info
+            user_resp = await self._app.http.client.get(
+                DISCORD_API_URL,
+                headers={"Authorization": f"Bearer {grant.access_token}"}
+            )
+            user_data = user_resp.json()
 
             # Store user in DB
             async with app.db.session() as session:
@@ -78,19 +360,62 @@ class CompassAuth():
                 )).one_or_none()
 
                 if user is not None:
-                    user.access_token = access_token
+                    user.access_token = grant.access_token
+                    user.refresh_token = grant.refresh_token
+                    user.token_expires_at = grant.expires_at
                 else:
                     user = CompassUser(
                         discord_id=user_data["id"],
                         username=user_data["username"],
                         discriminator=user_data["discriminator"],
                         avatar=user_data["avatar"],
-                        access_token=access_token,
-                        refresh_token=token_data.get("refresh_token")
+                        access_token=grant.access_token,
+                        refresh_token=grant.refresh_token,
+                        token_expires_at=grant.expires_at,
                     )
                     session.add(user)
 
-            return {"message": "Logged in successfully", "user": user_data}
+            token, session = self.sessions.issue(user.id, user.discord_id, self._roles(user.discord_id))
+            response = JSONResponse({"message": "Logged in successfully", "user": user_data})
+            response.set_cookie(
+                COOKIE_NAME,
+                token,
+                max_age=session.expires_at - session.issued_at,
+                httponly=True,
+                secure=self._app.config.discord_redirect_url.startswith("https://"),
+                samesite="lax",
+            )
+            return response
+
+        @app.web.get("/session")
+        async def get_session(session: Session = Depends(self.sessions)):
+            return {
+                "user_id": session.user_id,
+                "discord_id": str(session.discord_id),
+                "roles": sorted(session.roles),
+                "expires_at": session.expires_at,
+            }
+
+        @app.web.post("/logout")
+        async def logout(session: Session = Depends(self.sessions)):
+            await self.sessions.revoke(session)
+            response = JSONResponse({"message": "Logged out successfully"})
+            response.delete_cookie(COOKIE_NAME)
+            return response
+
+    def _roles(self, discord_id: int) -> set[str]:
+        """Roles of a user in the web app, from the cached guild member"""
+        roles = set()
+        guild = self._app.bot.get_guild(self._app.config.discord_guild_id)
+        member = guild.get_member(discord_id) if guild is not None else None
+        if member is not None:
+            roles.add("member")
+            if member.guild_permissions.administrator:
+                roles.add("admin")
+        return roles
 
     async def run(self) -> None:
-        ...
\ No newline at end of file
+        await asyncio.gather(
+            self.tokens.run(),
+            self.sessions.run(),
+        )
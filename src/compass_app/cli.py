@@ -9,7 +9,13 @@ CLI command handler for administrative purposes
 import shlex
 import logging
 import typing
+from pathlib import Path
 from el import terminal
+from el.async_tools import create_bg_task
+
+from compass_app import weeks
+from compass_app.accountability.backfill import BackfillProgress
+from compass_app.accountability.importer import ImportStats
 
 if typing.TYPE_CHECKING:
     from compass_app.main import CompassApp
@@ -23,6 +29,131 @@ class CompassCLI:
     def __init__(self, app: "CompassApp") -> None:
         self._app = app
 
+    def _backfill(self, args: list[str]) -> None:
+        """backfill <week>/<year> [<week>/<year>]: rebuilds accountability of a range of weeks"""
+        def parse_week(arg: str) -> weeks.CompassWeek:
+            week, year = arg.split("/")
+            return weeks.week(int(year), int(week))
+        try:
+            first = parse_week(args[0])
+            last = parse_week(args[-1])
+        except (IndexError, ValueError):
+            _term.print("Usage: backfill <week>/<year> [<week>/<year>]")
+            return
+        if self._app.accountability.backfill.running:
+            _term.print("A backfill is already running.")
+            return
+
+        async def progress(state: BackfillProgress):
+            _term.print(f"Backfill: {state}")
+
+        async def backfill():
+            try:
+                state = await self._app.accountability.backfill.rebuild(first, last, progress)
+            except Exception as e:
+                _term.print(f"Backfill failed: {e}")
+                return
+            _term.print(f"Backfill finished: {state}")
+
+        # runs in the background, so the CLI stays usable
+        _term.print(f"Backfilling accountability from {first} to {last}...")
+        create_bg_task(backfill())
+
+    def _export(self, args: list[str]) -> None:
+        """export <format> [<path>]: exports the accountability history to a file"""
+        exporter = self._app.accountability.export
+        if len(args) == 0 or args[0] not in exporter.available_formats():
+            _term.print(f"Usage: export <{'|'.join(exporter.available_formats())}> [<path>]")
+            return
+        format = args[0]
+        path = Path(args[1]) if len(args) > 1 else self._app.data_path / "exports" / exporter.file_name(format)
+
+        async def export():
+            try:
+                size = await exporter.to_file(format, path)
+            except Exception as e:
+                _term.print(f"Export failed: {e}")
+                return
+            _term.print(f"Exported accountability history to {path} ({size / 1024:.0f} KiB)")
+
+        # runs in the background, so the CLI stays usable
+        _term.print(f"Exporting accountability history to {path}...")
+        create_bg_task(export())
+
+    def _import(self, args: list[str]) -> None:
+        """import <path> [ndjson|csv]: imports accountability data, continuing an interrupted import"""
+        if len(args) == 0 or (len(args) > 1 and args[1] not in ("ndjson", "csv")):
+            _term.print("Usage: import <path> [ndjson|csv]")
+            return
+        path = Path(args[0])
+        format = args[1] if len(args) > 1 else None
+        if self._app.accountability.importer.running:
+            _term.print("An import is already running.")
+            return
+
+        async def progress(stats: ImportStats):
+            _term.print(f"Import: {stats}")
+
+        async def run_import():
+            try:
+                stats = await self._app.accountability.importer.import_file(path, format, progress)
+            except Exception as e:
+                _term.print(f"Import failed: {e}")
+                return
+            _term.print(f"Import finished: {stats}")
+
+        # runs in the background, so the CLI stays usable
+        _term.print(f"Importing accountability data from {path}...")
+        create_bg_task(run_import())
+
+    def _lag(self, args: list[str]) -> None:
+        """lag [<n>]: shows the recent event loop stalls or the full stack of one"""
+        monitor = self._app.loop_monitor
+        stalls = list(monitor.stalls)
+        if len(args) > 0:
+            try:
+                stall = stalls[int(args[0])]
+            except (IndexError, ValueError):
+                _term.print(f"Usage: lag [<n>], n is between 0 and {len(stalls) - 1}")
+                return
+            _term.print(f"{stall}\n{''.join(stall.stack)}")
+            return
+
+        _term.print(f"Max event loop lag: {monitor.max_lag * 1000:.1f}ms, {len(stalls)} recent stalls")
+        for i, stall in enumerate(stalls):
+            _term.print(f"  {i}: {stall}")
+
+    async def _profile(self, args: list[str]) -> None:
+        """profile start [<seconds>] [trace] | stop | dump | status: controls the profiler"""
+        profiler = self._app.profiler
+        match args:
+            case ["start", *options]:
+                try:
+                    duration = float(options[0]) if len(options) > 0 and options[0] != "trace" else None
+                except ValueError:
+                    _term.print("Usage: profile start [<seconds>] [trace]")
+                    return
+                try:
+                    profiler.start(duration, trace="trace" in options)
+                except RuntimeError as e:
+                    _term.print(str(e))
+                    return
+                _term.print("Profiling started.")
+            case ["stop" | "dump" as action]:
+                try:
+                    paths = await (profiler.stop() if action == "stop" else profiler.dump())
+                except RuntimeError as e:
+                    _term.print(str(e))
+                    return
+                _term.print(f"Profile written to {', '.join(str(p) for p in paths)}")
+            case ["status"] | []:
+                if profiler.running:
+                    _term.print(f"Profiling since {profiler.started:%H:%M:%S}, {profiler.sample_count} samples")
+                else:
+                    _term.print("The profiler is not running.")
+            case _:
+                _term.print("Usage: profile start [<seconds>] [trace] | stop | dump | status")
+
     async def run(self) -> None:
         line: str = ""
 
@@ -44,3 +175,29 @@ class CompassCLI:
                 case "gs" | "gsync":
                     count = await self._app.bot.sync_global()
                     _term.print(f"Synced {count} commands globally.")
+                case "idx" | "index":
+                    threads = self._app.accountability.threads
+                    messages = self._app.accountability.messages
+                    _term.print(f"Tracked threads: {len(threads)}, tracked messages: {len(messages)}")
+                    _term.print(
+                        f"Message filter: {messages.lookups} lookups, "
+                        f"hit rate {messages.hit_rate:.2%}, "
+                        f"false positive rate {messages.false_positive_rate:.2%}"
+                    )
+                case "score" | "rescore":
+                    await self._app.accountability.scoring.recompute()
+                    _term.print("Recomputed all accountability scores.")
+                case "bf" | "backfill":
+                    self._backfill(argv[1:])
+                case "prof" | "profile":
+                    await self._profile(argv[1:])
+                case "export":
+                    self._export(argv[1:])
+                case "import":
+                    self._import(argv[1:])
+                case "lag":
+                    self._lag(argv[1:])
+                case "replay":
+                    _term.print("Replaying accountability journal...")
+                    count = await self._app.accountability.journal.replay()
+                    _term.print(f"Replayed {count} journal records.")
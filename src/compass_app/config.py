@@ -7,12 +7,56 @@ Centralized place to define and load configuration
 """
 
 import os
-from pydantic import Field
+import typing
+from pydantic import BaseModel, Field
 from datetime import time
 from el.datastore import SavableModel
 from el.terminal import LogLevel
 
 
+class DatabaseProfile(BaseModel):
+    """
+    SQLite tuning applied to every database connection.
+    See https://www.sqlite.org/pragma.html for the meaning of the parameters.
+    """
+    model_config = {
+        "frozen": True,
+    }
+
+    journal_mode: typing.Literal["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL"] = "WAL"
+    synchronous: typing.Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    # milliseconds to wait for a lock before failing with "database is locked"
+    busy_timeout: int = 5000
+    # positive values are pages, negative values are KiB
+    cache_size: int = -32000
+    mmap_size: int = 128 * 1024 * 1024
+    temp_store: typing.Literal["DEFAULT", "FILE", "MEMORY"] = "MEMORY"
+    foreign_keys: bool = True
+    # number of pooled connections for read-only sessions. Writes use the default pool,
+    # so concurrent write sessions wait for SQLite's write lock (up to busy_timeout).
+    read_pool_size: int = 4
+
+
+class HTTPProfile(BaseModel):
+    """
+    Connection pool and timeouts of the shared HTTP client used for
+    third-party APIs (e.g. discord OAuth).
+    """
+    model_config = {
+        "frozen": True,
+    }
+
+    max_connections: int = 20
+    # idle connections kept open for reuse and seconds until they are closed
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 30.0
+    # seconds, pool is the time to wait for a free connection
+    connect_timeout: float = 5.0
+    read_timeout: float = 10.0
+    write_timeout: float = 10.0
+    pool_timeout: float = 5.0
+
+
 class Config(SavableModel):
     model_config = {
         "savable_default_dump_options": {
@@ -30,9 +74,22 @@ class Config(SavableModel):
     
     web_host: str
     web_port: int
+    # key for signing web sessions, generated and stored in the data folder if not set
+    session_secret: str | None = None
     
     accountability_channel_id: int
 
+    # Base URL of the discord REST API, only for testing against a mock server
+    # (see experiments/mock_discord.py). If set, the bot doesn't connect to the gateway.
+    discord_api_base: str | None = None
+
+    database: DatabaseProfile = Field(default_factory=DatabaseProfile)
+    http: HTTPProfile = Field(default_factory=HTTPProfile)
+
+    # range of years for which compass weeks are precomputed
+    calendar_first_year: int = 2024
+    calendar_last_year: int = 2050
+
 
 class Settings(SavableModel):
     model_config = {
@@ -43,6 +100,29 @@ class Settings(SavableModel):
 
     sqlalchemy_log_level: LogLevel = "WARNING"
 
+    # seconds changes are collected before they are written to disk
+    settings_save_delay: float = 0.5
+    # seconds between checks for external edits of the settings file
+    settings_poll_interval: float = 2.0
+
+    # event loop lag sampling, see loop_monitor.py
+    loop_monitor_interval: float = 0.1
+    loop_monitor_threshold: float = 0.25
+    loop_monitor_history: int = 20
+    # on-demand profiling from the CLI, see profiler.py
+    profile_sample_interval: float = 0.01
+    profile_max_duration: float = 300.0
+
+    # refreshing of discord OAuth tokens, see auth.py
+    # seconds between checks for expiring tokens
+    auth_refresh_interval: float = 600.0
+    # tokens expiring within this many seconds are refreshed
+    auth_refresh_margin: float = 24 * 60 * 60
+    auth_refresh_batch_size: int = 50
+    auth_refresh_concurrency: int = 4
+    # seconds web sessions are valid after logging in
+    auth_session_lifetime: float = 7 * 24 * 60 * 60
+
     # settings for automated accountability period creation/ending
     accountability_period_automation: bool = False
     accountability_period_weekday: int = 0
@@ -51,3 +131,33 @@ class Settings(SavableModel):
     accountability_scoring_automation: bool = False
     accountability_scoring_weekday: int = 0
     accountability_scoring_time: time = Field(default_factory=time)
+    # settings for buffered recording of accountability messages
+    accountability_ingest_queue_size: int = 1000
+    accountability_ingest_batch_size: int = 100
+    accountability_ingest_flush_interval: float = 1.0
+    # attempts and first backoff in seconds for events that fail with a database error (e.g. locked)
+    accountability_ingest_retries: int = 4
+    accountability_ingest_retry_base: float = 0.2
+    # seconds leaderboard and stats embeds are cached for
+    accountability_stats_cache_ttl: float = 60.0
+    # number of threads read in parallel when backfilling accountability from discord
+    accountability_backfill_concurrency: int = 4
+    # periods that ended within this many weeks are caught up on after reconnecting
+    accountability_catch_up_weeks: int = 2
+    # journal of accountability events, see accountability/journal.py
+    accountability_journal_fsync_interval: float = 0.5
+    accountability_journal_segment_size: int = 16 * 1024 * 1024
+    accountability_journal_compact_segments: int = 8
+    # outbound queue of discord side effects, see accountability/outbound.py
+    accountability_outbound_concurrency: int = 4
+    accountability_outbound_route_concurrency: int = 2
+    accountability_outbound_retry_base: float = 1.0
+    accountability_outbound_retry_cap: float = 300.0
+    # seconds commands wait for a discord side effect before reporting it as pending
+    accountability_outbound_wait: float = 30.0
+    # rows fetched and encoded at once when exporting the accountability history
+    accountability_export_chunk_size: int = 1000
+    # seconds an export may hold its database snapshot, which blocks WAL checkpoints
+    accountability_export_timeout: float = 300.0
+    # rows written in one transaction when importing accountability data
+    accountability_import_batch_size: int = 500
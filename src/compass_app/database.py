@@ -7,18 +7,23 @@ Database subsystem for data storage
 """
 
 import os
+import time
 import typing
 import asyncio
 import logging
 import contextlib
+from datetime import datetime
 
 import discord
 from sqlmodel import SQLModel, Field, select
 from sqlmodel.ext.asyncio.session import AsyncSession
-from sqlalchemy import String, BigInteger
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import String, BigInteger, func, event
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from el.async_tools import synchronize
 
+from compass_app import migrations, metrics
+
 
 if typing.TYPE_CHECKING:
     from compass_app.main import CompassApp
@@ -41,6 +46,8 @@ class CompassUser(SQLModel, table=True):
     avatar: str | None          = Field(sa_type=String(255))
     access_token: str | None    = Field(sa_type=String(255))
     refresh_token: str | None   = Field(sa_type=String(255))
+    # when the access token expires (UTC), refreshed ahead of time by the auth subsystem
+    token_expires_at: datetime | None = Field(default=None, index=True)
 
     @classmethod
     def from_discord(cls, user: discord.User | discord.Member):
@@ -52,21 +59,35 @@ class CompassUser(SQLModel, table=True):
         )
 
     @classmethod
-    async def get_or_create_from_discord(
+    async def upsert_from_discord(
         cls, 
         session: AsyncSession, 
-        dc_user: discord.User | discord.Member
-    ):
-        """Gets or creates the DB user from the associated discord user"""
-        user = await session.scalar(
-            select(CompassUser).where(CompassUser.discord_id == dc_user.id)
-        )
-        if user is None:
-            user = CompassUser.from_discord(dc_user)
-            session.add(user)
-        return user
-
+        discord_id: int,
+        username: str,
+        avatar: str | None = None,
+    ) -> int:
+        """
+        Creates the DB user for a discord user or updates the name and avatar
+        of the existing one in a single statement.
 
+        Returns
+        -------
+        int
+            ID of the DB user
+        """
+        stmt = insert(CompassUser).values(
+            discord_id=discord_id,
+            username=username,
+            avatar=avatar,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CompassUser.discord_id],
+            set_={
+                "username": stmt.excluded.username,
+                "avatar": func.coalesce(stmt.excluded.avatar, CompassUser.avatar),
+            }
+        ).returning(CompassUser.id)
+        return (await session.execute(stmt)).scalar_one()
 
 
 class CompassDB:
@@ -74,13 +95,37 @@ class CompassDB:
     def __init__(self, app: "CompassApp"):
         self._app = app
         self._app.db_path.parent.mkdir(exist_ok=True, parents=True)
+        self._profile = self._app.config.database
+
+        # engine for all writing sessions, with the default pool of several connections,
+        # SQLite's write lock serializes their transactions
         self.engine = create_async_engine(f"sqlite+aiosqlite:///{self._app.db_path}")
-        logging.getLogger('sqlalchemy.engine').setLevel(
-            self._app.settings.sqlalchemy_log_level
+        event.listen(self.engine.sync_engine, "connect", self._configure_write_connection)
+
+        # separate engine with its own connection pool for read-only sessions,
+        # so that reads (e.g. from web endpoints) never wait for a free
+        # connection behind writes. With WAL, reads don't block on write locks either.
+        self.read_engine = create_async_engine(
+            f"sqlite+aiosqlite:///{self._app.db_path}",
+            pool_size=self._profile.read_pool_size,
         )
+        event.listen(self.read_engine.sync_engine, "connect", self._configure_read_connection)
+
+        self._instrument(self.engine, "write")
+        self._instrument(self.read_engine, "read")
+        self._write_session_seconds = metrics.SESSION_SECONDS.labels("write")
+        self._read_session_seconds = metrics.SESSION_SECONDS.labels("read")
+
+        self._apply_log_level()
+        self._app.settings_store.changed >> self._apply_log_level
         
         self._is_ready: asyncio.Future[bool] = asyncio.get_event_loop().create_future()
 
+    def _apply_log_level(self, *_) -> None:
+        logging.getLogger('sqlalchemy.engine').setLevel(
+            self._app.settings.sqlalchemy_log_level
+        )
+
     @contextlib.asynccontextmanager
     async def session(self):
         """Creates a new session and starts a transaction.
@@ -98,18 +143,90 @@ class CompassDB:
         if not await self._is_ready:
             raise RuntimeError("Cannot access database because it failed to initialize")
 
-        async with AsyncSession(self.engine, expire_on_commit=False) as session:
-            async with session.begin():
-                yield session
+        started = time.perf_counter()
+        try:
+            async with AsyncSession(self.engine, expire_on_commit=False) as session:
+                async with session.begin():
+                    yield session
+        finally:
+            self._write_session_seconds.observe(time.perf_counter() - started)
+
+    @contextlib.asynccontextmanager
+    async def read_session(self):
+        """Creates a new read-only session and starts a transaction.
+
+        This waits until the DB is ready.
+
+        Yields
+        ------
+        AsyncSession
+            session with an active transaction on a connection that
+            refuses any writes.
+        """
+        # wait for db to become ready
+        if not await self._is_ready:
+            raise RuntimeError("Cannot access database because it failed to initialize")
+
+        started = time.perf_counter()
+        try:
+            async with AsyncSession(self.read_engine, expire_on_commit=False) as session:
+                async with session.begin():
+                    yield session
+        finally:
+            self._read_session_seconds.observe(time.perf_counter() - started)
+
+    @staticmethod
+    def _instrument(engine: AsyncEngine, name: str) -> None:
+        """Records the duration of all statements of an engine in the metrics"""
+        statement_seconds = metrics.SQL_SECONDS.labels(name)
+        statement_errors = metrics.SQL_ERRORS.labels(name)
+
+        def before_execute(conn, cursor, statement, parameters, context, executemany):
+            context._compass_started = time.perf_counter()
+
+        def after_execute(conn, cursor, statement, parameters, context, executemany):
+            statement_seconds.observe(time.perf_counter() - context._compass_started)
+
+        def handle_error(exception_context):
+            statement_errors.inc()
+
+        event.listen(engine.sync_engine, "before_cursor_execute", before_execute)
+        event.listen(engine.sync_engine, "after_cursor_execute", after_execute)
+        event.listen(engine.sync_engine, "handle_error", handle_error)
+
+    def _configure_connection(self, dbapi_connection) -> None:
+        """Applies the performance profile to a new connection"""
+        profile = self._profile
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {int(profile.busy_timeout)}")
+        cursor.execute(f"PRAGMA synchronous = {profile.synchronous}")
+        cursor.execute(f"PRAGMA cache_size = {int(profile.cache_size)}")
+        cursor.execute(f"PRAGMA mmap_size = {int(profile.mmap_size)}")
+        cursor.execute(f"PRAGMA temp_store = {profile.temp_store}")
+        cursor.execute(f"PRAGMA foreign_keys = {'ON' if profile.foreign_keys else 'OFF'}")
+        cursor.close()
+
+    def _configure_write_connection(self, dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        # the journal mode is stored in the database file, so only writers set it
+        cursor.execute(f"PRAGMA journal_mode = {self._profile.journal_mode}")
+        cursor.close()
+        self._configure_connection(dbapi_connection)
+
+    def _configure_read_connection(self, dbapi_connection, connection_record) -> None:
+        self._configure_connection(dbapi_connection)
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA query_only = ON")
+        cursor.close()
     
     async def run(self) -> None:
         # first we do some database initialization
         try:
-            # initialize tables
+            # create or migrate the tables
             # This runs after all subsystems have been imported,
             # so it is safe to access the metadata here.
             async with self.engine.begin() as conn:
-                await conn.run_sync(SQLModel.metadata.create_all)
+                await conn.run_sync(migrations.upgrade)
 
             # set db as ready so other subsystems can use it
             self._is_ready.set_result(True)
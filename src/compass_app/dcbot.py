@@ -7,10 +7,14 @@ Discord Bot subsystem entrypoint
 """
 
 import os
+import time
+import asyncio
 import logging
 import typing
 
+import aiohttp
 import discord
+from discord import app_commands
 from discord.ext import commands
 from discord.ext.commands import errors
 from discord.ext.commands.context import Context
@@ -19,6 +23,7 @@ from el.observable import filters
 from el.async_tools import synchronize
 from el.callback_manager import CallbackManager
 
+from compass_app import metrics
 from compass_app.accountability.cog import AccountabilityCommands
 
 if typing.TYPE_CHECKING:
@@ -27,6 +32,44 @@ if typing.TYPE_CHECKING:
 _log = logging.getLogger(__name__)
 
 
+class CompassCommandTree(app_commands.CommandTree):
+    """Command tree recording the run time of slash commands"""
+
+    @typing.override
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras["started"] = time.perf_counter()
+        return True
+
+    @typing.override
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError) -> None:
+        observe_command(interaction, "error")
+        await super().on_error(interaction, error)
+
+
+def observe_command(interaction: discord.Interaction, result: str) -> None:
+    started = interaction.extras.get("started")
+    if started is None or interaction.command is None:
+        return
+    metrics.COMMAND_SECONDS.labels(interaction.command.qualified_name, result).observe(
+        time.perf_counter() - started
+    )
+
+
+def _rest_trace() -> aiohttp.TraceConfig:
+    """Trace of all REST requests of discord.py for the request metrics"""
+    async def on_request_start(session, context, params: aiohttp.TraceRequestStartParams):
+        context.started = time.perf_counter()
+
+    async def on_request_end(session, context, params: aiohttp.TraceRequestEndParams):
+        metrics.REST_SECONDS.labels(params.method).observe(time.perf_counter() - context.started)
+        if params.response.status == 429:
+            metrics.REST_RATE_LIMITED.labels().inc()
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    return trace
+
 
 class DiscordBot(commands.Bot):
 
@@ -39,15 +82,49 @@ class DiscordBot(commands.Bot):
         super().__init__(
             command_prefix="ThIsWiLlNeVeRhApPeN",
             intents=intents, 
+            tree_cls=CompassCommandTree,
+            http_trace=_rest_trace(),
             **kwargs
         )
+        metrics.GATEWAY_LATENCY.labels().set_function(lambda: self.latency)
+        self._logged_in = asyncio.Event()
+
+        if self._app.config.discord_api_base is not None:
+            _log.warning(f"Using discord API at {self._app.config.discord_api_base}, the gateway is disabled")
+            discord.http.Route.BASE = self._app.config.discord_api_base
 
     async def run(self) -> None:
         await self.add_cog(AccountabilityCommands(self._app))
         
         async with self:
             self._app.exited >> filters.call_if_true(synchronize(self.close))
-            await self.start(self._app.config.discord_bot_token)
+            if self._app.config.discord_api_base is not None:
+                # a mock API has no gateway, so we only log in for REST calls
+                exited = asyncio.Event()
+                self._app.exited >> filters.call_if_true(exited.set)
+                await self.login(self._app.config.discord_bot_token)
+                await exited.wait()
+            else:
+                await self.start(self._app.config.discord_bot_token)
+
+    @typing.override
+    async def setup_hook(self) -> None:
+        # called by login(), so this also works without gateway connection
+        self._logged_in.set()
+
+    async def wait_until_logged_in(self) -> None:
+        """Waits until the bot is logged in and can make API requests"""
+        await self._logged_in.wait()
+
+    async def get_or_fetch_channel(self, channel_id: int):
+        """
+        Returns a channel from the cache or fetches it if it isn't cached
+        (e.g. archived threads or without gateway connection).
+        """
+        channel = self.get_channel(channel_id)
+        if channel is None:
+            channel = await self.fetch_channel(channel_id)
+        return channel
 
     async def sync(self) -> int:
         """Syncs the commands to the target guild"""
@@ -63,6 +140,13 @@ class DiscordBot(commands.Bot):
     async def on_ready(self):
         _log.info(f"logged in as {self.user}")
 
+    async def on_app_command_completion(
+        self,
+        interaction: discord.Interaction,
+        command: app_commands.Command | app_commands.ContextMenu
+    ) -> None:
+        observe_command(interaction, "ok")
+
     @typing.override
     async def on_message(self, message: discord.Message) -> None:
         if message.author == self.user:
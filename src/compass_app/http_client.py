@@ -0,0 +1,71 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+19.10.26, 03:30
+
+Shared HTTP client for third-party APIs.
+
+All subsystems use the same pooled client, so connections (and their TLS
+sessions) to the same host are kept alive and reused instead of being set
+up again for every request.
+"""
+
+import time
+import typing
+import asyncio
+import logging
+
+import httpx
+from el.observable import filters
+
+from compass_app import metrics
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+class CompassHTTP:
+    """
+    Owns the app-wide `httpx.AsyncClient` with the limits and timeouts of
+    the `http` config profile. The client is closed when the app exits.
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        profile = self._app.config.http
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=profile.max_connections,
+                max_keepalive_connections=profile.max_keepalive_connections,
+                keepalive_expiry=profile.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                connect=profile.connect_timeout,
+                read=profile.read_timeout,
+                write=profile.write_timeout,
+                pool=profile.pool_timeout,
+            ),
+            headers={"User-Agent": "compass-app (https://thecompass.diy)"},
+            event_hooks={
+                "request": [self._on_request],
+                "response": [self._on_response],
+            },
+        )
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        request.extensions["compass_started"] = time.perf_counter()
+
+    async def _on_response(self, response: httpx.Response) -> None:
+        request = response.request
+        started = request.extensions.get("compass_started")
+        if started is not None:
+            metrics.HTTP_SECONDS.labels(request.url.host).observe(time.perf_counter() - started)
+
+    async def run(self) -> None:
+        exited = asyncio.Event()
+        self._app.exited >> filters.call_if_true(exited.set)
+        await exited.wait()
+        await self.client.aclose()
+        _log.debug("Closed HTTP client")
@@ -0,0 +1,133 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+19.10.26, 01:10
+
+Event loop lag monitor.
+
+Everything runs on a single asyncio loop, so one blocking call delays the
+web server, the discord gateway heartbeats, the CLI and all automations.
+This measures how late the loop wakes up a periodic sampler and, when the
+loop is blocked for longer than a threshold, captures the stack of
+whatever is blocking it from a separate watchdog thread.
+"""
+
+import sys
+import time
+import typing
+import asyncio
+import logging
+import threading
+import traceback
+import collections
+import dataclasses
+from datetime import datetime
+
+from el.observable import filters
+
+from compass_app import metrics
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class LoopStall:
+    """A time the event loop was blocked for longer than the threshold"""
+    started: datetime
+    # seconds the loop was blocked, updated until the loop is responsive again
+    duration: float
+    # name of the task that was running, None if it was a plain callback
+    task: str | None
+    stack: list[str]
+    ongoing: bool = True
+
+    def __str__(self) -> str:
+        location = self.stack[-1].strip().splitlines()[0] if len(self.stack) > 0 else "unknown location"
+        return (
+            f"{self.started:%Y-%m-%d %H:%M:%S} blocked {self.duration:.3f}s{' (ongoing)' if self.ongoing else ''} "
+            f"in {self.task or 'callback'}: {location}"
+        )
+
+
+class LoopMonitor:
+    """
+    Samples the scheduling delay of the event loop every
+    `loop_monitor_interval` seconds into the metrics. If a sample is more
+    than `loop_monitor_threshold` seconds overdue, the watchdog thread
+    captures the stack of the loop thread and logs it, and the stall is
+    kept in a history of the last `loop_monitor_history` stalls.
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        self.stalls = collections.deque[LoopStall](maxlen=self._app.settings.loop_monitor_history)
+        self.max_lag = 0.0
+        # monotonic time the sampler is expected to run next, written by the loop
+        # and read by the watchdog thread (float assignments are atomic)
+        self._deadline = 0.0
+        self._stall: LoopStall | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread = 0
+        self._stopped = threading.Event()
+        self._lag_seconds = metrics.LOOP_LAG_SECONDS.labels()
+        self._stalls_total = metrics.LOOP_STALLS.labels()
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._app.exited >> filters.call_if_true(self._stopped.set)
+
+        interval = self._app.settings.loop_monitor_interval
+        self._deadline = time.monotonic() + interval
+        watchdog = threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True)
+        watchdog.start()
+
+        while not self._stopped.is_set():
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            lag = max(0.0, now - self._deadline)
+            self._lag_seconds.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            # the new deadline is set first, so the watchdog never sees the old one without a stall
+            self._deadline = now + interval
+            stall = self._stall
+            if stall is not None:
+                self._stall = None
+                stall.duration = max(stall.duration, lag)
+                stall.ongoing = False
+                _log.warning(f"Event loop was blocked for {stall.duration:.3f}s by {stall.task or 'a callback'}")
+        # the watchdog thread ends on its own once it sees the stop flag
+
+    def _watchdog(self) -> None:
+        """Runs in its own thread and captures the loop thread's stack while it is blocked"""
+        threshold = self._app.settings.loop_monitor_threshold
+        while not self._stopped.wait(threshold / 2):
+            now = time.monotonic()
+            lag = now - self._deadline
+            stall = self._stall
+            if lag < threshold:
+                continue
+            if stall is not None:
+                stall.duration = lag
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = traceback.format_stack(frame) if frame is not None else []
+            task = asyncio.current_task(self._loop) if self._loop is not None else None
+            stall = LoopStall(
+                started=datetime.now(),
+                duration=lag,
+                task=task.get_name() if task is not None else None,
+                stack=stack,
+            )
+            self._stall = stall
+            self.stalls.append(stall)
+            self._stalls_total.inc()
+            _log.warning(
+                f"Event loop blocked for more than {threshold}s in {stall.task or 'a callback'}:\n"
+                + "".join(stack)
+            )
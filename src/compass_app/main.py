@@ -19,12 +19,18 @@ from el import terminal
 from el.observable import Observable, filters
 from el.path_utils import abspath
 
-from compass_app.config import Config, Settings
+from compass_app import weeks
+from compass_app.config import Config
+from compass_app.settings_store import SettingsStore
 from compass_app.dcbot import DiscordBot
 from compass_app.database import CompassDB
+from compass_app.http_client import CompassHTTP
 from compass_app.webserver import CompassWeb
 from compass_app.auth import CompassAuth
 from compass_app.cli import CompassCLI
+from compass_app.scheduler import CompassScheduler
+from compass_app.loop_monitor import LoopMonitor
+from compass_app.profiler import CompassProfiler
 from compass_app.sleep_tracking import SleepTracking
 from compass_app.habitica import CompassHabitica
 from compass_app.accountability.manager import AccountabilityManager
@@ -73,15 +79,21 @@ class CompassApp:
 
         # load static config and dynamic settings file
         self.config = Config.model_load_from_disk(self._config_path)
-        self.settings = Settings.model_load_from_disk(self._settings_path, create_if_missing=True)
+        self.settings_store = SettingsStore(self, self._settings_path)
+        self.settings = self.settings_store.settings
+        weeks.configure(self.config.calendar_first_year, self.config.calendar_last_year)
 
         # core subsystems
         # db needs to be setup first, so that everything else can use it
         self.db = CompassDB(self)
+        self.http = CompassHTTP(self)
         self.web = CompassWeb(self)
         self.auth = CompassAuth(self)
         self.bot = DiscordBot(self)
         self.cli = CompassCLI(self)
+        self.scheduler = CompassScheduler(self)
+        self.loop_monitor = LoopMonitor(self)
+        self.profiler = CompassProfiler(self)
 
         # application modules
         self.accountability = AccountabilityManager(self)
@@ -99,10 +111,15 @@ class CompassApp:
         # run the application
         await asyncio.gather(
             self.db.run(),
+            self.settings_store.run(),
+            self.http.run(),
             self.web.run(),
             self.auth.run(),
             self.bot.run(),
             self.cli.run(),
+            self.scheduler.run(),
+            self.loop_monitor.run(),
+            self.profiler.run(),
 
             self.accountability.run(),
             self.sleep.run(),
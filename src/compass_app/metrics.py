@@ -0,0 +1,290 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+19.10.26, 00:20
+
+Minimal Prometheus compatible metrics.
+
+Metrics are plain counters that are updated in place, so recording a value
+costs a few arithmetic operations and no allocations. Labeled metrics
+create a child per label combination the first time it is used. On hot
+paths, the child should be looked up once and kept (e.g. in a module level
+constant) instead of calling `labels()` for every event.
+
+All metrics of the app are defined at the bottom of this module and are
+rendered in the Prometheus text format by `/metrics` of the web server.
+"""
+
+import math
+import time
+import bisect
+import typing
+import functools
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    """Monotonically increasing value"""
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def _samples(self, name: str, labels: str) -> typing.Iterator[str]:
+        yield f"{name}_total{labels} {_format_value(self.value)}"
+
+
+class Gauge:
+    """Value that can go up and down or is read from a function when collected"""
+    __slots__ = ("value", "_function")
+
+    def __init__(self):
+        self.value = 0.0
+        self._function: typing.Callable[[], float] | None = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set_function(self, function: typing.Callable[[], float]) -> None:
+        """Reads the value from a function whenever the metrics are collected"""
+        self._function = function
+
+    def _samples(self, name: str, labels: str) -> typing.Iterator[str]:
+        value = self.value
+        if self._function is not None:
+            try:
+                value = float(self._function())
+            except Exception:
+                value = math.nan
+        yield f"{name}{labels} {_format_value(value)}"
+
+
+# default buckets in seconds, from sub-millisecond SQL statements to slow discord requests
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+
+class Histogram:
+    """
+    Distribution of observed values in fixed buckets. The bucket counts are
+    stored per bucket and only accumulated when collected.
+    """
+    __slots__ = ("_bounds", "_counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self._bounds = tuple(buckets) + (math.inf,)
+        self._counts = [0] * len(self._bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> "_Timer":
+        """Context manager observing the time spent in it"""
+        return _Timer(self)
+
+    def _samples(self, name: str, labels: str) -> typing.Iterator[str]:
+        # the le label is added to the other labels of the child
+        prefix = labels[:-1] + "," if labels else "{"
+        cumulative = 0
+        for bound, count in zip(self._bounds, self._counts):
+            cumulative += count
+            yield f'{name}_bucket{prefix}le="{_format_value(bound)}"}} {cumulative}'
+        yield f"{name}_sum{labels} {_format_value(self.sum)}"
+        yield f"{name}_count{labels} {self.count}"
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+
+    def __enter__(self) -> None:
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+Metric = typing.TypeVar("Metric", Counter, Gauge, Histogram)
+
+
+class MetricFamily(typing.Generic[Metric]):
+    """A metric with a name, a help text and optional labels"""
+
+    def __init__(
+        self,
+        kind: str,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...],
+        factory: typing.Callable[[], Metric],
+    ):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._factory = factory
+        self._children: dict[tuple[str, ...], Metric] = {}
+        if len(labelnames) == 0:
+            self._children[()] = factory()
+
+    def labels(self, *values: str) -> Metric:
+        """
+        Returns the metric of a label combination, creating it on first use.
+        Metrics without labels are returned by `labels()` without arguments.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            child = self._children[values] = self._factory()
+        return child
+
+    def render(self) -> typing.Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in list(self._children.items()):
+            yield from child._samples(self.name, _format_labels(self.labelnames, values))
+
+
+class Registry:
+
+    def __init__(self):
+        self._families: dict[str, MetricFamily] = {}
+
+    def _register(self, family: MetricFamily) -> MetricFamily:
+        if family.name in self._families:
+            raise ValueError(f"Metric {family.name} is already registered")
+        self._families[family.name] = family
+        return family
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> MetricFamily[Counter]:
+        return self._register(MetricFamily("counter", name, documentation, labelnames, Counter))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> MetricFamily[Gauge]:
+        return self._register(MetricFamily("gauge", name, documentation, labelnames, Gauge))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> MetricFamily[Histogram]:
+        return self._register(MetricFamily(
+            "histogram", name, documentation, labelnames, functools.partial(Histogram, buckets)
+        ))
+
+    def render(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format"""
+        lines = []
+        for family in list(self._families.values()):
+            lines.extend(family.render())
+        lines.append("")
+        return "\n".join(lines)
+
+
+def timed(histogram: Histogram):
+    """Decorator observing the run time of a coroutine function"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+REGISTRY = Registry()
+
+# discord bot
+LISTENER_SECONDS = REGISTRY.histogram(
+    "compass_discord_listener_seconds", "Run time of discord event listeners", ("listener",)
+)
+COMMAND_SECONDS = REGISTRY.histogram(
+    "compass_discord_command_seconds", "Run time of slash commands", ("command", "result")
+)
+GATEWAY_LATENCY = REGISTRY.gauge(
+    "compass_discord_gateway_latency_seconds", "Latency between a gateway heartbeat and its acknowledgement"
+)
+REST_SECONDS = REGISTRY.histogram(
+    "compass_discord_rest_seconds", "Duration of discord REST requests", ("method",)
+)
+REST_RATE_LIMITED = REGISTRY.counter(
+    "compass_discord_rest_rate_limited", "Discord REST responses with status 429"
+)
+OUTBOUND_CALL_SECONDS = REGISTRY.histogram(
+    "compass_outbound_call_seconds", "Duration of discord calls of the outbound queue, including retries by discord.py", ("route",)
+)
+OUTBOUND_ACTIONS = REGISTRY.counter(
+    "compass_outbound_actions", "Attempts to perform outbound actions, by result", ("result",)
+)
+
+# third-party APIs
+HTTP_SECONDS = REGISTRY.histogram(
+    "compass_http_request_seconds", "Duration of requests of the shared HTTP client until the response headers", ("host",)
+)
+AUTH_TOKEN_REFRESHES = REGISTRY.counter(
+    "compass_auth_token_refreshes", "Refreshes of discord OAuth tokens, by result", ("result",)
+)
+
+# database
+SQL_SECONDS = REGISTRY.histogram(
+    "compass_db_statement_seconds", "Duration of SQL statements", ("engine",)
+)
+SQL_ERRORS = REGISTRY.counter(
+    "compass_db_statement_errors", "SQL statements that raised an error", ("engine",)
+)
+SESSION_SECONDS = REGISTRY.histogram(
+    "compass_db_session_seconds", "Time sessions are open, including waiting for the connection", ("engine",)
+)
+
+# event loop
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "compass_loop_lag_seconds", "Delay of the event loop in waking up the lag sampler"
+)
+LOOP_STALLS = REGISTRY.counter(
+    "compass_loop_stalls", "Times the event loop was blocked for longer than the threshold"
+)
+
+# automations
+SCHEDULER_RUNS = REGISTRY.counter(
+    "compass_scheduler_runs", "Runs of scheduled jobs, by result", ("job", "result")
+)
@@ -0,0 +1,228 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 13:40
+
+Versioned database schema migrations.
+
+The schema version is stored in the SQLite `user_version` header field.
+On startup, all migrations newer than the stored version are applied
+in order, each in its own transaction together with its version update.
+If the schema is already current, no DDL statements are executed at all.
+
+Migrations must be idempotent, because a fresh database is created from
+the current table definitions, which may already contain what a later
+migration adds. Use the helpers below which check before they create.
+"""
+
+import typing
+import logging
+
+from sqlmodel import SQLModel
+from sqlalchemy import Column, text
+from sqlalchemy.engine import Connection
+
+_log = logging.getLogger(__name__)
+
+
+def get_version(conn: Connection) -> int:
+    return conn.execute(text("PRAGMA user_version")).scalar_one()
+
+
+def _set_version(conn: Connection, version: int) -> None:
+    # pragmas can't be parametrized, so the version is validated
+    conn.execute(text(f"PRAGMA user_version = {int(version)}"))
+
+
+def _create_tables(conn: Connection, *names: str) -> None:
+    """Creates the named tables and their indices if they don't exist"""
+    SQLModel.metadata.create_all(
+        conn,
+        tables=[SQLModel.metadata.tables[name] for name in names]
+    )
+
+
+def _create_indices(conn: Connection, table_name: str) -> None:
+    """Creates all indices declared on a table that don't exist yet"""
+    for index in SQLModel.metadata.tables[table_name].indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _add_column(conn: Connection, table_name: str, column_name: str) -> None:
+    """Adds a column declared on a table if it doesn't exist yet"""
+    existing = {
+        row[1] for row in conn.execute(text(f'PRAGMA table_info("{table_name}")'))
+    }
+    if column_name in existing:
+        return
+    column: Column = SQLModel.metadata.tables[table_name].columns[column_name]
+    col_type = column.type.compile(dialect=conn.dialect)
+    conn.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN "{column_name}" {col_type}'))
+
+
+def _merge_duplicate_periods(conn: Connection) -> None:
+    """Merges periods of the same week into the oldest one, together with their entries"""
+    duplicates = conn.execute(text(
+        "SELECT year, week, MIN(id) FROM accountability_period "
+        "GROUP BY year, week HAVING COUNT(*) > 1"
+    )).all()
+    for year, week, kept_id in duplicates:
+        _log.warning(f"Merging duplicate accountability periods of week {week}/{year} into period {kept_id}")
+        params = {"year": year, "week": week, "kept": kept_id}
+        # threads of the kept period are only filled in, never replaced
+        conn.execute(text(
+            "UPDATE accountability_period SET "
+            "goal_channel_id = COALESCE(goal_channel_id, ("
+            "    SELECT goal_channel_id FROM accountability_period "
+            "    WHERE year = :year AND week = :week AND goal_channel_id IS NOT NULL ORDER BY id LIMIT 1"
+            ")), "
+            "result_channel_id = COALESCE(result_channel_id, ("
+            "    SELECT result_channel_id FROM accountability_period "
+            "    WHERE year = :year AND week = :week AND result_channel_id IS NOT NULL ORDER BY id LIMIT 1"
+            ")) "
+            "WHERE id = :kept"
+        ), params)
+        conn.execute(text(
+            "UPDATE accountability_entry SET period_id = :kept WHERE period_id IN ("
+            "    SELECT id FROM accountability_period WHERE year = :year AND week = :week AND id != :kept"
+            ")"
+        ), params)
+        conn.execute(text(
+            "DELETE FROM accountability_period WHERE year = :year AND week = :week AND id != :kept"
+        ), params)
+
+
+def _merge_duplicate_entries(conn: Connection) -> None:
+    """
+    Merges entries of the same user and period into the oldest one. Like for
+    messages, the first goal and result win, the others are removed.
+    """
+    duplicates = conn.execute(text(
+        "SELECT user_id, period_id, MIN(id) FROM accountability_entry "
+        "GROUP BY user_id, period_id HAVING COUNT(*) > 1"
+    )).all()
+    if len(duplicates) > 0:
+        _log.warning(f"Merging {len(duplicates)} duplicate accountability entries")
+    for user_id, period_id, kept_id in duplicates:
+        rows = conn.execute(text(
+            "SELECT id, goal_id, result_id FROM accountability_entry "
+            "WHERE user_id = :user_id AND period_id = :period_id ORDER BY id"
+        ), {"user_id": user_id, "period_id": period_id}).all()
+        goal_id = next((goal for _, goal, _ in rows if goal is not None), None)
+        result_id = next((result for _, _, result in rows if result is not None), None)
+        conn.execute(text(
+            "UPDATE accountability_entry SET goal_id = :goal_id, result_id = :result_id WHERE id = :id"
+        ), {"goal_id": goal_id, "result_id": result_id, "id": kept_id})
+        conn.execute(
+            text("DELETE FROM accountability_entry WHERE id = :id"),
+            [{"id": entry_id} for entry_id, _, _ in rows if entry_id != kept_id],
+        )
+        for table, column, kept in (("accountability_goal", 1, goal_id), ("accountability_result", 2, result_id)):
+            dropped = [{"id": row[column]} for row in rows if row[column] is not None and row[column] != kept]
+            if len(dropped) > 0:
+                conn.execute(text(f"DELETE FROM {table} WHERE id = :id"), dropped)
+
+
+def _v1_hot_path_indices(conn: Connection) -> None:
+    """
+    Initial schema with indices on hot accountability lookup columns.
+
+    Adds indices on the goal/result thread IDs of periods, a unique index
+    on the period week and a unique index on the user+period of entries.
+    Duplicates that would violate the unique indices are merged first.
+    """
+    _create_tables(
+        conn,
+        "compass_user",
+        "accountability_period",
+        "accountability_goal",
+        "accountability_result",
+        "accountability_entry",
+    )
+
+    # the unique indices can't be created if there are already duplicates,
+    # merging periods can create duplicate entries, so they are merged last
+    _merge_duplicate_periods(conn)
+    _merge_duplicate_entries(conn)
+
+    _create_indices(conn, "accountability_period")
+    _create_indices(conn, "accountability_entry")
+
+
+def _v2_scheduler(conn: Connection) -> None:
+    """Table for the last run markers of scheduled jobs"""
+    _create_tables(conn, "scheduler_run")
+
+
+def _v3_scores(conn: Connection) -> None:
+    """Materialized accountability score tables"""
+    _create_tables(conn, "accountability_score", "accountability_user_score")
+    # fill them from the results recorded so far
+    from compass_app.accountability import scoring
+    conn.execute(text(scoring.INSERT_PERIOD_SCORES.format(where="")))
+    conn.execute(text(scoring.INSERT_USER_SCORES.format(where="")))
+
+
+def _v4_checkpoints(conn: Connection) -> None:
+    """Per-thread checkpoints for catching up on missed messages"""
+    _create_tables(conn, "accountability_checkpoint")
+
+
+def _v5_outbox(conn: Connection) -> None:
+    """Outbox of pending discord side effects of accountability changes"""
+    _create_tables(conn, "accountability_outbox")
+
+
+def _v6_token_expiry(conn: Connection) -> None:
+    """Expiry of discord OAuth tokens of users, for refreshing them ahead of time"""
+    _add_column(conn, "compass_user", "token_expires_at")
+    _create_indices(conn, "compass_user")
+
+
+def _v7_revoked_sessions(conn: Connection) -> None:
+    """Web sessions that have been revoked before they expire"""
+    # registers the table, which is otherwise only imported with the auth subsystem
+    from compass_app import sessions
+    _create_tables(conn, sessions.RevokedSession.__tablename__)
+
+
+def _v8_import_progress(conn: Connection) -> None:
+    """Progress of bulk imports of accountability data"""
+    _create_tables(conn, "accountability_import_progress")
+
+
+# all migrations in order, the version of a migration is its position in the list
+MIGRATIONS: list[typing.Callable[[Connection], None]] = [
+    _v1_hot_path_indices,
+    _v2_scheduler,
+    _v3_scores,
+    _v4_checkpoints,
+    _v5_outbox,
+    _v6_token_expiry,
+    _v7_revoked_sessions,
+    _v8_import_progress,
+]
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def upgrade(conn: Connection) -> None:
+    """Applies all migrations that are missing in the database"""
+    version = get_version(conn)
+    if version == LATEST_VERSION:
+        _log.debug(f"Database schema is up to date (version {version})")
+        return
+    if version > LATEST_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than supported version {LATEST_VERSION}")
+
+    for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        _log.info(f"Migrating database schema to version {target}: {migration.__doc__.strip().splitlines()[0]}")
+        # pysqlite runs DDL outside of a transaction unless DML has opened one,
+        # so the transaction is explicit to roll back all of a failed migration
+        conn.exec_driver_sql("BEGIN")
+        try:
+            migration(conn)
+            _set_version(conn, target)
+        except BaseException:
+            conn.exec_driver_sql("ROLLBACK")
+            raise
+        conn.exec_driver_sql("COMMIT")
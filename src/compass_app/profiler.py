@@ -0,0 +1,226 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+19.10.26, 02:00
+
+On-demand profiling of the running app.
+
+The sampling profiler records two kinds of stacks in the collapsed format
+used by flamegraph tools (e.g. flamegraph.pl, speedscope):
+ - "thread;..." stacks of all threads, sampled from a separate thread.
+   This shows where CPU time is spent and what blocks the event loop.
+ - "task;..." await chains of all suspended asyncio tasks, sampled on the
+   loop. This shows where coroutines spend their (wall clock) time waiting,
+   e.g. on the database or discord.
+
+In trace mode, cProfile additionally profiles the loop thread
+deterministically, which is written as a pstats file.
+"""
+
+import sys
+import types
+import typing
+import marshal
+import asyncio
+import cProfile
+import logging
+import threading
+import collections
+from pathlib import Path
+from datetime import datetime
+
+from el.observable import filters
+from el.async_tools import create_bg_task
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+def _coroutine_frames(coro: typing.Any) -> typing.Iterator[types.FrameType]:
+    """Follows the await chain of a coroutine from the outermost one"""
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            return
+        yield frame
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+
+
+class CompassProfiler:
+    """
+    Profiler that can be attached to the live process for a bounded time
+    window. Profiles are written to `<data_path>/profiles`.
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        # collapsed stacks and their counts, written by the sampler thread and the loop
+        self._samples = collections.Counter[str]()
+        self._lock = threading.Lock()
+        self._sample_count = 0
+        self._labels: dict[types.CodeType, str] = {}
+        self._cprofile: cProfile.Profile | None = None
+        self._stopped = threading.Event()
+        self._sampler: threading.Thread | None = None
+        self._task_sampler: asyncio.TimerHandle | None = None
+        self._deadline: asyncio.TimerHandle | None = None
+        self._started: datetime | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._started is not None
+
+    @property
+    def started(self) -> datetime | None:
+        return self._started
+
+    @property
+    def sample_count(self) -> int:
+        return self._sample_count
+
+    def start(self, duration: float | None = None, trace: bool = False) -> None:
+        """
+        Starts profiling. This must be called on the event loop.
+
+        Parameters
+        ----------
+        duration : float | None, optional
+            seconds after which profiling is stopped and the profile written,
+            by default `profile_max_duration`
+        trace : bool, optional
+            whether to also profile the loop thread with cProfile, which is
+            exact but slows down everything running on the loop
+
+        Raises
+        ------
+        RuntimeError
+            The profiler is already running
+        """
+        if self.running:
+            raise RuntimeError("The profiler is already running")
+        settings = self._app.settings
+        duration = min(duration or settings.profile_max_duration, settings.profile_max_duration)
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            self._samples.clear()
+        self._sample_count = 0
+        self._started = datetime.now()
+        self._stopped.clear()
+        if trace:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+        self._sampler = threading.Thread(
+            target=self._sample_threads,
+            args=(settings.profile_sample_interval,),
+            name="profile-sampler",
+            daemon=True,
+        )
+        self._sampler.start()
+        self._task_sampler = loop.call_later(settings.profile_sample_interval, self._sample_tasks)
+        self._deadline = loop.call_later(duration, lambda: create_bg_task(self._stop_after_deadline()))
+        _log.info(f"Profiling for up to {duration:.0f}s{' with cProfile' if trace else ''}")
+
+    async def stop(self) -> list[Path]:
+        """Stops profiling and writes the profile, returns the written files"""
+        if not self.running:
+            raise RuntimeError("The profiler is not running")
+        self._stopped.set()
+        self._task_sampler.cancel()
+        self._deadline.cancel()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        paths = await self.dump()
+        self._started = None
+        self._cprofile = None
+        return paths
+
+    async def dump(self) -> list[Path]:
+        """Writes the profile collected so far without stopping, returns the written files"""
+        if not self.running:
+            raise RuntimeError("The profiler is not running")
+        directory = self._app.data_path / "profiles"
+        base = directory / f"profile-{self._started:%Y%m%d-%H%M%S}"
+        with self._lock:
+            samples = list(self._samples.items())
+
+        stats = None
+        if self._cprofile is not None:
+            # create_stats() disables the profiler, it keeps its data when it is enabled again
+            self._cprofile.create_stats()
+            stats = dict(self._cprofile.stats)
+            if not self._stopped.is_set():
+                self._cprofile.enable()
+
+        # file IO happens off the loop
+        def write() -> list[Path]:
+            directory.mkdir(parents=True, exist_ok=True)
+            paths = [base.with_suffix(".collapsed")]
+            paths[0].write_text("".join(f"{stack} {count}\n" for stack, count in samples))
+            if stats is not None:
+                paths.append(base.with_suffix(".pstats"))
+                with open(paths[1], "wb") as file:
+                    marshal.dump(stats, file)
+            return paths
+        paths = await asyncio.to_thread(write)
+        _log.info(f"Wrote profile with {self._sample_count} samples to {', '.join(str(p) for p in paths)}")
+        return paths
+
+    async def _stop_after_deadline(self) -> None:
+        if self.running:
+            await self.stop()
+
+    async def run(self) -> None:
+        exited = asyncio.Event()
+        self._app.exited >> filters.call_if_true(exited.set)
+        await exited.wait()
+        # keep what has been profiled until now
+        if self.running:
+            await self.stop()
+
+    def _label(self, code: types.CodeType) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_qualname} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+        return label
+
+    def _sample_threads(self, interval: float) -> None:
+        """Runs in its own thread and samples the stacks of all other threads"""
+        own = threading.get_ident()
+        names: dict[int, str] = {}
+        while not self._stopped.wait(interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                name = names.get(thread_id)
+                if name is None:
+                    names.update((t.ident, t.name) for t in threading.enumerate())
+                    name = names.get(thread_id, str(thread_id))
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(name)
+                stack.append("thread")
+                key = ";".join(reversed(stack))
+                with self._lock:
+                    self._samples[key] += 1
+            self._sample_count += 1
+
+    def _sample_tasks(self) -> None:
+        """Runs on the loop, where all tasks are suspended, and samples their await chains"""
+        if self._stopped.is_set():
+            return
+        for task in asyncio.all_tasks():
+            coro = task.get_coro()
+            stack = ["task", getattr(coro, "__qualname__", type(coro).__name__)]
+            stack.extend(self._label(frame.f_code) for frame in _coroutine_frames(coro))
+            key = ";".join(stack)
+            with self._lock:
+                self._samples[key] += 1
+        self._task_sampler = asyncio.get_running_loop().call_later(
+            self._app.settings.profile_sample_interval, self._sample_tasks
+        )
@@ -0,0 +1,240 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 14:25
+
+Persistent job scheduler for timed automations
+"""
+
+import heapq
+import typing
+import asyncio
+import logging
+import dataclasses
+from datetime import datetime, time, timezone, timedelta
+
+from sqlmodel import SQLModel, Field, select
+from sqlalchemy import String
+from sqlalchemy.dialects.sqlite import insert
+from el.observable import filters
+from el.async_tools import create_bg_task
+
+from compass_app import metrics
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+# returns the next time a job should run after the provided time or None if it shouldn't run
+NextFireFunction = typing.Callable[[datetime], datetime | None]
+# called with the time the job was scheduled for
+JobCallback = typing.Callable[[datetime], typing.Awaitable[None]]
+
+
+class SchedulerRun(SQLModel, table=True):
+    """Time of the last run of every scheduled job"""
+    __tablename__ = "scheduler_run"
+
+    job: str            = Field(sa_type=String(100), primary_key=True)
+    last_run: datetime
+
+
+@dataclasses.dataclass
+class ScheduledJob:
+    name: str
+    next_fire: NextFireFunction
+    callback: JobCallback
+    # whether a run that was missed while the app was not running is done on startup
+    catch_up: bool = True
+    # time the job is currently scheduled for
+    due: datetime | None = None
+    last_run: datetime | None = None
+
+
+def weekly(
+    weekday: typing.Callable[[], int],
+    at: typing.Callable[[], time],
+    enabled: typing.Callable[[], bool] = lambda: True,
+) -> NextFireFunction:
+    """
+    Creates a next fire function for a job that runs once a week.
+    The parameters are functions, so they are always evaluated with
+    the current settings.
+
+    Parameters
+    ----------
+    weekday : () -> int
+        ISO day of the week to run on (Monday = 0)
+    at : () -> time
+        UTC time of the day to run at
+    enabled : () -> bool, optional
+        whether the job should run at all, by default always
+    """
+    def next_fire(after: datetime) -> datetime | None:
+        if not enabled():
+            return None
+        candidate = datetime.combine(after.date(), at(), timezone.utc)
+        candidate += timedelta(days=(weekday() - after.weekday()) % 7)
+        if candidate <= after:
+            candidate += timedelta(days=7)
+        return candidate
+    return next_fire
+
+
+class CompassScheduler:
+    """
+    Runs registered jobs at the times calculated by their next fire function.
+
+    The scheduler keeps a heap of upcoming runs and sleeps exactly until the
+    earliest one is due. The time of the last run of every job is stored in
+    the database, so runs that were missed while the app was not running
+    are caught up on startup (multiple missed runs of a job are coalesced
+    into one).
+    """
+
+    # upper limit for a single sleep, so wall clock jumps (e.g. suspend or time sync)
+    # can't delay a job for longer than this
+    MAX_SLEEP = 3600
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        self._jobs: dict[str, ScheduledJob] = {}
+        self._heap: list[tuple[datetime, int, str]] = []
+        self._seq = 0
+        self._wake = asyncio.Event()
+        self._started = False
+
+    def add_job(
+        self,
+        name: str,
+        next_fire: NextFireFunction,
+        callback: JobCallback,
+        catch_up: bool = True,
+    ) -> None:
+        """
+        Registers a new job. This should be done during app initialization,
+        so that missed runs can be caught up on startup.
+        """
+        if name in self._jobs:
+            raise ValueError(f"Job '{name}' is already registered")
+        self._jobs[name] = ScheduledJob(name, next_fire, callback, catch_up)
+        if self._started:
+            self.reschedule(name)
+
+    def reschedule(self, name: str | None = None) -> None:
+        """
+        Recalculates the next run time of a job (or all jobs), e.g. after
+        its settings have changed.
+        """
+        now = datetime.now(timezone.utc)
+        jobs = self._jobs.values() if name is None else [self._jobs[name]]
+        for job in jobs:
+            self._schedule(job, job.next_fire(now))
+
+    def next_run(self, name: str) -> datetime | None:
+        """Returns the time a job is scheduled for next"""
+        return self._jobs[name].due
+
+    def _schedule(self, job: ScheduledJob, due: datetime | None) -> None:
+        job.due = due
+        if due is not None:
+            # outdated heap entries are skipped when popped
+            heapq.heappush(self._heap, (due, self._seq, job.name))
+            self._seq += 1
+            _log.debug(f"Scheduled job '{job.name}' for {due}")
+        self._wake.set()
+
+    def _catch_up_time(self, job: ScheduledJob, now: datetime) -> datetime | None:
+        """Returns the latest missed run of a job or None if no run was missed"""
+        if job.last_run is None or not job.catch_up:
+            return None
+        missed = None
+        due = job.next_fire(job.last_run)
+        while due is not None and due <= now:
+            missed = due
+            due = job.next_fire(due)
+        return missed
+
+    async def _load_last_runs(self) -> None:
+        async with self._app.db.read_session() as session:
+            runs = (await session.exec(select(SchedulerRun))).all()
+        for run in runs:
+            if run.job in self._jobs:
+                # sqlite doesn't store the timezone
+                self._jobs[run.job].last_run = run.last_run.replace(tzinfo=timezone.utc)
+
+    async def _store_last_run(self, job: ScheduledJob) -> None:
+        async with self._app.db.session() as session:
+            stmt = insert(SchedulerRun).values(job=job.name, last_run=job.last_run)
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=[SchedulerRun.job],
+                set_={"last_run": stmt.excluded.last_run}
+            ))
+
+    async def _run_job(self, job: ScheduledJob, due: datetime) -> None:
+        _log.info(f"Running scheduled job '{job.name}' (due {due})")
+        try:
+            await job.callback(due)
+            metrics.SCHEDULER_RUNS.labels(job.name, "ok").inc()
+        except Exception as e:
+            metrics.SCHEDULER_RUNS.labels(job.name, "error").inc()
+            _log.error(f"Scheduled job '{job.name}' failed: {e}", exc_info=e)
+
+        # the marker is the scheduled time, so the next run is calculated from it
+        job.last_run = due
+        try:
+            await self._store_last_run(job)
+        except Exception as e:
+            _log.warning(f"Failed to store last run of job '{job.name}': {e}")
+
+        # only schedule the next run if nothing else did so in the meantime
+        if job.due == due:
+            self._schedule(job, job.next_fire(max(due, datetime.now(timezone.utc))))
+
+    async def run(self) -> None:
+        exited = asyncio.Event()
+        def on_exit():
+            exited.set()
+            self._wake.set()
+        self._app.exited >> filters.call_if_true(on_exit)
+
+        try:
+            await self._load_last_runs()
+        except Exception as e:
+            _log.warning(f"Failed to load scheduler state, missed jobs will not be caught up: {e}")
+
+        # initial scheduling, including catch up of missed runs
+        now = datetime.now(timezone.utc)
+        for job in self._jobs.values():
+            missed = self._catch_up_time(job, now)
+            if missed is not None:
+                _log.info(f"Job '{job.name}' missed its run at {missed}, catching up")
+                self._schedule(job, missed)
+            else:
+                self._schedule(job, job.next_fire(now))
+        self._started = True
+        # the next fire functions read the settings, so changes can move any job
+        self._app.settings_store.changed >> (lambda _: self.reschedule())
+
+        while not exited.is_set():
+            self._wake.clear()
+
+            # run all jobs that are due, skipping outdated heap entries
+            now = datetime.now(timezone.utc)
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                due, _, name = heapq.heappop(self._heap)
+                job = self._jobs[name]
+                if job.due != due:
+                    continue
+                create_bg_task(self._run_job(job, due))
+
+            # sleep until the next job is due or the schedule changes
+            timeout = self.MAX_SLEEP
+            if len(self._heap) > 0:
+                timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except TimeoutError:
+                pass
@@ -0,0 +1,225 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+19.10.26, 04:10
+
+Signed session tokens of the web app.
+
+A session token carries everything an endpoint needs to know about the
+user (ID, discord ID and roles) and is signed with HMAC-SHA256, so it can
+be verified in memory without looking anything up in the database.
+Tokens expire on their own. Sessions that end earlier (logout) are
+recorded in a revocation table, which is kept in memory as well.
+"""
+
+import os
+import hmac
+import json
+import time
+import base64
+import typing
+import asyncio
+import hashlib
+import logging
+import secrets
+import dataclasses
+from datetime import datetime, timezone
+
+from fastapi import Request, HTTPException
+from sqlmodel import SQLModel, Field, select
+from sqlalchemy import String, delete
+from el.observable import filters
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+COOKIE_NAME = "compass_session"
+
+
+class RevokedSession(SQLModel, table=True):
+    """Sessions that have been ended before their token expires"""
+    __tablename__ = "auth_revoked_session"
+
+    session_id: str     = Field(sa_type=String(32), primary_key=True)
+    # the entry is only needed until the token expires anyway
+    expires_at: datetime = Field(index=True)
+
+
+@dataclasses.dataclass(frozen=True)
+class Session:
+    """Contents of a verified session token"""
+    session_id: str
+    user_id: int
+    discord_id: int
+    roles: frozenset[str]
+    # unix timestamps
+    issued_at: int
+    expires_at: int
+
+    def has_role(self, role: str) -> bool:
+        return role in self.roles
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class SessionManager:
+    """
+    Issues and verifies session tokens of the form `<payload>.<signature>`,
+    where the payload is base64 encoded JSON and the signature the HMAC of
+    the encoded payload.
+
+    The signing key is `session_secret` of the config or, if that isn't set,
+    a random key generated once and stored in `<data_path>/session_secret`.
+    """
+
+    def __init__(self, app: "CompassApp"):
+        self._app = app
+        self._key = self._load_key()
+        # revoked session IDs and when their tokens expire
+        self._revoked: dict[str, int] = {}
+
+    def _load_key(self) -> bytes:
+        if self._app.config.session_secret is not None:
+            return self._app.config.session_secret.encode()
+        path = self._app.data_path / "session_secret"
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            pass
+        key = secrets.token_bytes(32)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # the key can forge sessions, so only the owner may read it
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            file.write(key)
+        _log.info(f"Generated new session signing key in {path}")
+        return key
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.digest(self._key, payload.encode(), hashlib.sha256))
+
+    def issue(self, user_id: int, discord_id: int, roles: typing.Iterable[str] = ()) -> tuple[str, Session]:
+        """
+        Creates a session valid for `auth_session_lifetime` seconds.
+
+        Returns
+        -------
+        tuple[str, Session]
+            the signed token and the session it contains
+        """
+        now = int(time.time())
+        session = Session(
+            session_id=secrets.token_urlsafe(16),
+            user_id=user_id,
+            discord_id=discord_id,
+            roles=frozenset(roles),
+            issued_at=now,
+            expires_at=now + int(self._app.settings.auth_session_lifetime),
+        )
+        payload = _b64encode(json.dumps({
+            "sid": session.session_id,
+            "uid": session.user_id,
+            # discord IDs exceed the integers some JSON parsers can represent exactly
+            "did": str(session.discord_id),
+            "roles": sorted(session.roles),
+            "iat": session.issued_at,
+            "exp": session.expires_at,
+        }, separators=(",", ":")).encode())
+        return f"{payload}.{self._sign(payload)}", session
+
+    def verify(self, token: str) -> Session | None:
+        """Returns the session of a token or None if it is invalid, expired or revoked"""
+        payload, _, signature = token.partition(".")
+        if not hmac.compare_digest(signature.encode(), self._sign(payload).encode()):
+            return None
+        try:
+            data = json.loads(_b64decode(payload))
+            session = Session(
+                session_id=data["sid"],
+                user_id=data["uid"],
+                discord_id=int(data["did"]),
+                roles=frozenset(data["roles"]),
+                issued_at=data["iat"],
+                expires_at=data["exp"],
+            )
+        except (ValueError, KeyError, TypeError):
+            return None
+        if session.expires_at <= time.time() or session.session_id in self._revoked:
+            return None
+        return session
+
+    async def revoke(self, session: Session) -> None:
+        """Ends a session before its token expires"""
+        self._revoked[session.session_id] = session.expires_at
+        async with self._app.db.session() as db_session:
+            await db_session.merge(RevokedSession(
+                session_id=session.session_id,
+                expires_at=datetime.fromtimestamp(session.expires_at, timezone.utc),
+            ))
+
+    async def __call__(self, request: Request) -> Session:
+        """
+        FastAPI dependency returning the session of a request, from the
+        session cookie or an `Authorization: Bearer` header.
+
+        Raises
+        ------
+        HTTPException
+            401 if there is no valid session
+        """
+        token = request.cookies.get(COOKIE_NAME)
+        if token is None:
+            scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+            if scheme.lower() == "bearer":
+                token = credentials
+        session = self.verify(token) if token else None
+        if session is None:
+            raise HTTPException(status_code=401, detail="Not logged in", headers={"WWW-Authenticate": "Bearer"})
+        return session
+
+    def require_role(self, role: str) -> typing.Callable[[Request], typing.Awaitable[Session]]:
+        """FastAPI dependency returning the session of a request if it has a role, 403 otherwise"""
+        async def dependency(request: Request) -> Session:
+            session = await self(request)
+            if not session.has_role(role):
+                raise HTTPException(status_code=403, detail=f"Requires the {role} role")
+            return session
+        return dependency
+
+    async def run(self) -> None:
+        exited = asyncio.Event()
+        self._app.exited >> filters.call_if_true(exited.set)
+
+        try:
+            async with self._app.db.read_session() as session:
+                revoked = (await session.exec(select(RevokedSession))).all()
+            for entry in revoked:
+                self._revoked[entry.session_id] = int(entry.expires_at.replace(tzinfo=timezone.utc).timestamp())
+        except Exception as e:
+            _log.error(f"Failed to load revoked sessions: {e}", exc_info=e)
+
+        # entries of expired tokens are dropped once an hour
+        while True:
+            try:
+                await asyncio.wait_for(exited.wait(), 3600)
+                break
+            except TimeoutError:
+                pass
+            now = time.time()
+            self._revoked = {sid: exp for sid, exp in self._revoked.items() if exp > now}
+            try:
+                async with self._app.db.session() as session:
+                    await session.execute(
+                        delete(RevokedSession).where(RevokedSession.expires_at <= datetime.now(timezone.utc))
+                    )
+            except Exception as e:
+                _log.warning(f"Failed to remove expired revoked sessions: {e}")
@@ -0,0 +1,160 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+19.10.26, 02:40
+
+Persistence of the modifiable settings.
+
+Changes are written to disk after a short delay, so a burst of changes
+results in a single write. Writes happen in a worker thread and replace the
+file atomically, so a crash never leaves a truncated settings file behind.
+The file is also watched for external edits, which are applied to the live
+settings object.
+"""
+
+import os
+import typing
+import asyncio
+import logging
+import tempfile
+from pathlib import Path
+
+import pydantic
+from el.observable import Observable, filters
+
+from compass_app.config import Settings
+
+if typing.TYPE_CHECKING:
+    from compass_app.main import CompassApp
+
+_log = logging.getLogger(__name__)
+
+
+def _write_atomic(path: Path, content: str) -> os.stat_result:
+    """Writes a file through a temporary file that replaces it, returns the new file's stat"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    return path.stat()
+
+
+def _stat(path: Path) -> os.stat_result | None:
+    try:
+        return path.stat()
+    except FileNotFoundError:
+        return None
+
+
+class SettingsStore:
+    """
+    Owns the live `Settings` object of the app. The object is never
+    replaced, so everything can keep referencing `app.settings`.
+
+    Subscribers are notified through the `changed` observable, which is
+    incremented after every local `save()` and every reload of external
+    changes. `changed_fields` holds the names of the fields that changed last.
+    """
+
+    def __init__(self, app: "CompassApp", path: Path):
+        self._app = app
+        self._path = path
+        self.settings = Settings.model_load_from_disk(path, create_if_missing=True)
+        self.changed = Observable[int](0)
+        self.changed_fields: frozenset[str] = frozenset()
+        # stat of the file as we last wrote or read it, to tell external edits apart
+        self._known = _stat(path)
+        self._dirty = False
+        self._write_task: asyncio.Task | None = None
+
+    def save(self, fields: typing.Iterable[str] | None = None) -> None:
+        """
+        Persists the current settings after `settings_save_delay` seconds and
+        notifies subscribers right away. Must be called on the event loop.
+
+        Parameters
+        ----------
+        fields : Iterable[str] | None, optional
+            names of the changed fields for subscribers, by default all
+        """
+        self._dirty = True
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_later())
+        self._notify(Settings.model_fields.keys() if fields is None else fields)
+
+    async def flush(self) -> None:
+        """Writes pending changes right away"""
+        if self._write_task is not None and not self._write_task.done():
+            self._write_task.cancel()
+        if self._dirty:
+            await self._write()
+
+    def _notify(self, fields: typing.Iterable[str]) -> None:
+        self.changed_fields = frozenset(fields)
+        self.changed.value += 1
+
+    async def _write_later(self) -> None:
+        # changes within the delay are written together
+        await asyncio.sleep(self._app.settings.settings_save_delay)
+        await self._write()
+
+    async def _write(self) -> None:
+        self._dirty = False
+        # serialized on the loop, so the file is a consistent snapshot
+        content = self.settings.model_dump_json(indent=4)
+        try:
+            self._known = await asyncio.to_thread(_write_atomic, self._path, content)
+        except OSError as e:
+            self._dirty = True
+            _log.error(f"Failed to save settings to {self._path}: {e}")
+
+    async def _reload(self, stat: os.stat_result) -> None:
+        """Applies the settings file after it has been changed by someone else"""
+        self._known = stat
+        try:
+            content = await asyncio.to_thread(self._path.read_text)
+            loaded = Settings.model_validate_json(content)
+        except (OSError, pydantic.ValidationError) as e:
+            _log.error(f"Ignoring invalid settings file {self._path}: {e}")
+            return
+
+        changed = [
+            name for name in Settings.model_fields
+            if getattr(loaded, name) != getattr(self.settings, name)
+        ]
+        if len(changed) == 0:
+            return
+        if self._dirty:
+            _log.warning("Settings file changed while local changes are pending, the local changes overwrite it")
+            return
+        for name in changed:
+            setattr(self.settings, name, getattr(loaded, name))
+        _log.info(f"Reloaded settings from {self._path}, changed: {', '.join(changed)}")
+        self._notify(changed)
+
+    async def run(self) -> None:
+        exited = asyncio.Event()
+        self._app.exited >> filters.call_if_true(exited.set)
+
+        while not exited.is_set():
+            try:
+                await asyncio.wait_for(exited.wait(), self._app.settings.settings_poll_interval)
+            except TimeoutError:
+                pass
+            if exited.is_set():
+                break
+            stat = await asyncio.to_thread(_stat, self._path)
+            if stat is None:
+                continue
+            known = self._known
+            if known is None or (stat.st_mtime_ns, stat.st_size, stat.st_ino) != (known.st_mtime_ns, known.st_size, known.st_ino):
+                await self._reload(stat)
+
+        await self.flush()
@@ -14,11 +14,12 @@ import asyncio
 import typing
 
 from fastapi import FastAPI, Depends, HTTPException
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, PlainTextResponse
 from urllib.parse import urlencode
 from el.observable import filters
 from el.async_tools import synchronize
 
+from compass_app import metrics
 
 if typing.TYPE_CHECKING:
     from compass_app.main import CompassApp
@@ -36,6 +37,13 @@ class CompassWeb(FastAPI):
         @self.get("/")
         async def homepage():
             return "Welcome to the compass app..."
+
+        @self.get("/metrics", response_class=PlainTextResponse)
+        async def get_metrics():
+            return PlainTextResponse(
+                metrics.REGISTRY.render(),
+                media_type="text/plain; version=0.0.4; charset=utf-8",
+            )
     
     async def run(self) -> None:
 
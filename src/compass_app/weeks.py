@@ -0,0 +1,176 @@
+"""
+The Compass Community © 2025 - now
+www.thecompass.diy
+18.10.26, 15:10
+
+Compass week calendar.
+
+Compass accountability uses US-style weeks which start on Sunday and end on
+Saturday. Week 1 of a year is the week starting on the first Sunday of
+that year (the same as `%U` in strftime), so Sunday Jan. 5th 2025 is the
+first day of week 1 of 2025. The days of January before the first Sunday
+belong to the last week of the previous year, so unlike `%U` there
+is no week 0 and every week is exactly seven days long.
+
+Lookups are O(1): the weeks of the configured range of years are
+precomputed into a table that is indexed by the distance in days
+from the first Sunday of the range.
+"""
+
+import typing
+import dataclasses
+from datetime import date, timedelta
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class CompassWeek:
+    year: int
+    week: int
+    # Sunday
+    start: date
+    # Saturday
+    end: date
+
+    def __str__(self) -> str:
+        return f"week {self.week} of {self.year}"
+
+
+def first_sunday(year: int) -> date:
+    """Returns the first Sunday of the year, which is the first day of week 1"""
+    jan1 = date(year, 1, 1)
+    # weekday(): Mon=0, Sun=6
+    return jan1 + timedelta(days=(6 - jan1.weekday()) % 7)
+
+
+class CompassCalendar:
+    """
+    Precomputed table of all compass weeks of a range of years.
+    Dates and weeks outside of the range are still supported
+    but calculated on every lookup.
+    """
+
+    def __init__(self, first_year: int = 2024, last_year: int = 2050):
+        if last_year < first_year:
+            raise ValueError("The last year of the calendar must not be before the first year")
+        self.first_year = first_year
+        self.last_year = last_year
+
+        self._base = first_sunday(first_year).toordinal()
+        self._end = first_sunday(last_year + 1).toordinal()
+        self._weeks: list[CompassWeek] = []
+        # index of week 1 of every year in the table
+        self._year_start: dict[int, int] = {}
+
+        for year in range(first_year, last_year + 1):
+            self._year_start[year] = len(self._weeks)
+            start = first_sunday(year)
+            next_year = first_sunday(year + 1)
+            week = 1
+            while start < next_year:
+                self._weeks.append(CompassWeek(year, week, start, start + timedelta(days=6)))
+                start += timedelta(days=7)
+                week += 1
+
+    @staticmethod
+    def _calculate_week_of(day: date) -> CompassWeek:
+        year = day.year if day >= first_sunday(day.year) else day.year - 1
+        return CompassCalendar._calculate_week(year, (day - first_sunday(year)).days // 7 + 1)
+
+    @staticmethod
+    def _calculate_week(year: int, week: int) -> CompassWeek:
+        start = first_sunday(year) + timedelta(weeks=week - 1)
+        if week < 1 or start >= first_sunday(year + 1):
+            raise ValueError(f"Year {year} has no week {week}")
+        return CompassWeek(year, week, start, start + timedelta(days=6))
+
+    def week_of(self, day: date) -> CompassWeek:
+        """Returns the week containing a date"""
+        offset = day.toordinal() - self._base
+        if offset < 0 or day.toordinal() >= self._end:
+            return self._calculate_week_of(day)
+        return self._weeks[offset // 7]
+
+    def week(self, year: int, week: int) -> CompassWeek:
+        """
+        Returns the week with the provided number.
+
+        Raises
+        ------
+        ValueError
+            The year doesn't have a week with this number
+        """
+        start = self._year_start.get(year)
+        if start is None:
+            return self._calculate_week(year, week)
+        if week < 1:
+            raise ValueError(f"Year {year} has no week {week}")
+        index = start + week - 1
+        if index >= len(self._weeks) or self._weeks[index].year != year:
+            raise ValueError(f"Year {year} has no week {week}")
+        return self._weeks[index]
+
+    def weeks_in_year(self, year: int) -> int:
+        """Returns the number of weeks in a year (52 or 53)"""
+        return (first_sunday(year + 1) - first_sunday(year)).days // 7
+
+    def weeks_of(self, days: typing.Iterable[date]) -> list[CompassWeek]:
+        """
+        Converts many dates to their weeks at once, for analytics.
+        This avoids the per-call overhead of `week_of()`.
+        """
+        base = self._base
+        end = self._end
+        table = self._weeks
+        calculate = self._calculate_week_of
+        result = []
+        for day in days:
+            ordinal = day.toordinal()
+            if base <= ordinal < end:
+                result.append(table[(ordinal - base) // 7])
+            else:
+                result.append(calculate(day))
+        return result
+
+    def current_week(self, today: date | None = None) -> CompassWeek:
+        """Returns the week of today or the provided date"""
+        return self.week_of(today if today is not None else date.today())
+
+    def previous_week(self, week: CompassWeek) -> CompassWeek:
+        return self.week_of(week.start - timedelta(days=7))
+
+    def next_week(self, week: CompassWeek) -> CompassWeek:
+        return self.week_of(week.start + timedelta(days=7))
+
+
+# calendar used by the app, this is replaced by `configure()`
+_calendar = CompassCalendar()
+
+
+def configure(first_year: int, last_year: int) -> None:
+    """Rebuilds the app calendar with a different range of years"""
+    global _calendar
+    _calendar = CompassCalendar(first_year, last_year)
+
+
+def get_calendar() -> CompassCalendar:
+    return _calendar
+
+
+def week_of(day: date) -> CompassWeek:
+    """Returns the week containing a date"""
+    return _calendar.week_of(day)
+
+
+def current_week(today: date | None = None) -> CompassWeek:
+    """Returns the week of today or the provided date"""
+    return _calendar.current_week(today)
+
+
+def week(year: int, week: int) -> CompassWeek:
+    """Returns the week with the provided number"""
+    return _calendar.week(year, week)
+
+
+def weeks_of(days: typing.Iterable[date]) -> list[CompassWeek]:
+    """Converts many dates to their weeks at once"""
+    return _calendar.weeks_of(days)